@@ -2,15 +2,29 @@
 
 import getpass
 import argparse
+import atexit
+import functools
 import json
 import os.path
+import queue
+import threading
 from colorama import init, Fore, Style
 from requests.auth import HTTPBasicAuth
 
-from beep_downloader.remote.json import JsonRemote
+from beep_downloader import timing
+from beep_downloader.remote import CrawlCache
+from beep_downloader.remote.json import JsonRemote, DownloadPlanner
 from beep_downloader.remote.scraper import ScraperRemote
-from beep_downloader.cache import get_cache, get_forbidden_files
+from beep_downloader.manifest import Manifest
+from beep_downloader.filters import CrawlFilter
+from beep_downloader.structure import load_structure, dump_structure
 from beep_downloader.download import python_parallel_downloader
+from beep_downloader.login import set_session_cache, revalidate_login
+from beep_downloader.download_ui import set_progress
+from beep_downloader.watch import ActivityCache, Status, ARCHIVED_MAX_AGE, \
+    watch
+from beep_downloader.utils import parse_size, parse_duration, \
+    format_duration
 
 
 def parse_args():
@@ -21,6 +35,10 @@ def parse_args():
     pw_group.add_argument("--pw-stdin",
                           action="store_true",
                           help="Read password from stdin")
+    parser.add_argument("--no-session-cache",
+                        action="store_true",
+                        help="Do not save the session cookies on disk, log "
+                        "in from scratch at every run")
     parser.add_argument("--out-dir",
                         default="results",
                         help="Destination directory")
@@ -30,28 +48,401 @@ def parse_args():
     parser.add_argument("--include-beep",
                         action="store_true",
                         help="Include useless 'BeeP channe' course")
+    parser.add_argument("--include-course",
+                        action="append",
+                        default=[],
+                        help="Crawl only the courses with this groupId or "
+                        "whose name matches this glob (e.g. '*2024*'), can "
+                        "be repeated")
+    parser.add_argument("--exclude-course",
+                        action="append",
+                        default=[],
+                        help="Do not crawl the courses with this groupId or "
+                        "whose name matches this glob, can be repeated")
+    parser.add_argument("--include-folder",
+                        action="append",
+                        default=[],
+                        help="Download only the files in the folders that "
+                        "match this glob: without / it matches the name of "
+                        "a folder at any depth, with / the path from the "
+                        "course (e.g. 'Lezioni/2024*'). Can be repeated")
+    parser.add_argument("--exclude-folder",
+                        action="append",
+                        default=[],
+                        help="Do not crawl the folders that match this glob "
+                        "(e.g. 'Registrazioni*'), like --include-folder. Can "
+                        "be repeated")
+    parser.add_argument("--include-ext",
+                        action="append",
+                        default=[],
+                        help="Download only the files with these extensions, "
+                        "separated by commas (e.g. pdf,zip)")
+    parser.add_argument("--exclude-ext",
+                        action="append",
+                        default=[],
+                        help="Do not download the files with these "
+                        "extensions, separated by commas (e.g. mp4)")
+    parser.add_argument("--max-size",
+                        type=parse_size,
+                        help="Do not download the files bigger than this "
+                        "(e.g. 500M)")
     parser.add_argument("--no-overwrite",
                         action="store_true",
                         help="Do not overwrite existing files")
+    parser.add_argument("--engine",
+                        choices=["threads", "asyncio", "aria2"],
+                        default="threads",
+                        help="Download engine, asyncio requires aiohttp and "
+                        "aria2 requires aria2c")
     parser.add_argument("--download-threads",
                         type=int,
                         default=10,
-                        help="Number of threads used to download")
+                        help="Number of threads (or concurrent transfers "
+                        "with --engine asyncio) used to download")
+    parser.add_argument("--progress",
+                        choices=["auto", "board", "log", "quiet"],
+                        default="auto",
+                        help="How the download progress is shown: a board "
+                        "with the file of each downloader, a log line per "
+                        "file or only the errors. auto shows the board on a "
+                        "terminal and the log otherwise")
+    parser.add_argument("--adaptive",
+                        action="store_true",
+                        help="Adapt the number of active transfers, up to "
+                        "--download-threads, to the measured throughput and "
+                        "errors")
+    parser.add_argument("--max-rate",
+                        type=parse_size,
+                        help="Limit the total download speed, in bytes per "
+                        "second (e.g. 5M)")
+    parser.add_argument("--dedup",
+                        choices=["off", "reflink", "hardlink"],
+                        default="off",
+                        help="Replace the downloaded files whose content "
+                        "hash matches a file already downloaded with links to "
+                        "it. The reflinks need a copy-on-write filesystem, the "
+                        "hard links share the edits made to any copy")
+    parser.add_argument("--schedule",
+                        choices=["crawl", "lpt", "small"],
+                        default="crawl",
+                        help="Order of the downloads: as the courses are "
+                        "crawled, biggest files first (shortest total time) "
+                        "or smallest files first (most files available "
+                        "early). Not supported by --engine aria2")
+    parser.add_argument("--fair",
+                        action="store_true",
+                        help="Share the downloaders evenly among the "
+                        "courses instead of one course at a time")
+    parser.add_argument("--segment-threshold",
+                        type=parse_size,
+                        default="100M",
+                        help="Download files bigger than this (e.g. 100M) "
+                        "in parallel segments, 0 to disable")
+    parser.add_argument("--session-lifetime",
+                        type=parse_duration,
+                        help="How long a BeeP session lasts (e.g. 30m), the "
+                        "session is renewed in background before it expires. "
+                        "By default it's learned from the first expiry")
     parser.add_argument(
         "--structure",
         action="store",
         help=
         "Do not query the API to get the structure but use this file instead")
+    parser.add_argument("--save-structure",
+                        help="Write the structure of the courses to this "
+                        "file, one folder per line, to be used later with "
+                        "--structure")
     parser.add_argument("--json-api",
                         action="store_true",
                         help="Use the beep JSON api")
-    return parser.parse_args()
+    parser.add_argument("--crawl-threads",
+                        type=int,
+                        default=8,
+                        help="Number of concurrent requests used to fetch "
+                        "the structure with --json-api")
+    parser.add_argument("--json-batch",
+                        action="store_true",
+                        help="Group the --json-api requests of each level "
+                        "of the tree in batch requests")
+    parser.add_argument("--incremental",
+                        action="store_true",
+                        help="Do not fetch again the files of the folders "
+                        "whose lastPostDate and modifiedDate did not change "
+                        "since the last run, their subfolders are still "
+                        "listed (--json-api only)")
+    parser.add_argument("--max-age",
+                        type=parse_duration,
+                        help="Reuse without any request the courses crawled "
+                        "less than this ago (e.g. 12h, 7d)")
+    parser.add_argument("--stream",
+                        action="store_true",
+                        help="Start downloading while the list of courses "
+                        "is still being fetched")
+    parser.add_argument("--profile-report",
+                        help="Time every request and write a report with "
+                        "the latency percentiles of each endpoint, the "
+                        "slowest files and the time spent in each phase to "
+                        "this file, as CSV if it ends with .csv and as JSON "
+                        "otherwise")
+    parser.add_argument("--prometheus",
+                        help="Write the timings of the run to this file in "
+                        "the Prometheus text format, for the textfile "
+                        "collector of the node exporter")
+    parser.add_argument("--watch",
+                        type=parse_duration,
+                        help="Keep running and sync again at this interval "
+                        "(e.g. 1h). The courses changed recently are "
+                        "crawled at every sync, the others less often, at "
+                        "least every --max-age (default 7d)")
+    parser.add_argument("--jitter",
+                        type=parse_duration,
+                        help="Move each sync of --watch randomly by up to "
+                        "this much (default a tenth of the interval)")
+    parser.add_argument("--status-file",
+                        help="Where --watch writes its state, the time of "
+                        "the last sync and the files still to download "
+                        "(default status.json in --out-dir)")
+    args = parser.parse_args()
+    if args.watch and (args.structure or args.no_cache):
+        parser.error("--watch cannot be used with --structure or --no-cache")
+    return args
+
+
+def get_downloader(args):
+    dedup = None if args.dedup == "off" else args.dedup
+    if args.engine == "asyncio":
+        try:
+            from beep_downloader.download_async import \
+                asyncio_parallel_downloader
+        except ImportError:
+            print(Style.BRIGHT + Fore.RED +
+                  "--engine asyncio requires aiohttp to be installed")
+            exit(1)
+        return functools.partial(asyncio_parallel_downloader,
+                                 session_lifetime=args.session_lifetime,
+                                 max_rate=args.max_rate,
+                                 dedup=dedup,
+                                 schedule=args.schedule,
+                                 fair=args.fair)
+    if args.engine == "aria2":
+        from beep_downloader.download_aria2 import aria2_available, \
+            aria2_parallel_downloader
+        if not aria2_available():
+            print(Style.BRIGHT + Fore.RED +
+                  "--engine aria2 requires aria2c to be installed")
+            exit(1)
+        return functools.partial(aria2_parallel_downloader,
+                                 session_lifetime=args.session_lifetime,
+                                 max_rate=args.max_rate)
+    return functools.partial(python_parallel_downloader,
+                             segment_threshold=args.segment_threshold,
+                             session_lifetime=args.session_lifetime,
+                             adaptive=args.adaptive,
+                             max_rate=args.max_rate,
+                             dedup=dedup,
+                             schedule=args.schedule,
+                             fair=args.fair)
+
+
+def get_crawl_filter(args):
+    def extensions(values):
+        return [e for value in values for e in value.split(",")]
+
+    return CrawlFilter(args.include_course, args.exclude_course,
+                       args.include_folder, args.exclude_folder,
+                       extensions(args.include_ext),
+                       extensions(args.exclude_ext), args.max_size)
+
+
+class SyncFailed(Exception):
+    pass
+
+
+def login_failed():
+    raise SyncFailed("Login failed, maybe wrong credentials?")
+
+
+def stream_download(remote, args, username, password, downloaded,
+                    forbidden_files, manifest):
+    items = queue.Queue()
+    planned = []
+
+    def put(item):
+        planned.append(item)
+        items.put(item)
+
+    planner = DownloadPlanner(downloaded, args.out_dir, forbidden_files, put)
+    result = dict()
+
+    def crawl_thread():
+        try:
+            with timing.phase("crawl"):
+                result["structure"] = remote.stream_user_sites(
+                    args.include_beep, username, password, planner)
+        except Exception as e:
+            result["error"] = e
+        finally:
+            items.put(None)
+
+    def to_download():
+        while True:
+            item = items.get()
+            if item is None:
+                return
+            yield item
+
+    crawler = threading.Thread(target=crawl_thread)
+    crawler.start()
+    with timing.phase("download"):
+        get_downloader(args)(username, password, to_download(),
+                             args.download_threads, not args.no_overwrite,
+                             manifest)
+    crawler.join()
+
+    if isinstance(result.get("error"), json.decoder.JSONDecodeError):
+        login_failed()
+    if "error" in result:
+        raise result["error"]
+    if result["structure"] is None:
+        login_failed()
+    planner.print_summary()
+    return result["structure"], planned
+
+
+def save_structure(args, manifest, structure):
+    manifest.save_structure(structure)
+    if args.save_structure:
+        with open(args.save_structure, "w") as f:
+            dump_structure(structure, f)
+
+
+def write_profile(args, profiler):
+    if args.profile_report:
+        profiler.write_report(args.profile_report)
+    if args.prometheus:
+        profiler.write_prometheus(args.prometheus)
+
+
+def sync(args, username, password, manifest, remote, crawl_filter):
+    # crawls the courses and downloads the new files, returns the structure
+    # and the planned files
+    if args.no_cache:
+        downloaded = dict()
+        forbidden_files = set()
+    else:
+        downloaded = manifest.downloaded()
+        forbidden_files = manifest.forbidden_files()
+        partial = manifest.partial_files()
+        if partial:
+            print(Style.BRIGHT + Fore.YELLOW +
+                  "%d downloads were interrupted, they are planned again" %
+                  len(partial))
+
+    if args.stream and not args.structure:
+        print(Style.BRIGHT + Fore.LIGHTCYAN_EX +
+              "Fetch list of courses and download files into %s" %
+              args.out_dir)
+        structure, to_download = stream_download(remote, args, username,
+                                                 password, downloaded,
+                                                 forbidden_files, manifest)
+        save_structure(args, manifest, structure)
+        return structure, to_download
+
+    if args.structure:
+        with open(args.structure) as f:
+            structure = crawl_filter.prune_sites(load_structure(f))
+            print("Loaded %d courses" % len(structure))
+    else:
+        print(Style.BRIGHT + Fore.LIGHTCYAN_EX + "Fetch list of courses")
+        try:
+            with timing.phase("crawl"):
+                structure = remote.get_user_sites(args.include_beep,
+                                                  username, password)
+            if structure is None:
+                raise RuntimeError("Login failed")
+        except (json.decoder.JSONDecodeError, RuntimeError):
+            login_failed()
+    save_structure(args, manifest, structure)
+
+    print(Style.BRIGHT + Fore.LIGHTCYAN_EX + "Computing download size")
+    with timing.phase("plan"):
+        to_download = remote.get_download_list(structure, downloaded,
+                                               args.out_dir, forbidden_files)
+    if not to_download:
+        return structure, to_download
+
+    print(Style.BRIGHT + Fore.LIGHTCYAN_EX +
+          "Downloading files into %s" % args.out_dir)
+    with timing.phase("download"):
+        get_downloader(args)(username, password, to_download,
+                             args.download_threads, not args.no_overwrite,
+                             manifest)
+    return structure, to_download
+
+
+def watch_syncs(args, username, password, manifest, remote, crawl_filter):
+    # the process, the sessions and the structure of the last sync stay in
+    # memory between the syncs
+    status = Status(args.status_file
+                    or os.path.join(args.out_dir, "status.json"))
+    state = {"structure": manifest.load_structure()}
+
+    def watch_sync():
+        if not args.profile_report and not args.prometheus:
+            return run_sync()
+        # every sync writes its own timings, the profiler starts again empty
+        # instead of growing for the life of the process
+        profiler = timing.enable()
+        try:
+            return run_sync()
+        finally:
+            write_profile(args, profiler)
+
+    def run_sync():
+        cache = ActivityCache(state["structure"], args.max_age
+                              or ARCHIVED_MAX_AGE, args.incremental,
+                              crawl_filter.signature)
+        remote.cache = cache
+        revalidate_login(username)
+        due = cache.due()
+        print(Style.BRIGHT + Fore.LIGHTCYAN_EX +
+              "Sync started, %d of %d known courses to crawl again" %
+              (due, len(cache.structure)))
+        structure, to_download = sync(args, username, password, manifest,
+                                      remote, crawl_filter)
+        state["structure"] = structure
+        # the files not downloaded are planned again by the next sync
+        downloaded = manifest.downloaded()
+        pending = sum(1 for item in to_download
+                      if downloaded.get(item.fileEntryId) != (
+                          item.modifiedDate, item.path))
+        return {
+            "courses": len(structure),
+            "courses_due": due,
+            "planned": len(to_download),
+            "pending": pending
+        }
+
+    print(Style.BRIGHT + Fore.LIGHTCYAN_EX +
+          "Watching, a sync every %s" % format_duration(args.watch))
+    jitter = args.jitter if args.jitter is not None else args.watch / 10
+    watch(watch_sync, args.watch, jitter, status)
 
 
 def main():
     init(autoreset=True)
     print(Style.BRIGHT + Fore.LIGHTGREEN_EX + "Welcome to Beep downloader")
     args = parse_args()
+    if args.profile_report or args.prometheus:
+        profiler = timing.enable()
+        if not args.watch:
+            # written at exit, also when the run stops early. The watcher
+            # writes them after every sync
+            atexit.register(write_profile, args, profiler)
+    if args.no_session_cache:
+        set_session_cache(None)
+    if args.progress != "auto":
+        set_progress(args.progress)
 
     if not args.person_code or not args.password:
         print(Style.BRIGHT + Fore.LIGHTCYAN_EX +
@@ -70,57 +461,40 @@ def main():
         username = args.person_code
         password = args.password
 
+    manifest = Manifest(os.path.join(args.out_dir, "manifest.db"))
+    cache_path = os.path.join(args.out_dir, "cache.json")
+    if manifest.created and os.path.exists(cache_path):
+        manifest.import_json(args.out_dir, cache_path,
+                             os.path.join(args.out_dir, "forbidden.json"),
+                             os.path.join(args.out_dir, "validators.json"))
+    if args.no_cache:
+        manifest.revalidate = False
+
+    crawl_filter = get_crawl_filter(args)
+    cache = None
+    if not args.watch and not args.no_cache and (args.incremental or
+                                                 args.max_age is not None):
+        cache = CrawlCache(manifest.load_structure(), args.max_age,
+                           args.incremental, crawl_filter.signature)
     if args.json_api:
-        remote = JsonRemote()
+        remote = JsonRemote(args.crawl_threads, args.json_batch, cache,
+                            crawl_filter)
     else:
         print(Style.BRIGHT + Fore.YELLOW +
               "Without --json-api the files may have the wrong extension")
-        remote = ScraperRemote()
-
-    if args.structure:
-        with open(args.structure) as f:
-            structure = json.load(f)
-            print("Loaded %d courses" % len(structure))
-    else:
-        print(Style.BRIGHT + Fore.LIGHTCYAN_EX + "Fetch list of courses")
-        try:
-            structure = remote.get_user_sites(args.include_beep, username,
-                                              password)
-            if structure is None:
-                raise RuntimeError("Login failed")
-        except (json.decoder.JSONDecodeError, RuntimeError):
-            print(Style.BRIGHT + Fore.RED +
-                  "Login failed, maybe wrong credentials?")
-            exit(1)
+        remote = ScraperRemote(cache, crawl_filter=crawl_filter)
 
-    cache_path = os.path.join(args.out_dir, "cache.json")
-    forbidden_files_path = os.path.join(args.out_dir, "forbidden.json")
-    if args.no_cache:
-        cache = dict()
-        forbidden_files = set()
-    else:
-        cache = get_cache(cache_path)
-        forbidden_files = get_forbidden_files(forbidden_files_path)
-
-    print(Style.BRIGHT + Fore.LIGHTCYAN_EX + "Computing download size")
-    to_download = remote.get_download_list(structure, cache, args.out_dir,
-                                           forbidden_files)
-
-    if not to_download:
-        print(Style.BRIGHT + Fore.LIGHTGREEN_EX + "Done! Enjoy c:")
-        exit(0)
-
-    print(Style.BRIGHT + Fore.LIGHTCYAN_EX +
-          "Downloading files into %s" % args.out_dir)
-    forbidden_files = python_parallel_downloader(
-        username, password, to_download, args.download_threads,
-        not args.no_overwrite, forbidden_files, forbidden_files_path)
-
-    with open(cache_path, "w") as f:
-        f.write(json.dumps(structure))
-    with open(forbidden_files_path, "w") as f:
-        f.write(json.dumps(list(forbidden_files)))
+    try:
+        if args.watch:
+            watch_syncs(args, username, password, manifest, remote,
+                        crawl_filter)
+        else:
+            sync(args, username, password, manifest, remote, crawl_filter)
+    except SyncFailed as e:
+        print(Style.BRIGHT + Fore.RED + str(e))
+        exit(1)
 
+    manifest.close()
     print(Style.BRIGHT + Fore.LIGHTGREEN_EX + "Done! Enjoy c:")
 
 
@@ -5,31 +5,17 @@ import json
 from colorama import init, Fore, Style
 
 
-def get_file_from_cache(cache, fileEntryId):
-    for f in cache.get("files", []):
-        if f.get("classPK") == fileEntryId or f.get("fileEntryId") == fileEntryId:
-            return f
-    return {}
-
-
-def get_folder_from_cache(cache, folderId):
-    return cache.get("folders", dict()).get(str(folderId), dict())
-
-
-def get_site_from_cache(cache, groupId):
-    return cache.get(groupId, dict())
-
-
 def get_cache(cache_path):
     if not os.path.exists(cache_path):
         return dict()
     with open(cache_path, "r") as f:
         try:
-            return json.loads(f.read())
+            cache = json.loads(f.read())
         except:
             print(Style.BRIGHT + Fore.RED + "Corrupted cache!")
             os.remove(cache_path)
             return dict()
+    return cache
 
 
 def get_forbidden_files(forbidden_files_path):
@@ -42,3 +28,28 @@ def get_forbidden_files(forbidden_files_path):
             print(Style.BRIGHT + Fore.RED + "Corrupted forbidden files!")
             os.remove(forbidden_files_path)
             return set()
+
+
+def get_validators(validators_path):
+    if not os.path.exists(validators_path):
+        return dict()
+    with open(validators_path, "r") as f:
+        try:
+            return json.loads(f.read())
+        except:
+            print(Style.BRIGHT + Fore.RED + "Corrupted validators!")
+            os.remove(validators_path)
+            return dict()
+
+
+def index_folders(structure):
+    # folderId -> folder of every folder in the structure, the ids are unique
+    # across the sites
+    index = dict()
+    stack = list(structure.values())
+    while stack:
+        folder = stack.pop()
+        for folderId, subfolder in folder.get("folders", dict()).items():
+            index[int(folderId)] = subfolder
+            stack.append(subfolder)
+    return index
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+
+import hashlib
+import os
+import os.path
+
+HASH = "sha256"
+LINK_SUFFIX = ".link.part"
+# linux ioctl that shares the extents of a file on copy-on-write filesystems
+FICLONE = 0x40049409
+HARDLINK = "hardlink"
+REFLINK = "reflink"
+
+
+def new_hash():
+    return hashlib.new(HASH)
+
+
+def hash_file(path, hasher=None):
+    hasher = hasher or new_hash()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024**2), b""):
+            hasher.update(chunk)
+    return hasher
+
+
+def _reflink(src, dst):
+    try:
+        import fcntl
+    except ImportError:
+        raise OSError("reflinks are not supported on this platform")
+    with open(src, "rb") as s, open(dst, "wb") as d:
+        fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+
+
+def link_file(src, dst, mode=HARDLINK):
+    # replaces dst with a link to src, returns False if the filesystem
+    # cannot link them. The downloads always write a new file and rename it,
+    # so a linked file updated later does not change its other copies
+    try:
+        if os.path.samefile(src, dst):
+            return True
+    except OSError:
+        pass
+    os.makedirs(os.path.dirname(dst), exist_ok=True)
+    tmp = dst + LINK_SUFFIX
+    try:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        if mode == REFLINK:
+            _reflink(src, tmp)
+        else:
+            os.link(src, tmp)
+    except OSError:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
+    os.replace(tmp, dst)
+    return True
+
+
+def share_content(manifest, validator, mode=HARDLINK):
+    # replaces a file just downloaded with a link to an identical file
+    # downloaded before, returns True if it was linked
+    if not validator or not validator.get("hash"):
+        return False
+    path, length = validator["path"], validator["length"]
+    for other in manifest.same_content(length, validator["hash"]):
+        if other == path or not os.path.exists(other):
+            continue
+        if os.path.getsize(other) == length and link_file(other, path, mode):
+            return True
+    return False
+
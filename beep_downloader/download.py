@@ -1,20 +1,39 @@
 #!/usr/bin/env python3
 
+import json
 import requests
 import tempfile
 import subprocess
 import os.path
-import queue
 import threading
 import traceback
-import json
+import math
 import re
+import time
+from collections import namedtuple
+from email.utils import formatdate, parsedate_to_datetime
 from colorama import init, Fore, Style
 
-from beep_downloader.login import perform_beep_login
-from beep_downloader.download_ui import DownloadUI, thread_print
+from beep_downloader import timing
+from beep_downloader.login import LoginManager
+from beep_downloader.download_ui import DownloadUI
+from beep_downloader.download_control import Backoff, RateLimiter, \
+    ConcurrencyController
+from beep_downloader.schedule import Schedule, ScheduledQueue
+from beep_downloader.dedup import new_hash, hash_file, share_content
 
 CHUNK_SIZE = 4096
+PART_SUFFIX = ".part"
+SEGMENTS_SUFFIX = ".segments.part"
+# the segments already written in the .segments.part file, and the size and
+# validator of the response they come from
+SEGMENTS_STATE_SUFFIX = ".segments.json"
+MIN_SEGMENT_SIZE = 4 * 1024**2
+
+DownloadItem = namedtuple(
+    "DownloadItem",
+    ["url", "path", "fileEntryId", "size", "modifiedDate", "groupId"],
+    defaults=[None])
 
 
 class LoginFailed(Exception):
@@ -25,137 +44,550 @@ class Unauthorized(Exception):
     pass
 
 
-def _do_download(url, path, cookies, ui):
-    session = requests.Session()
-    session.cookies = cookies
-    with session.get(url, stream=True, allow_redirects=False) as res:
-        if res.status_code >= 300 and res.status_code <= 399:
-            raise LoginFailed()
-        if res.status_code >= 400 and res.status_code <= 499:
-            raise Unauthorized()
-        if "Content-Disposition" in res.headers:
-            match = re.search(r'filename="([^"]+)"',
-                              res.headers["Content-Disposition"])
-            if match:
-                filename = match.group(1)
-                ext = filename.split(".")[-1]
-                if not path.endswith(ext):
-                    path = path + "." + ext
+class IncompleteDownload(Exception):
+    pass
+
+
+class SegmentRequeued(Exception):
+    pass
+
+
+class NotModified(Exception):
+    pass
+
+
+class ServerBusy(Exception):
+    # 429 or 503, the server asks to slow down
+    def __init__(self, retry_after=None):
+        super().__init__("Server busy")
+        self.retry_after = retry_after
+
+
+def _retry_after(headers):
+    value = headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _check_status(status, headers):
+    if status >= 300 and status <= 399:
+        raise LoginFailed()
+    if status in (429, 503):
+        raise ServerBusy(_retry_after(headers))
+    if status >= 400 and status <= 499:
+        raise Unauthorized()
+    if status >= 500:
+        raise IncompleteDownload("Server error %d" % status)
+
+
+def _iter_chunks(res, ui, limiter=None):
+    for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
+        if chunk:
+            ui.add_download(len(chunk))
+            if limiter is not None:
+                limiter.consume(len(chunk))
+            yield chunk
+
+
+def _file_path(path, headers):
+    if "Content-Disposition" in headers:
+        match = re.search(r'filename="([^"]+)"', headers["Content-Disposition"])
+        if match:
+            filename = match.group(1)
+            ext = filename.split(".")[-1]
+            if not path.endswith(ext):
+                path = path + "." + ext
+    return path
+
+
+def _expected_size(res, offset):
+    try:
+        length = int(res.headers["Content-Length"])
+    except (KeyError, ValueError):
+        length = None
+    if res.status_code != 206:
+        return length
+    match = re.match(r"bytes (\d+)-(\d+)/(\d+|\*)",
+                     res.headers.get("Content-Range", ""))
+    if not match or int(match.group(1)) != offset:
+        raise IncompleteDownload("Invalid Content-Range")
+    start, end, total = match.groups()
+    if length is not None and length != int(end) - int(start) + 1:
+        raise IncompleteDownload("Content-Length does not match Content-Range")
+    if total != "*":
+        return int(total)
+    if length is not None:
+        return offset + length
+    return None
+
+
+def _conditional_headers(validator):
+    # a file is revalidated only if the copy downloaded last time is still
+    # there untouched
+    headers = dict()
+    if not validator or not os.path.exists(validator["path"]):
+        return headers
+    if os.path.getsize(validator["path"]) != validator.get("length"):
+        return headers
+    if validator.get("etag"):
+        headers["If-None-Match"] = validator["etag"]
+    if validator.get("lastModified"):
+        headers["If-Modified-Since"] = validator["lastModified"]
+    return headers
+
+
+def _validator(path, headers, length):
+    return {
+        "path": path,
+        "etag": headers.get("ETag"),
+        "lastModified": headers.get("Last-Modified"),
+        "length": length
+    }
+
+
+def _do_download(url, path, session, ui, validator=None, limiter=None):
+    # the partial file is named after the planned path since the extension
+    # is known only after the response
+    started = time.monotonic()
+    part_path = path + PART_SUFFIX
+    # compressed bodies would break the byte offsets
+    headers = {"Accept-Encoding": "identity"}
+    offset = 0
+    if os.path.exists(part_path):
+        offset = os.path.getsize(part_path)
+    else:
+        headers.update(_conditional_headers(validator))
+    if offset:
+        # the mtime of a partial file is the Last-Modified of its response, if
+        # the file has changed since then the server sends it all again
+        headers["Range"] = "bytes=%d-" % offset
+        headers["If-Range"] = formatdate(os.path.getmtime(part_path),
+                                         usegmt=True)
+    with session.get(url, headers=headers, stream=True,
+                     allow_redirects=False) as res:
+        if res.status_code == 416:
+            os.remove(part_path)
+            raise IncompleteDownload("Range not satisfiable")
+        if res.status_code == 304:
+            raise NotModified()
+        _check_status(res.status_code, res.headers)
+        path = _file_path(path, res.headers)
+        if res.status_code != 206:
+            offset = 0
+        expected = _expected_size(res, offset)
         dirname = os.path.dirname(path)
         os.makedirs(dirname, exist_ok=True)
-        with open(path, "wb") as f:
-            for chunk in res.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    ui.add_download(len(chunk))
+        # the content hash is computed while writing, a resumed file hashes
+        # the part already on disk first
+        hasher = hash_file(part_path) if offset else new_hash()
+        try:
+            with open(part_path, "ab" if offset else "wb") as f:
+                for chunk in _iter_chunks(res, ui, limiter):
                     f.write(chunk)
+                    hasher.update(chunk)
+            size = os.path.getsize(part_path)
+            if expected is not None and size > expected:
+                os.remove(part_path)
+                raise IncompleteDownload("Received more than Content-Length")
+            if expected is not None and size < expected:
+                raise IncompleteDownload("Connection closed early")
+        except BaseException:
+            _keep_partial(part_path, res.headers.get("Last-Modified"))
+            raise
+    os.replace(part_path, path)
+    timing.file(path, size, time.monotonic() - started)
+    validator = _validator(path, res.headers, size)
+    validator["hash"] = hasher.hexdigest()
+    return validator
+
+
+class SegmentedFile:
+    def __init__(self, item, path, size, segment_size, validator):
+        self.item = item
+        self.path = path
+        self.part_path = item.path + SEGMENTS_SUFFIX
+        self.state_path = item.path + SEGMENTS_STATE_SUFFIX
+        self.size = size
+        self.segment_size = segment_size
+        self.validator = validator
+        # indexes of the segments already written
+        self.done = set()
+        self.remaining = 0
+        self.failed = False
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+
+    @property
+    def resumable(self):
+        # without a validator the segments of a changed file could be mixed
+        return bool(self.validator["etag"] or self.validator["lastModified"])
+
+    def _state(self):
+        return {
+            "size": self.size,
+            "segmentSize": self.segment_size,
+            "etag": self.validator["etag"],
+            "lastModified": self.validator["lastModified"],
+            "done": sorted(self.done)
+        }
 
+    def resume(self):
+        # reuses the segments written by a previous run if they come from
+        # the same version of the file, returns whether it did
+        if not self.resumable or not os.path.exists(self.part_path) or \
+                os.path.getsize(self.part_path) != self.size:
+            return False
+        try:
+            with open(self.state_path, "r") as f:
+                state = json.loads(f.read())
+        except (OSError, ValueError):
+            return False
+        ignored = {"done": [], "segmentSize": None}
+        if dict(state, **ignored) != dict(self._state(), **ignored):
+            return False
+        # the segments keep the size of the previous run
+        self.segment_size = state["segmentSize"]
+        self.done = set(state["done"])
+        return True
 
-def python_parallel_downloader(username, password, to_download, parallel,
-                               overwrite, forbidden_files,
-                               forbidden_files_path):
-    todo = queue.Queue()
-    cookies = None
+    def _save_state(self):
+        tmp_path = self.state_path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(self._state()))
+        os.replace(tmp_path, self.state_path)
+
+    def segment_done(self, index):
+        with self.lock:
+            if self.failed:
+                return False
+            self.done.add(index)
+            self.remaining -= 1
+            if self.remaining > 0:
+                if self.resumable:
+                    self._save_state()
+                return False
+        return self.finish()
+
+    def finish(self):
+        os.replace(self.part_path, self.path)
+        self.discard()
+        timing.file(self.path, self.size, time.monotonic() - self.started)
+        # the segments are written out of order, the file is hashed at the end
+        self.validator["hash"] = hash_file(self.path).hexdigest()
+        return True
+
+    def discard(self):
+        for path in (self.part_path, self.state_path):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def fail(self, forbidden=False):
+        # the file is given up, its segments are kept for the next run if
+        # they can be resumed
+        with self.lock:
+            first = not self.failed
+            self.failed = True
+            if first and (forbidden or not self.resumable):
+                self.discard()
+            return first
+
+
+class Segment:
+    def __init__(self, file, index, count, start, end):
+        self.file = file
+        self.index = index
+        self.url = file.item.url
+        self.path = "%s [%d/%d]" % (file.item.path, index + 1, count)
+        self.fileEntryId = file.item.fileEntryId
+        self.start = start
+        self.end = end
+
+
+def _write_segment(res, file, start, end, ui, limiter=None):
+    match = re.match(r"bytes (\d+)-(\d+)/(\d+)",
+                     res.headers.get("Content-Range", ""))
+    if res.status_code != 206 or not match or int(match.group(1)) != start \
+            or int(match.group(2)) != end:
+        raise IncompleteDownload("Invalid Content-Range")
+    written = 0
+    with open(file.part_path, "r+b") as f:
+        f.seek(start)
+        for chunk in _iter_chunks(res, ui, limiter):
+            f.write(chunk)
+            written += len(chunk)
+    if written != end - start + 1:
+        raise IncompleteDownload("Connection closed early")
+
+
+def _start_segmented(item,
+                     session,
+                     ui,
+                     segment_size,
+                     put,
+                     validator=None,
+                     limiter=None):
+    # the first segment is requested straight away, its Content-Range tells
+    # the exact size of the file. The segments written by a previous run are
+    # reused if the size and the validator of the file did not change.
+    # Returns the validator of the file if it is complete.
+    headers = {
+        "Accept-Encoding": "identity",
+        "Range": "bytes=0-%d" % (segment_size - 1)
+    }
+    headers.update(_conditional_headers(validator))
+    with session.get(item.url, headers=headers, stream=True,
+                     allow_redirects=False) as res:
+        if res.status_code == 304:
+            raise NotModified()
+        _check_status(res.status_code, res.headers)
+        match = re.match(r"bytes 0-(\d+)/(\d+)",
+                         res.headers.get("Content-Range", ""))
+        if res.status_code != 206 or not match:
+            res.close()
+            return _do_download(item.url, item.path, session, ui, validator,
+                                limiter)
+        size = int(match.group(2))
+        path = _file_path(item.path, res.headers)
+        file = SegmentedFile(item, path, size, segment_size,
+                             _validator(path, res.headers, size))
+        if not file.resume():
+            file.discard()
+            os.makedirs(os.path.dirname(file.path), exist_ok=True)
+            with open(file.part_path, "wb") as f:
+                f.truncate(size)
+        starts = range(0, size, file.segment_size)
+        segments = []
+        for index, start in enumerate(starts):
+            end = min(start + file.segment_size, size) - 1
+            if index not in file.done:
+                segments.append(Segment(file, index, len(starts), start,
+                                        end))
+        file.remaining = len(segments)
+        if not segments:
+            # the previous run wrote all the segments but did not finish
+            res.close()
+            return file.validator if file.finish() else None
+        for segment in segments[1:]:
+            put(segment)
+        if segments[0].start != 0 or segments[0].end != int(match.group(1)):
+            # the first segment is already written, or the previous run cut
+            # the file in segments of another size
+            res.close()
+            put(segments[0])
+            return None
+        try:
+            _write_segment(res, file, 0, segments[0].end, ui, limiter)
+        except Exception:
+            # the other segments are already being downloaded, only the first
+            # one has to be retried
+            put(segments[0])
+            raise SegmentRequeued()
+    if file.segment_done(0):
+        return file.validator
+    return None
+
+
+def _download_segment(segment, session, ui, limiter=None):
+    headers = {
+        "Accept-Encoding": "identity",
+        "Range": "bytes=%d-%d" % (segment.start, segment.end)
+    }
+    with session.get(segment.url, headers=headers, stream=True,
+                     allow_redirects=False) as res:
+        _check_status(res.status_code, res.headers)
+        _write_segment(res, segment.file, segment.start, segment.end, ui,
+                       limiter)
+    if segment.file.segment_done(segment.index):
+        return segment.file.validator
+    return None
+
+
+def _keep_partial(part_path, last_modified):
+    if not os.path.exists(part_path):
+        return
+    try:
+        mtime = parsedate_to_datetime(last_modified).timestamp()
+    except (TypeError, ValueError):
+        # without a validator the partial file cannot be resumed safely
+        os.remove(part_path)
+        return
+    os.utime(part_path, (mtime, mtime))
+
+
+def python_parallel_downloader(username,
+                               password,
+                               to_download,
+                               parallel,
+                               overwrite,
+                               manifest,
+                               segment_threshold=0,
+                               session_lifetime=None,
+                               adaptive=False,
+                               max_rate=None,
+                               dedup=None,
+                               schedule="crawl",
+                               fair=False):
+    todo = ScheduledQueue(Schedule(schedule, fair))
     done = False
-    login_needed = threading.Condition()
-    login_required = threading.Condition()
     done_cv = threading.Condition()
-    ui = DownloadUI(len(to_download))
+    ui = DownloadUI(0)
+    login = LoginManager(username, password, session_lifetime, ui)
+    controller = ConcurrencyController(parallel, adaptive)
+    backoff = Backoff()
+    limiter = RateLimiter(max_rate) if max_rate else None
+    # item -> login generation of its last redirect to the login page
+    redirects = dict()
 
-    for f in to_download:
-        todo.put(f)
+    def retry(num, item, path, reason, retry_after=None):
+        # returns the seconds to wait before requeueing the item, None if it
+        # failed too many times
+        delay = backoff.delay(item, retry_after)
+        if delay is None:
+            redirects.pop(item, None)
+            file_done = not isinstance(item, Segment) or item.file.fail()
+            ui.fail_download(num, reason + ", giving up", path, done=file_done)
+        else:
+            ui.fail_download(num, reason, path)
+        return delay
 
     def download_thread(num):
-        nonlocal cookies
         prefix = "Downloader[%d] " % num
+        # every downloader keeps its connections alive between the files, the
+        # cookies are swapped in when the login manager has new ones
+        session = timing.instrument(requests.Session(), "download")
         while True:
             item = todo.get()
             if item is None:
                 break
-            url, path, fileEntryId = item
-            with login_required:
-                if cookies is None:
-                    login_required.notify()
-            with login_needed:
-                while cookies is None and not done:
-                    login_needed.wait()
-            if done:
+            url, path, fileEntryId = item.url, item.path, item.fileEntryId
+            generation, cookies = login.get()
+            if login.failed:
                 todo.task_done()
-                break
+                continue
+            if session.cookies is not cookies:
+                session.cookies = cookies
+            validator = manifest.validator(fileEntryId)
+            retry_in = None
+            controller.acquire()
             try:
-                ui.start_download(num, path)
-                if overwrite or not os.path.exists(path):
-                    _do_download(url, path, cookies, ui)
-                    ui.done_download(num, path)
+                if isinstance(item, Segment):
+                    if not item.file.failed:
+                        ui.start_download(num, path)
+                        validator = _download_segment(item, session, ui,
+                                                      limiter)
+                        if validator:
+                            linked = dedup and share_content(
+                                manifest, validator, dedup)
+                            manifest.done(item.file.item, validator)
+                            ui.done_download(num, item.file.path,
+                                             linked=linked)
+                        else:
+                            ui.done_segment(num, path)
+                elif overwrite or not os.path.exists(path):
+                    ui.start_download(num, path)
+                    manifest.started(item)
+                    if segment_threshold and item.size >= segment_threshold:
+                        segment_size = max(
+                            MIN_SEGMENT_SIZE,
+                            int(math.ceil(item.size / parallel)))
+                        validator = _start_segmented(item, session, ui,
+                                                     segment_size, todo.put,
+                                                     validator, limiter)
+                        if validator:
+                            linked = dedup and share_content(
+                                manifest, validator, dedup)
+                            manifest.done(item, validator)
+                            ui.done_download(num, path, linked=linked)
+                        else:
+                            ui.done_segment(num, path)
+                    else:
+                        validator = _do_download(url, path, session, ui,
+                                                 validator, limiter)
+                        linked = dedup and share_content(
+                            manifest, validator, dedup)
+                        manifest.done(item, validator)
+                        ui.done_download(num, path, linked=linked)
                 else:
+                    ui.start_download(num, path)
+                    manifest.done(item)
                     ui.done_download(num, path, skipped=True)
+            except NotModified:
+                manifest.done(item, validator)
+                ui.done_download(num, path, skipped=True)
             except Unauthorized:
-                ui.fail_download(num, "Unauthorized", path, done=True)
-                forbidden_files.add(fileEntryId)
-            except LoginFailed:
-                ui.fail_download(num, "Session expired", path)
-                todo.put(item)
-                cookies = None
-            except:
+                # the segments of a file count as a single file in the UI
+                file_done = not isinstance(item, Segment) or \
+                    item.file.fail(forbidden=True)
+                ui.fail_download(num, "Unauthorized", path, done=file_done)
+                manifest.forbidden(fileEntryId)
+            except SegmentRequeued:
                 ui.fail_download(num, "Download failed", path)
+            except LoginFailed:
+                if redirects.get(item, generation) < generation:
+                    # redirected again with the cookies of a newer login,
+                    # the file is broken rather than the session
+                    redirects.pop(item)
+                    retry_in = retry(num, item, path,
+                                     "Redirected after login")
+                else:
+                    redirects[item] = generation
+                    ui.fail_download(num, "Session expired", path)
+                    todo.put(item)
+                    # other downloaders may have already obtained new
+                    # cookies
+                    login.expired(generation)
+            except ServerBusy as e:
+                controller.error()
+                retry_in = retry(num, item, path, "Server busy",
+                                 e.retry_after)
+            except Exception:
+                controller.error()
                 traceback.print_exc()
-                todo.put(item)
+                retry_in = retry(num, item, path, "Download failed")
+            else:
+                backoff.forget(item)
+                redirects.pop(item, None)
             finally:
+                controller.release()
+            if retry_in is not None:
+                todo.requeue_later(item, retry_in)
+            else:
                 todo.task_done()
-
-    def login_thread():
-        nonlocal cookies, done
-        while not done:
-            with login_required:
-                while cookies is not None and not done:
-                    login_required.wait()
-            if done:
-                break
-            with login_needed:
-                ui.silent = True
-                cookies = perform_beep_login(username, password)
-                ui.silent = False
-                if not cookies:
-                    done = True
-                    with done_cv:
-                        done_cv.notify_all()
-                    while not todo.empty():
-                        todo.get()
-                        todo.task_done()
-                    login_needed.notify_all()
-                    break
-                login_needed.notify_all()
+        session.close()
 
     def printer_thread():
+        # the UI draws itself, this only measures the speed for the
+        # concurrency controller
         while not done:
             ui.snapshot()
-            ui.print_status()
+            controller.update(ui.current_speed)
             with done_cv:
                 done_cv.wait(2)
 
-    def forbidden_files_thread():
-        os.makedirs(os.path.dirname(forbidden_files_path), exist_ok=True)
-        while not done:
-            with open(forbidden_files_path, "w") as f:
-                f.write(json.dumps(list(forbidden_files)))
-                ui.silent = True
-                thread_print("Saved snapshot of forbidden files: %d files" %
-                             len(forbidden_files))
-                ui.silent = False
-            with done_cv:
-                done_cv.wait(10)
-
-    login = threading.Thread(target=login_thread)
     login.start()
     printer = threading.Thread(target=printer_thread)
     printer.start()
-    forbidden_files_thr = threading.Thread(target=forbidden_files_thread)
-    forbidden_files_thr.start()
     threads = []
     for num in range(parallel):
         thread = threading.Thread(target=download_thread, args=(num, ))
         thread.start()
         threads.append(thread)
 
+    # to_download may be a generator that yields while the structure is still
+    # being crawled, the downloaders are already running at this point
+    for f in to_download:
+        if login.failed:
+            break
+        ui.add_files(1)
+        todo.put(f)
     todo.join()
     for _ in range(parallel):
         todo.put(None)
@@ -164,11 +596,6 @@ def python_parallel_downloader(username, password, to_download, parallel,
     done = True
     with done_cv:
         done_cv.notify_all()
-    with login_required:
-        login_required.notify_all()
-    login.join()
+    login.stop()
     printer.join()
-    forbidden_files_thr.join()
     ui.done()
-
-    return forbidden_files
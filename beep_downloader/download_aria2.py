@@ -0,0 +1,320 @@
+#!/usr/bin/env python3
+
+import binascii
+import collections
+import json
+import os
+import os.path
+import queue
+import re
+import shutil
+import socket
+import subprocess
+import threading
+import time
+import requests
+from concurrent.futures import ThreadPoolExecutor
+
+from beep_downloader import timing
+from beep_downloader.login import LoginManager
+from beep_downloader.download import LoginFailed, Unauthorized, \
+    NotModified, _file_path, _conditional_headers, _validator, _do_download
+from beep_downloader.download_ui import DownloadUI
+
+ARIA2_OPTIONS = {
+    "max-connection-per-server": "4",
+    "split": "4",
+    "min-split-size": "20M",
+    "continue": "true",
+    "allow-overwrite": "true",
+    "auto-file-renaming": "false",
+    # revalidate existing files with If-Modified-Since
+    "conditional-get": "true",
+    "remote-time": "true",
+}
+# aria2 error codes of "resource not found" and "authorization failed"
+ARIA2_FORBIDDEN_ERRORS = {"3", "24"}
+# aria2 error code of an unexpected HTTP response, e.g. a redirect to the
+# login page when the session is expired
+ARIA2_LOGIN_ERRORS = {"22"}
+MAX_RETRIES = 5
+POLL_INTERVAL = 0.5
+
+
+class Aria2Error(Exception):
+    pass
+
+
+class Aria2:
+    def __init__(self, parallel, max_rate=None):
+        sock = socket.socket()
+        sock.bind(("127.0.0.1", 0))
+        self.port = sock.getsockname()[1]
+        sock.close()
+        self.secret = binascii.hexlify(os.urandom(16)).decode()
+        self.url = "http://127.0.0.1:%d/jsonrpc" % self.port
+        self.session = requests.Session()
+        self.process = subprocess.Popen(
+            [
+                "aria2c", "--enable-rpc", "--rpc-listen-all=false",
+                "--rpc-listen-port=%d" % self.port,
+                "--rpc-secret=%s" % self.secret,
+                "--max-concurrent-downloads=%d" % parallel,
+                "--stop-with-process=%d" % os.getpid(),
+                "--max-overall-download-limit=%d" % (max_rate or 0), "--quiet"
+            ],
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                self.call("getVersion")
+                return
+            except requests.ConnectionError:
+                time.sleep(0.1)
+        self.process.kill()
+        raise Aria2Error("aria2c did not start")
+
+    def call(self, method, *params):
+        data = {
+            "jsonrpc": "2.0",
+            "id": "beep",
+            "method": "aria2." + method,
+            "params": ["token:" + self.secret] + list(params)
+        }
+        res = self.session.post(self.url, data=json.dumps(data)).json()
+        if "error" in res:
+            raise Aria2Error(res["error"]["message"])
+        return res["result"]
+
+    def shutdown(self):
+        try:
+            self.call("shutdown")
+        except (requests.ConnectionError, Aria2Error):
+            pass
+        try:
+            self.process.wait(10)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+
+
+def _probe(session, url, path, cookies, validator=None):
+    # a 1 byte request tells whether the session is still valid, whether the
+    # file changed since the last download, its real name and its size, aria2
+    # would follow the redirect to the login page instead. Returns the path,
+    # the size, None if unknown, and the headers of the response
+    session.cookies = cookies
+    headers = {"Range": "bytes=0-0"}
+    headers.update(_conditional_headers(validator))
+    with session.get(url, headers=headers, stream=True,
+                     allow_redirects=False) as res:
+        if res.status_code == 304:
+            raise NotModified()
+        if res.status_code >= 300 and res.status_code <= 399:
+            raise LoginFailed()
+        if res.status_code >= 400 and res.status_code <= 499:
+            raise Unauthorized()
+        size = None
+        if res.status_code == 206:
+            res.content
+            match = re.match(r"bytes \d+-\d+/(\d+)",
+                             res.headers.get("Content-Range", ""))
+            if match:
+                size = int(match.group(1))
+        elif res.headers.get("Content-Length", "").isdigit():
+            size = int(res.headers["Content-Length"])
+        return _file_path(path, res.headers), size, res.headers
+
+
+def aria2_parallel_downloader(username, password, to_download, parallel,
+                              overwrite, manifest, session_lifetime=None,
+                              max_rate=None):
+    ui = DownloadUI(0)
+    login = LoginManager(username, password, session_lifetime, ui)
+    events = queue.Queue()
+    local = threading.local()
+    aria2 = Aria2(parallel, max_rate)
+    probes = ThreadPoolExecutor(parallel)
+    # gid -> [item, path, completed bytes, expected size, login generation,
+    # validator]
+    active = dict()
+    attempts = dict()
+    # the items are probed and given to aria2 just in time, at most parallel
+    # at once: the cookies of the items queued in aria2 would expire. Each
+    # one takes a slot of the board until it leaves
+    waiting = collections.deque()
+    slots = dict()
+    free_slots = list(reversed(range(parallel)))
+    # the slot of the files settled without a transfer
+    own_slot = parallel
+    pending = 0
+    fed = False
+
+    def probe(item):
+        if not hasattr(local, "session"):
+            local.session = timing.instrument(requests.Session(),
+                                              "download")
+        generation, cookies = login.get()
+        if not cookies:
+            events.put(("login_failed", item, None))
+            return
+        validator = manifest.validator(item.fileEntryId)
+        try:
+            path, size, headers = _probe(local.session, item.url, item.path,
+                                         cookies, validator)
+            if size is None:
+                # a login page saved by aria2 in place of the file could not
+                # be told apart by its size, the file is downloaded here
+                validator = _do_download(item.url, item.path, local.session,
+                                         ui, validator)
+                events.put(("downloaded", item, validator))
+                return
+            events.put(("probed", item,
+                        (path, size, cookies, generation,
+                         _validator(path, headers, size))))
+        except NotModified:
+            events.put(("not_modified", item, validator))
+        except LoginFailed:
+            login.expired(generation)
+            events.put(("failed", item, "Session expired"))
+        except Unauthorized:
+            events.put(("forbidden", item, None))
+        except Exception as e:
+            events.put(("failed", item, str(e)))
+
+    def feeder():
+        # to_download may be a generator that yields while the structure is
+        # being crawled
+        for item in to_download:
+            events.put(("new", item, None))
+        events.put(("fed", None, None))
+
+    def feed():
+        while free_slots and waiting:
+            item = waiting.popleft()
+            slots[item] = free_slots.pop()
+            ui.start_download(slots[item], item.path)
+            manifest.started(item)
+            probes.submit(probe, item)
+
+    def release(item):
+        slot = slots.pop(item)
+        free_slots.append(slot)
+        return slot
+
+    def finish(item):
+        # the item leaves its slot for good, returns the slot
+        nonlocal pending
+        pending -= 1
+        return release(item)
+
+    def retry(item, path, reason):
+        nonlocal pending
+        attempts[item] = attempts.get(item, 0) + 1
+        give_up = attempts[item] > MAX_RETRIES or login.failed
+        ui.fail_download(release(item), reason, path, done=give_up)
+        if give_up:
+            pending -= 1
+        else:
+            waiting.append(item)
+
+    def handle_event(kind, item, data):
+        nonlocal pending, fed
+        if kind == "fed":
+            fed = True
+        elif kind == "new":
+            ui.add_files(1)
+            if not overwrite and os.path.exists(item.path):
+                ui.start_download(own_slot, item.path)
+                manifest.done(item)
+                ui.done_download(own_slot, item.path, skipped=True)
+            else:
+                pending += 1
+                waiting.append(item)
+        elif kind == "probed":
+            path, size, cookies, generation, validator = data
+            options = dict(ARIA2_OPTIONS)
+            options["dir"] = os.path.dirname(path)
+            options["out"] = os.path.basename(path)
+            options["header"] = [
+                "Cookie: " + "; ".join("%s=%s" % (c.name, c.value)
+                                       for c in cookies)
+            ]
+            os.makedirs(options["dir"], exist_ok=True)
+            gid = aria2.call("addUri", [item.url], options)
+            active[gid] = [item, path, 0, size, generation, validator]
+        elif kind == "downloaded":
+            manifest.done(item, data)
+            ui.done_download(finish(item), data["path"])
+        elif kind == "not_modified":
+            manifest.done(item, data)
+            ui.done_download(finish(item), item.path, skipped=True)
+        elif kind == "forbidden":
+            ui.fail_download(finish(item), "Unauthorized", item.path,
+                             done=True)
+            manifest.forbidden(item.fileEntryId)
+        elif kind == "login_failed":
+            ui.fail_download(finish(item), "Login failed", item.path,
+                             done=True)
+        elif kind == "failed":
+            retry(item, item.path, "Download failed: %s" % data)
+
+    def poll():
+        for status in aria2.call("tellActive", ["gid", "completedLength"]):
+            entry = active.get(status["gid"])
+            if entry is None:
+                continue
+            completed = int(status["completedLength"])
+            ui.add_download(completed - entry[2])
+            entry[2] = completed
+        stopped = aria2.call("tellStopped", 0, 1000,
+                             ["gid", "status", "errorCode", "completedLength"])
+        for status in stopped:
+            entry = active.pop(status["gid"], None)
+            aria2.call("removeDownloadResult", status["gid"])
+            if entry is None:
+                continue
+            item, path, completed, size, generation, validator = entry
+            ui.add_download(int(status["completedLength"]) - completed)
+            code = status.get("errorCode", "0")
+            if status["status"] == "complete" and \
+                    os.path.getsize(path) != size:
+                # aria2 followed a redirect to the login page and saved it
+                os.remove(path)
+                login.expired(generation)
+                retry(item, path, "Session expired")
+            elif status["status"] == "complete":
+                manifest.done(item, validator)
+                ui.done_download(finish(item), path)
+            elif code in ARIA2_FORBIDDEN_ERRORS:
+                ui.fail_download(finish(item), "Unauthorized", path,
+                                 done=True)
+                manifest.forbidden(item.fileEntryId)
+            elif code in ARIA2_LOGIN_ERRORS:
+                login.expired(generation)
+                retry(item, path, "Session expired")
+            else:
+                retry(item, path, "aria2 error %s" % code)
+
+    feeder_thread = threading.Thread(target=feeder, daemon=True)
+    feeder_thread.start()
+    login.start()
+    try:
+        while not fed or pending > 0:
+            try:
+                handle_event(*events.get(timeout=POLL_INTERVAL))
+                while not events.empty():
+                    handle_event(*events.get())
+            except queue.Empty:
+                pass
+            poll()
+            feed()
+            ui.snapshot()
+    finally:
+        login.stop()
+        probes.shutdown()
+        aria2.shutdown()
+    ui.done()
+
+
+def aria2_available():
+    return shutil.which("aria2c") is not None
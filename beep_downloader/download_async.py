@@ -0,0 +1,275 @@
+#!/usr/bin/env python3
+
+import asyncio
+import aiohttp
+import functools
+import os.path
+import time
+import traceback
+
+from beep_downloader import timing
+from beep_downloader.login import LoginManager
+from beep_downloader.download import CHUNK_SIZE, PART_SUFFIX, LoginFailed, \
+    Unauthorized, IncompleteDownload, NotModified, ServerBusy, _file_path, \
+    _conditional_headers, _validator, _check_status
+from beep_downloader.dedup import new_hash, share_content
+from beep_downloader.schedule import Schedule, AsyncScheduledQueue
+from beep_downloader.download_ui import DownloadUI
+from beep_downloader.download_control import Backoff, RateLimiter
+
+# seconds to connect and between two reads of a response
+CONNECT_TIMEOUT = 30
+READ_TIMEOUT = 60
+# bytes received before writing them, the files are written by the threads of
+# the default executor to keep the disk out of the event loop
+WRITE_BUFFER = 1024 * 1024
+
+
+class LoginGate:
+    # asyncio front of a LoginManager, the downloaders wait for the login on
+    # the gate without blocking the event loop
+    def __init__(self, login):
+        self.login = login
+        self.generation = None
+        self.header = None
+        self.lock = asyncio.Lock()
+
+    @property
+    def failed(self):
+        return self.login.failed
+
+    async def get(self):
+        generation, cookies = self.login.current()
+        if cookies is None and not self.login.failed:
+            async with self.lock:
+                loop = asyncio.get_event_loop()
+                generation, cookies = await loop.run_in_executor(
+                    None, self.login.get)
+        if generation != self.generation and cookies:
+            self.header = "; ".join("%s=%s" % (c.name, c.value)
+                                    for c in cookies)
+            self.generation = generation
+        return generation, self.header
+
+    def expired(self, generation):
+        self.login.expired(generation)
+
+
+def _write_chunks(f, hasher, chunks):
+    for chunk in chunks:
+        f.write(chunk)
+        hasher.update(chunk)
+
+
+async def _do_download(session,
+                       url,
+                       path,
+                       cookies,
+                       ui,
+                       validator=None,
+                       limiter=None):
+    headers = {"Accept-Encoding": "identity", "Cookie": cookies}
+    headers.update(_conditional_headers(validator))
+    loop = asyncio.get_event_loop()
+    started = time.monotonic()
+    async with session.get(url, headers=headers,
+                           allow_redirects=False) as res:
+        timing.request("download", "GET", url, res.status,
+                       time.monotonic() - started, res.content_length or 0)
+        if res.status == 304:
+            raise NotModified()
+        _check_status(res.status, res.headers)
+        part_path = path + PART_SUFFIX
+        path = _file_path(path, res.headers)
+        await loop.run_in_executor(
+            None,
+            functools.partial(os.makedirs,
+                              os.path.dirname(path),
+                              exist_ok=True))
+        size = 0
+        hasher = new_hash()
+        f = await loop.run_in_executor(None, open, part_path, "wb")
+        try:
+            chunks = []
+            buffered = 0
+            async for chunk in res.content.iter_chunked(CHUNK_SIZE):
+                ui.add_download(len(chunk))
+                chunks.append(chunk)
+                buffered += len(chunk)
+                size += len(chunk)
+                if buffered >= WRITE_BUFFER:
+                    await loop.run_in_executor(None, _write_chunks, f, hasher,
+                                               chunks)
+                    chunks = []
+                    buffered = 0
+                if limiter is not None:
+                    delay = limiter.wait_time(len(chunk))
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+            await loop.run_in_executor(None, _write_chunks, f, hasher, chunks)
+        finally:
+            await loop.run_in_executor(None, f.close)
+        if res.content_length is not None and size != res.content_length:
+            await loop.run_in_executor(None, os.remove, part_path)
+            raise IncompleteDownload("Connection closed early")
+    await loop.run_in_executor(None, os.replace, part_path, path)
+    timing.file(path, size, time.monotonic() - started)
+    validator = _validator(path, res.headers, size)
+    validator["hash"] = hasher.hexdigest()
+    return validator
+
+
+async def _downloader(username, password, to_download, parallel, overwrite,
+                      manifest, session_lifetime, max_rate, dedup, schedule,
+                      fair):
+    loop = asyncio.get_event_loop()
+    todo = AsyncScheduledQueue(Schedule(schedule, fair))
+    ui = DownloadUI(0)
+    login = LoginManager(username, password, session_lifetime, ui)
+    gate = LoginGate(login)
+    backoff = Backoff()
+    limiter = RateLimiter(max_rate) if max_rate else None
+    # item -> login generation of its last redirect to the login page
+    redirects = dict()
+
+    def retry(num, item, path, reason, retry_after=None):
+        # puts the item back in the queue after its backoff, returns whether
+        # it did: the requeue takes the place of the task_done
+        delay = backoff.delay(item, retry_after)
+        if delay is None:
+            redirects.pop(item, None)
+            ui.fail_download(num, reason + ", giving up", path, done=True)
+            return False
+        ui.fail_download(num, reason, path)
+        todo.requeue_later(item, delay)
+        return True
+    done = asyncio.Event()
+
+    async def download_task(session, num):
+        while True:
+            item = await todo.get()
+            if item is None:
+                todo.task_done()
+                break
+            path = item.path
+            requeued = False
+            try:
+                generation, cookies = await gate.get()
+                if gate.failed:
+                    continue
+                ui.start_download(num, path)
+                if overwrite or not os.path.exists(path):
+                    validator = manifest.validator(item.fileEntryId)
+                    manifest.started(item)
+                    validator = await _do_download(session, item.url, path,
+                                                   cookies, ui, validator,
+                                                   limiter)
+                    linked = dedup and share_content(manifest, validator,
+                                                     dedup)
+                    manifest.done(item, validator)
+                    ui.done_download(num, path, linked=linked)
+                else:
+                    manifest.done(item)
+                    ui.done_download(num, path, skipped=True)
+            except NotModified:
+                manifest.done(item, validator)
+                ui.done_download(num, path, skipped=True)
+            except Unauthorized:
+                ui.fail_download(num, "Unauthorized", path, done=True)
+                manifest.forbidden(item.fileEntryId)
+            except LoginFailed:
+                if redirects.get(item, generation) < generation:
+                    # redirected again with the cookies of a newer login,
+                    # the file is broken rather than the session
+                    redirects.pop(item)
+                    requeued = retry(num, item, path,
+                                     "Redirected after login")
+                else:
+                    redirects[item] = generation
+                    ui.fail_download(num, "Session expired", path)
+                    gate.expired(generation)
+                    todo.put_nowait(item)
+            except ServerBusy as e:
+                requeued = retry(num, item, path, "Server busy",
+                                 e.retry_after)
+            except Exception:
+                traceback.print_exc()
+                requeued = retry(num, item, path, "Download failed")
+            else:
+                backoff.forget(item)
+                redirects.pop(item, None)
+            finally:
+                if not requeued:
+                    todo.task_done()
+
+    async def printer_task():
+        while not done.is_set():
+            ui.snapshot()
+            try:
+                await asyncio.wait_for(done.wait(), 2)
+            except asyncio.TimeoutError:
+                pass
+
+    async def feed():
+        # to_download may be a generator that blocks while the structure is
+        # being crawled, it's consumed from a worker thread
+        items = iter(to_download)
+        while not gate.failed:
+            if isinstance(to_download, (list, tuple)):
+                item = next(items, None)
+            else:
+                item = await loop.run_in_executor(None, next, items, None)
+            if item is None:
+                break
+            ui.add_files(1)
+            todo.put_nowait(item)
+
+    connector = aiohttp.TCPConnector(limit=parallel)
+    # no limit on a whole transfer, a big file takes its time, but a stalled
+    # connection fails and is retried
+    timeout = aiohttp.ClientTimeout(total=None,
+                                    sock_connect=CONNECT_TIMEOUT,
+                                    sock_read=READ_TIMEOUT)
+    async with aiohttp.ClientSession(
+            connector=connector,
+            cookie_jar=aiohttp.DummyCookieJar(),
+            timeout=timeout) as session:
+        tasks = [
+            asyncio.ensure_future(download_task(session, num))
+            for num in range(parallel)
+        ]
+        printer = asyncio.ensure_future(printer_task())
+        login.start()
+        try:
+            await feed()
+            await todo.join()
+            for _ in range(parallel):
+                todo.put_nowait(None)
+            await asyncio.gather(*tasks)
+        finally:
+            login.stop()
+        done.set()
+        await printer
+    ui.done()
+
+
+def asyncio_parallel_downloader(username,
+                                password,
+                                to_download,
+                                parallel,
+                                overwrite,
+                                manifest,
+                                session_lifetime=None,
+                                max_rate=None,
+                                dedup=None,
+                                schedule="crawl",
+                                fair=False):
+    loop = asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    try:
+        return loop.run_until_complete(
+            _downloader(username, password, to_download, parallel, overwrite,
+                        manifest, session_lifetime, max_rate, dedup,
+                        schedule, fair))
+    finally:
+        loop.close()
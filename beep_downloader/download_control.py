@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+
+import random
+import threading
+import time
+
+# retries of a failed file before giving up, and the bounds of the
+# exponential backoff between them
+MAX_RETRIES = 5
+BACKOFF_BASE = 1
+BACKOFF_MAX = 60
+# relative throughput gain that justifies one more concurrent transfer
+MIN_GAIN = 0.05
+# the best throughput seen is slowly forgotten so that the controller probes
+# again for more transfers when the conditions change
+BEST_DECAY = 0.95
+
+
+class Backoff:
+    # exponential backoff with jitter of the failed items, with a cap on the
+    # number of retries
+    def __init__(self,
+                 max_retries=MAX_RETRIES,
+                 base=BACKOFF_BASE,
+                 cap=BACKOFF_MAX):
+        self.max_retries = max_retries
+        self.base = base
+        self.cap = cap
+        self.attempts = dict()
+        self.lock = threading.Lock()
+
+    def delay(self, item, retry_after=None):
+        # seconds to wait before retrying the item, None if it failed too
+        # many times
+        with self.lock:
+            attempts = self.attempts.get(item, 0) + 1
+            self.attempts[item] = attempts
+        if attempts > self.max_retries:
+            return None
+        delay = min(self.cap, self.base * 2**(attempts - 1))
+        delay *= random.uniform(0.5, 1)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.cap))
+        return delay
+
+    def forget(self, item):
+        with self.lock:
+            self.attempts.pop(item, None)
+
+
+class RateLimiter:
+    # token bucket shared by all the transfers, rate is in bytes per second
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def wait_time(self, size):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate,
+                              self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= size
+            if self.tokens >= 0:
+                return 0
+            return -self.tokens / self.rate
+
+    def consume(self, size):
+        delay = self.wait_time(size)
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ConcurrencyController:
+    # limits the number of active transfers. When adaptive the limit moves
+    # between 1 and max_active: it's halved when the server is overloaded or
+    # the transfers fail, it grows by one while the throughput improves and
+    # steps back when the last increase did not help
+    def __init__(self, max_active, adaptive=False):
+        self.max_active = max_active
+        self.adaptive = adaptive
+        self.limit = max(1, max_active // 2) if adaptive else max_active
+        self.active = 0
+        self.errors = 0
+        self.best_rate = 0
+        self.best_limit = self.limit
+        self.cv = threading.Condition()
+
+    def acquire(self):
+        with self.cv:
+            while self.active >= self.limit:
+                self.cv.wait()
+            self.active += 1
+
+    def release(self):
+        with self.cv:
+            self.active -= 1
+            self.cv.notify()
+
+    def error(self):
+        with self.cv:
+            self.errors += 1
+
+    def update(self, rate):
+        # called periodically with the throughput of the last interval
+        if not self.adaptive:
+            return
+        with self.cv:
+            if self.errors:
+                self.limit = max(1, self.limit // 2)
+                self.best_rate = 0
+                self.best_limit = self.limit
+                self.errors = 0
+            elif rate > self.best_rate * (1 + MIN_GAIN):
+                self.best_rate = rate
+                self.best_limit = self.limit
+                self.limit = min(self.max_active, self.limit + 1)
+            elif self.limit > self.best_limit:
+                self.limit = self.best_limit
+            self.best_rate *= BEST_DECAY
+            self.cv.notify_all()
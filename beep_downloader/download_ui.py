@@ -1,70 +1,246 @@
 #!/usr/bin/env python3
 
+import collections
 import math
+import shutil
+import sys
+import threading
 import time
 from colorama import init, Fore, Style
 
 from beep_downloader.utils import format_size
 
+# the downloaders only update counters, the screen is redrawn at this rate
+RENDER_INTERVAL = 0.25
+# without a terminal a status line is logged this often
+LOG_STATUS_INTERVAL = 10
+BOARD = "board"
+LOG = "log"
+QUIET = "quiet"
+
+progress_mode = None
+
+
+def set_progress(mode):
+    # board, log or quiet, None chooses board on a terminal and log otherwise
+    global progress_mode
+    progress_mode = mode
+
 
 def thread_print(*args, end="\n"):
     print(" ".join(map(str, args)) + end, end="")
 
 
+class Counters:
+    # counters of a single thread, only that thread writes them so they need
+    # no lock. The renderer sums the counters of all the threads
+    def __init__(self):
+        self.files = 0
+        self.started = 0
+        self.stopped = 0
+        self.finished = 0
+        self.skipped = 0
+        self.linked = 0
+        self.failed = 0
+        self.downloaded = 0
+
+
 class DownloadUI:
     def __init__(self, num_files):
-        self.num_files = num_files
-        self.todo = num_files
-        self.doing = 0
-        self.silent = False
-        self.digits = int(math.log10(num_files or 1))+1
-        self.downloaded = 0
+        self.mode = progress_mode
+        if self.mode is None:
+            self.mode = BOARD if sys.stdout.isatty() else LOG
+        self.local = threading.local()
+        self.slots = []
+        self.lock = threading.Lock()
+        self.counters.files += num_files
+        # worker -> (path, start time), None when idle
+        self.board = dict()
+        # (color, worker, message, path) to print, appended by any thread
+        self.events = collections.deque()
+        self.board_lines = 0
+        self.paused = False
+        self.started = time.monotonic()
         self.current_speed = 0
         self.last_snapshot = None
+        self.last_downloaded = 0
+        self.last_status = self.started
+        self.stopping = threading.Event()
+        self.renderer = threading.Thread(target=self._render_loop,
+                                         daemon=True)
+        self.renderer.start()
+
+    @property
+    def counters(self):
+        counters = getattr(self.local, "counters", None)
+        if counters is None:
+            counters = self.local.counters = Counters()
+            with self.lock:
+                self.slots.append(counters)
+        return counters
+
+    def _total(self, name):
+        return sum(getattr(counters, name) for counters in list(self.slots))
+
+    @property
+    def silent(self):
+        return self.paused
+
+    @silent.setter
+    def silent(self, silent):
+        # the login prints its own messages, the board is cleared first
+        with self.lock:
+            if silent and not self.paused:
+                self._clear_board()
+            self.paused = silent
+
+    def add_files(self, num_files):
+        self.counters.files += num_files
 
     def start_download(self, thread, path):
-        thread_print(
-            "{}[Downloader{:2}] Downloading | {}".format(Fore.YELLOW, thread, path))
-        self.doing += 1
-        self.print_status()
-
-    def done_download(self, thread, path, skipped=False):
-        skipped = " [skipped]" if skipped else ""
-        thread_print(
-            "{}[Downloader{:2}] Downloaded  | {} {}".format(Fore.GREEN, thread, path, skipped))
-        self.doing -= 1
-        self.todo -= 1
-        self.print_status()
+        self.counters.started += 1
+        self.board[thread] = (path, time.monotonic())
+
+    def done_download(self, thread, path, skipped=False, linked=False):
+        counters = self.counters
+        counters.stopped += 1
+        counters.finished += 1
+        if skipped:
+            counters.skipped += 1
+        elif linked:
+            counters.linked += 1
+        self.board[thread] = None
+        if self.mode == LOG:
+            tag = " [skipped]" if skipped else " [linked]" if linked else ""
+            self.events.append((Fore.GREEN, thread, "Downloaded ", path + tag))
+
+    def done_segment(self, thread, path):
+        self.counters.stopped += 1
+        self.board[thread] = None
 
     def fail_download(self, thread, reason, path, done=False):
-        thread_print(
-            "{}[Downloader{:2}]   Failed    | {} | {}".format(Fore.RED, thread, reason, path))
-        self.doing -= 1
+        counters = self.counters
+        counters.stopped += 1
         if done:
-            self.todo -= 1
-        self.print_status()
+            counters.finished += 1
+            counters.failed += 1
+        self.board[thread] = None
+        self.events.append(
+            (Fore.RED, thread, "  Failed   ", "%s | %s" % (reason, path)))
 
-    def print_status(self):
-        if self.silent:
-            return
-        done = self.num_files - self.todo
-        perc = done / self.num_files * 100
-        thread_print(
-            "\r[{:{digits}} / {}] ({:5.2f}%) CN:{} -- {}/s   \r".format(done, self.num_files, perc, self.doing, format_size(self.current_speed), digits=self.digits), end="")
-
-    def done(self):
-        thread_print(" " * 80, end="\r")
+    def add_download(self, size):
+        self.counters.downloaded += size
 
     def snapshot(self):
+        # measures the speed since the previous snapshot
         now = time.monotonic()
-        if self.last_snapshot is None:
-            self.last_snapshot = now
-            self.downloaded = 0
-            return
-        delta = now - self.last_snapshot
-        self.current_speed = self.downloaded / delta
+        downloaded = self._total("downloaded")
+        if self.last_snapshot is not None:
+            delta = now - self.last_snapshot
+            if delta > 0:
+                self.current_speed = (downloaded - self.last_downloaded) / \
+                    delta
         self.last_snapshot = now
-        self.downloaded = 0
+        self.last_downloaded = downloaded
 
-    def add_download(self, size):
-        self.downloaded += size
+    def status(self):
+        num_files = self._total("files")
+        done = self._total("finished")
+        doing = self._total("started") - self._total("stopped")
+        digits = int(math.log10(num_files or 1)) + 1
+        perc = done / (num_files or 1) * 100
+        return "[{:{digits}} / {}] ({:5.2f}%) CN:{} -- {}/s".format(
+            done,
+            num_files,
+            perc,
+            doing,
+            format_size(self.current_speed),
+            digits=digits)
+
+    def print_status(self):
+        with self.lock:
+            self._render()
+
+    def _render_loop(self):
+        while not self.stopping.wait(RENDER_INTERVAL):
+            with self.lock:
+                self._render()
+
+    def _event_lines(self):
+        lines = []
+        while self.events:
+            color, thread, message, path = self.events.popleft()
+            lines.append("{}[Downloader{:2}] {} | {}{}".format(
+                color, thread, message, path, Style.RESET_ALL))
+        return lines
+
+    def _render(self):
+        if self.paused:
+            return
+        lines = self._event_lines()
+        if self.mode == BOARD:
+            self._draw_board(lines)
+            return
+        for line in lines:
+            if self.mode == LOG or line.startswith(Fore.RED):
+                thread_print(line)
+        now = time.monotonic()
+        if self.mode == LOG and now - self.last_status >= LOG_STATUS_INTERVAL:
+            self.last_status = now
+            thread_print(self.status())
+
+    def _board_lines(self, width, height):
+        now = time.monotonic()
+        active = sorted((thread, entry)
+                        for thread, entry in list(self.board.items())
+                        if entry is not None)
+        lines = []
+        for thread, (path, since) in active[:max(1, height - 3)]:
+            elapsed = int(now - since)
+            line = "[Downloader{:2}] {:02}:{:02} | {}".format(
+                thread, elapsed // 60, elapsed % 60, path)
+            lines.append(Fore.YELLOW + line[:width - 1] + Style.RESET_ALL)
+        if len(active) > len(lines):
+            lines.append("  ... and %d more" % (len(active) - len(lines)))
+        lines.append(Style.BRIGHT + self.status()[:width - 1] +
+                     Style.RESET_ALL)
+        return lines
+
+    def _clear_board(self):
+        if self.mode == BOARD and self.board_lines:
+            sys.stdout.write("\x1b[%dA\r\x1b[J" % self.board_lines)
+            sys.stdout.flush()
+            self.board_lines = 0
+
+    def _draw_board(self, events):
+        # the events scroll above the board, that is drawn again in place
+        width, height = shutil.get_terminal_size()
+        out = []
+        if self.board_lines:
+            out.append("\x1b[%dA\r" % self.board_lines)
+        for line in events:
+            out.append(line + "\x1b[K\n")
+        board = self._board_lines(width, height)
+        for line in board:
+            out.append(line + "\x1b[K\n")
+        out.append("\x1b[J")
+        self.board_lines = len(board)
+        sys.stdout.write("".join(out))
+        sys.stdout.flush()
+
+    def done(self):
+        self.stopping.set()
+        self.renderer.join()
+        self.snapshot()
+        with self.lock:
+            self._render()
+            self._clear_board()
+        elapsed = time.monotonic() - self.started
+        downloaded = self._total("downloaded")
+        print(Style.BRIGHT + Fore.LIGHTCYAN_EX +
+              "Downloaded %d files (%d skipped, %d linked, %d failed), %s "
+              "in %.1fs (%s/s)" %
+              (self._total("finished") - self._total("failed"),
+               self._total("skipped"), self._total("linked"),
+               self._total("failed"), format_size(downloaded), elapsed,
+               format_size(downloaded / (elapsed or 1))))
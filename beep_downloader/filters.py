@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+
+import json
+import os.path
+import re
+from collections import namedtuple
+
+# path of a folder from the root of its course and whether its files are
+# kept: the folders above an included one are crawled only to reach it
+Scope = namedtuple("Scope", ["path", "inside"])
+
+
+def _glob(pattern):
+    # regex of a glob, * and ? do not match the / between the folders
+    out = []
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        i += 1
+        if c == "*":
+            out.append("[^/]*")
+        elif c == "?":
+            out.append("[^/]")
+        elif c == "[":
+            end = pattern.find("]", i + 1)
+            if end < 0:
+                out.append("\\[")
+                continue
+            body = pattern[i:end].replace("\\", "\\\\")
+            if body.startswith("!"):
+                body = "^" + body[1:]
+            out.append("[%s]" % body)
+            i = end + 1
+        else:
+            out.append(re.escape(c))
+    return "".join(out)
+
+
+def _compile(regexes):
+    # the rules are joined in a single regex, matched once per name instead
+    # of once per rule
+    if not regexes:
+        return None
+    return re.compile("|".join("(?:%s)" % regex for regex in regexes),
+                      re.IGNORECASE)
+
+
+def _matches(regex, text):
+    return regex is not None and regex.fullmatch(text) is not None
+
+
+class CourseRules:
+    # a course is matched by its groupId or by a glob of its name
+    def __init__(self, patterns):
+        self.ids = {int(p) for p in patterns if p.isdigit()}
+        self.names = _compile([_glob(p) for p in patterns if not p.isdigit()])
+        self.empty = not patterns
+
+    def match(self, groupId, name):
+        return int(groupId) in self.ids or _matches(self.names, name)
+
+
+class FolderRules:
+    # like in .gitignore, a glob without / matches the name of a folder at
+    # any depth and a glob with / matches the path from the root of the
+    # course
+    def __init__(self, patterns):
+        names = [p for p in patterns if "/" not in p.strip("/")]
+        paths = [p.strip("/") for p in patterns if "/" in p.strip("/")]
+        self.names = _compile([_glob(p) for p in names])
+        self.paths = _compile([_glob(p) for p in paths])
+        # the folders that may contain a path, they are crawled to reach it
+        prefixes = []
+        for path in paths:
+            parts = [_glob(part) for part in path.split("/")]
+            prefixes.extend("/".join(parts[:n]) for n in range(1, len(parts)))
+        self.prefixes = _compile(prefixes)
+        self.anywhere = bool(names)
+        self.empty = not patterns
+
+    def match(self, name, path):
+        return _matches(self.names, name) or _matches(self.paths, path)
+
+    def may_contain(self, path):
+        return self.anywhere or _matches(self.prefixes, path)
+
+
+def _extensions(extensions):
+    return frozenset(e.strip().lstrip(".").lower() for e in extensions
+                     if e.strip())
+
+
+class CrawlFilter:
+    # include and exclude rules applied while crawling, the excluded courses
+    # and folders are never requested
+    def __init__(self,
+                 include_courses=(),
+                 exclude_courses=(),
+                 include_folders=(),
+                 exclude_folders=(),
+                 include_extensions=(),
+                 exclude_extensions=(),
+                 max_size=None):
+        self.include_courses = CourseRules(include_courses)
+        self.exclude_courses = CourseRules(exclude_courses)
+        self.include_folders = FolderRules(include_folders)
+        self.exclude_folders = FolderRules(exclude_folders)
+        self.include_extensions = _extensions(include_extensions)
+        self.exclude_extensions = _extensions(exclude_extensions)
+        self.max_size = max_size
+        self.filter_files = bool(self.include_extensions
+                                 or self.exclude_extensions
+                                 or max_size is not None)
+        # saved with the crawled courses, the courses crawled with other
+        # rules are not reused by the crawl cache
+        rules = [
+            sorted(include_courses),
+            sorted(exclude_courses),
+            sorted(include_folders),
+            sorted(exclude_folders),
+            sorted(self.include_extensions),
+            sorted(self.exclude_extensions), max_size
+        ]
+        self.signature = json.dumps(rules) if any(rules) else None
+
+    def site(self, groupId, name):
+        # the scope of the root of a course, None if it's excluded
+        if not self.include_courses.empty and \
+                not self.include_courses.match(groupId, name):
+            return None
+        if self.exclude_courses.match(groupId, name):
+            return None
+        return Scope("", self.include_folders.empty)
+
+    def folder(self, scope, name):
+        # the scope of a subfolder, None if it's not to be crawled
+        path = scope.path + "/" + name if scope.path else name
+        if self.exclude_folders.match(name, path):
+            return None
+        if scope.inside or self.include_folders.match(name, path):
+            return Scope(path, True)
+        if self.include_folders.may_contain(path):
+            return Scope(path, False)
+        return None
+
+    def files(self, scope, files):
+        if not scope.inside:
+            return []
+        if not self.filter_files:
+            return files
+        return [f for f in files if self._keep_file(f)]
+
+    def _keep_file(self, f):
+        if self.max_size is not None and f.size > self.max_size:
+            return False
+        # the scraper does not know the extensions, the title may have one
+        extension = (f.extension
+                     or os.path.splitext(f.title)[1][1:]).lower()
+        if not extension:
+            return True
+        if self.include_extensions and \
+                extension not in self.include_extensions:
+            return False
+        return extension not in self.exclude_extensions
+
+    def prune(self, folder, scope):
+        # a copy of a crawled folder without the excluded parts
+        pruned = {
+            key: value
+            for key, value in folder.items() if key not in ("files", "folders")
+        }
+        pruned["files"] = self.files(scope, folder["files"])
+        pruned["folders"] = dict()
+        for folderId, subfolder in folder["folders"].items():
+            subscope = self.folder(scope, subfolder["name"])
+            if subscope is not None:
+                pruned["folders"][folderId] = self.prune(subfolder, subscope)
+        return pruned
+
+    def prune_sites(self, sites):
+        pruned = dict()
+        for groupId, site in sites.items():
+            scope = self.site(groupId, site["name"])
+            if scope is not None:
+                pruned[groupId] = self.prune(site, scope)
+        return pruned
@@ -1,45 +1,316 @@
 #!/usr/bin/env python3
 
+import json
+import os
+import os.path
 import re
 import requests
+import threading
+import time
 from html import unescape
 from bs4 import BeautifulSoup
 from colorama import Fore
 
-BEEP_LOGIN_URL = "https://aunicalogin.polimi.it/aunicalogin/aunicalogin/controller/IdentificazioneUnica.do?&jaf_currentWFID=main&polij_step=0&__pj0=0&__pj1=5d4116fc58f397506f8c792adf1b1270"
+from beep_downloader import timing
+
+BEEP_URL = "https://beep.metid.polimi.it"
+AUNICALOGIN_URL = "https://aunicalogin.polimi.it"
+BEEP_LOGIN_URL = AUNICALOGIN_URL + "/aunicalogin/aunicalogin/controller/IdentificazioneUnica.do?&jaf_currentWFID=main&polij_step=0&__pj0=0&__pj1=5d4116fc58f397506f8c792adf1b1270"
+BEEP_HOME_URL = BEEP_URL + "/polimi/login"
+BEEP_SSO_URL = BEEP_URL + "/Shibboleth.sso/SAML2/POST"
+# only the pages of a logged in user have the logout link
+LOGGED_IN_MARKER = b"/c/portal/logout"
+SESSION_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME")
+    or os.path.join(os.path.expanduser("~"), ".cache"), "beep-downloader",
+    "sessions.json")
+
+
+# fraction of the session lifetime after which the cookies are refreshed,
+# earlier if the login takes longer than the rest of the lifetime
+REFRESH_AT = 0.8
+# seconds before retrying a failed refresh
+REFRESH_RETRY = 30
+# the cookies are never refreshed sooner than this many seconds, or this
+# many logins, after the previous login
+MIN_REFRESH_INTERVAL = 60
+MIN_REFRESH_LOGINS = 4
 
 
 login_cache = dict()
+session_cache_path = SESSION_CACHE_PATH
+
+
+def set_session_cache(path):
+    # None disables the cookies saved on disk
+    global session_cache_path
+    session_cache_path = path
+
+
+def _read_sessions():
+    if session_cache_path is None or not os.path.exists(session_cache_path):
+        return dict()
+    with open(session_cache_path, "r") as f:
+        try:
+            return json.loads(f.read())
+        except ValueError:
+            return dict()
+
+
+def _write_sessions(sessions):
+    # the file holds valid session cookies, only the user can read it
+    directory = os.path.dirname(session_cache_path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    tmp_path = session_cache_path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as f:
+        f.write(json.dumps(sessions))
+    os.replace(tmp_path, session_cache_path)
+
+
+def load_session(username):
+    session = _read_sessions().get(username)
+    if session is None:
+        return None
+    jar = requests.cookies.RequestsCookieJar()
+    for cookie in session["cookies"]:
+        jar.set(cookie["name"],
+                cookie["value"],
+                domain=cookie["domain"],
+                path=cookie["path"],
+                expires=cookie["expires"],
+                secure=cookie["secure"])
+    return jar
+
+
+def save_session(username, cookies):
+    if session_cache_path is None:
+        return
+    sessions = _read_sessions()
+    sessions[username] = {
+        "savedAt": time.time(),
+        "cookies": [{
+            "name": c.name,
+            "value": c.value,
+            "domain": c.domain,
+            "path": c.path,
+            "expires": c.expires,
+            "secure": c.secure
+        } for c in cookies]
+    }
+    _write_sessions(sessions)
+
+
+def forget_login(username):
+    # the session expired, the next login goes through the SSO again
+    login_cache.pop(username, None)
+    sessions = _read_sessions()
+    if sessions.pop(username, None) is not None:
+        _write_sessions(sessions)
+
+
+def revalidate_login(username):
+    # the cookies kept in memory by a long running process may have expired
+    # since the last use
+    cookies = login_cache.get(username)
+    if cookies is not None and not session_valid(cookies):
+        forget_login(username)
+
 
+def session_valid(cookies):
+    session = timing.instrument(requests.Session(), "login")
+    session.cookies = cookies
+    try:
+        res = session.get(BEEP_HOME_URL)
+    except requests.RequestException:
+        return False
+    return res.status_code == 200 and LOGGED_IN_MARKER in res.content
 
-def perform_beep_login(username, password):
+
+def perform_beep_login(username, password, verbose=True):
+    return beep_login(username, password, verbose)[0]
+
+
+def beep_login(username, password, verbose=True):
+    # returns the cookies and whether they come from a full SSO login, the
+    # age of the cookies reused from memory or from disk is unknown
+    log = print if verbose else lambda *args: None
     if username in login_cache:
-        return login_cache[username]
-    session = requests.Session()
-    print("    Setting up session")
-    session.get("https://beep.metid.polimi.it/polimi/login")
-    print("    Aunicalogin")
+        return login_cache[username], False
+    with timing.phase("login"):
+        return _login(username, password, log)
+
+
+def _login(username, password, log):
+    cookies = load_session(username)
+    if cookies is not None:
+        if session_valid(cookies):
+            log("    Reusing saved session")
+            login_cache[username] = cookies
+            return cookies, False
+        log("    Saved session expired")
+    session = timing.instrument(requests.Session(), "login")
+    log("    Setting up session")
+    session.get(BEEP_HOME_URL)
+    log("    Aunicalogin")
     res = session.post(BEEP_LOGIN_URL, data={
         "login": username, "password": password, "evn_conferma": ""})
 
     # search if the password is expiring
     content = BeautifulSoup(res.content.decode("latin"), 'html.parser')
     for mex in content.find_all(class_="jaf-message-fragment"):
-        print(Fore.YELLOW + "    " + mex.get_text().strip())
-        return None
+        log(Fore.YELLOW + "    " + mex.get_text().strip())
+        return None, False
 
     sso_data = {}
     for group in re.findall(r'<input type="hidden" name="([^"]+)" value="([^"]+)"\/>', res.content.decode("latin")):
         sso_data[unescape(group[0])] = unescape(group[1])
-    print("    Shibboleth SAML login")
-    session.post(
-        "https://beep.metid.polimi.it/Shibboleth.sso/SAML2/POST", data=sso_data)
-    print("    Back to beep")
-    session.get("https://beep.metid.polimi.it/polimi/login")
+    log("    Shibboleth SAML login")
+    session.post(BEEP_SSO_URL, data=sso_data)
+    log("    Back to beep")
+    session.get(BEEP_HOME_URL)
     if session.cookies.get("JSESSIONID") is None:
-        print(Fore.RED + "    Login failed!")
-        return None
-    print("    Login succesful: JSESSIONID=%s" %
+        log(Fore.RED + "    Login failed!")
+        return None, False
+    log("    Login succesful: JSESSIONID=%s" %
           session.cookies.get("JSESSIONID"))
     login_cache[username] = session.cookies
-    return session.cookies
+    save_session(username, session.cookies)
+    return session.cookies, True
+
+
+class LoginManager:
+    # shares the session cookies between many downloaders, when a session
+    # expires only one of them logs in again. With start() a background
+    # thread logs in again before the session expires and swaps the cookies
+    # while the downloaders keep using the old ones
+    def __init__(self, username, password, lifetime=None, ui=None):
+        self.username = username
+        self.password = password
+        # seconds a session lasts, learned from the first expiry if unknown
+        self.lifetime = lifetime
+        self.ui = ui
+        self.cookies = None
+        # whether the cookies come from a full SSO login of this manager,
+        # only their expiry tells the session lifetime
+        self.fresh = False
+        self.generation = 0
+        self.logged_at = None
+        # seconds taken by the last login
+        self.login_time = 0
+        self.failed = False
+        self.refreshes = 0
+        # lock protects the cookies, login_lock makes a single login run at
+        # a time
+        self.lock = threading.Lock()
+        self.login_lock = threading.Lock()
+        self.stopping = False
+        self.wakeup = threading.Event()
+        self.refresher = None
+
+    def _login(self, verbose):
+        # returns the cookies and whether they come from a full SSO login
+        start = time.monotonic()
+        cookies, fresh = beep_login(self.username, self.password, verbose)
+        if fresh:
+            self.login_time = time.monotonic() - start
+        return cookies, fresh
+
+    def _swap(self, cookies, fresh):
+        self.cookies = cookies
+        self.fresh = fresh
+        self.generation += 1
+        self.logged_at = time.monotonic()
+        self.wakeup.set()
+
+    def _refresh_deadline(self):
+        if self.cookies is None or not self.lifetime:
+            return None
+        margin = max(self.lifetime * (1 - REFRESH_AT), 2 * self.login_time)
+        interval = max(self.lifetime - margin, MIN_REFRESH_INTERVAL,
+                       MIN_REFRESH_LOGINS * self.login_time)
+        if margin >= self.lifetime or interval >= self.lifetime:
+            # the session is too short to be renewed in time without
+            # logging in all the time, the expiry falls back to get()
+            return None
+        return self.logged_at + interval
+
+    def current(self):
+        with self.lock:
+            return self.generation, self.cookies
+
+    def get(self):
+        with self.lock:
+            if self.cookies is not None or self.failed:
+                return self.generation, self.cookies
+        with self.login_lock:
+            # the login may have been done while waiting for the lock
+            with self.lock:
+                if self.cookies is not None or self.failed:
+                    return self.generation, self.cookies
+            if self.ui is not None:
+                self.ui.silent = True
+            cookies, fresh = self._login(True)
+            if self.ui is not None:
+                self.ui.silent = False
+            with self.lock:
+                if cookies:
+                    self._swap(cookies, fresh)
+                else:
+                    self.failed = True
+                return self.generation, self.cookies
+
+    def expired(self, generation):
+        with self.lock:
+            if generation != self.generation or self.cookies is None:
+                return
+            if self.lifetime is None and self.fresh:
+                self.lifetime = time.monotonic() - self.logged_at
+            forget_login(self.username)
+            self.cookies = None
+
+    def refresh(self, generation):
+        # logs in again while the current cookies are still in use
+        with self.login_lock:
+            with self.lock:
+                if generation != self.generation or self.cookies is None:
+                    return True
+                forget_login(self.username)
+            cookies, fresh = self._login(False)
+            if not cookies:
+                return False
+            with self.lock:
+                self._swap(cookies, fresh)
+                self.refreshes += 1
+            return True
+
+    def _keep_alive(self):
+        while True:
+            self.wakeup.clear()
+            with self.lock:
+                generation = self.generation
+                deadline = self._refresh_deadline()
+            timeout = None
+            if deadline is not None:
+                timeout = max(0, deadline - time.monotonic())
+            # woken up early by new cookies or by stop()
+            self.wakeup.wait(timeout)
+            if self.stopping:
+                return
+            with self.lock:
+                due = generation == self.generation and \
+                    deadline is not None and time.monotonic() >= deadline
+            if due and not self.refresh(generation):
+                # keep the old cookies, an expiry falls back to get()
+                self.wakeup.wait(REFRESH_RETRY)
+
+    def start(self):
+        self.refresher = threading.Thread(target=self._keep_alive,
+                                          daemon=True)
+        self.refresher.start()
+
+    def stop(self):
+        self.stopping = True
+        self.wakeup.set()
+        if self.refresher is not None:
+            self.refresher.join()
@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+import os.path
+import sqlite3
+import threading
+import time
+from colorama import Fore, Style
+
+from beep_downloader.cache import get_cache, get_forbidden_files, \
+    get_validators
+from beep_downloader.structure import FileEntry, compact_files
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sites (
+    groupId INTEGER PRIMARY KEY,
+    name TEXT NOT NULL,
+    crawledAt REAL,
+    filters TEXT
+);
+CREATE TABLE IF NOT EXISTS folders (
+    folderId INTEGER PRIMARY KEY,
+    groupId INTEGER NOT NULL,
+    parentId INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    lastPostDate INTEGER,
+    modifiedDate INTEGER
+);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (groupId, parentId);
+CREATE TABLE IF NOT EXISTS files (
+    fileEntryId INTEGER PRIMARY KEY,
+    groupId INTEGER NOT NULL,
+    folderId INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    extension TEXT NOT NULL,
+    size REAL NOT NULL,
+    modifiedDate INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_folder ON files (groupId, folderId);
+CREATE TABLE IF NOT EXISTS downloads (
+    fileEntryId INTEGER PRIMARY KEY,
+    state TEXT NOT NULL,
+    target TEXT,
+    modifiedDate INTEGER,
+    path TEXT,
+    etag TEXT,
+    lastModified TEXT,
+    length INTEGER,
+    hash TEXT,
+    updated REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS downloads_state ON downloads (state);
+CREATE INDEX IF NOT EXISTS downloads_content ON downloads (length, hash);
+"""
+
+DONE = "done"
+FORBIDDEN = "forbidden"
+# being downloaded, or interrupted: a .part of the file may be on disk
+PARTIAL = "partial"
+
+
+class Manifest:
+    # local state of the downloads, every finished file is committed right
+    # away so an interrupted run restarts from where it stopped
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.created = not os.path.exists(path)
+        # send conditional requests for the files downloaded before
+        self.revalidate = True
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(path, check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        with self.lock:
+            self.conn.close()
+
+    def downloaded(self):
+        # fileEntryId -> (modifiedDate, planned path) of the downloaded files
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT fileEntryId, modifiedDate, target FROM downloads "
+                "WHERE state = ?", (DONE, ))
+            return {row[0]: (row[1], row[2]) for row in rows}
+
+    def forbidden_files(self):
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT fileEntryId FROM downloads WHERE state = ?",
+                (FORBIDDEN, ))
+            return {row[0] for row in rows}
+
+    def partial_files(self):
+        # fileEntryId -> planned path of the downloads that did not finish
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT fileEntryId, target FROM downloads WHERE state = ?",
+                (PARTIAL, ))
+            return {row[0]: row[1] for row in rows}
+
+    def validator(self, fileEntryId):
+        if not self.revalidate:
+            return None
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT path, etag, lastModified, length, hash FROM downloads "
+                "WHERE fileEntryId = ? AND path IS NOT NULL",
+                (fileEntryId, )).fetchone()
+        if row is None:
+            return None
+        return {
+            "path": row[0],
+            "etag": row[1],
+            "lastModified": row[2],
+            "length": row[3],
+            "hash": row[4]
+        }
+
+    def started(self, item):
+        # the validator of the file downloaded before is kept for the
+        # conditional request, until done or forbidden replace the row
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT INTO downloads (fileEntryId, state, target, "
+                "modifiedDate, updated) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (fileEntryId) DO UPDATE SET "
+                "state = excluded.state, target = excluded.target, "
+                "modifiedDate = excluded.modifiedDate, "
+                "updated = excluded.updated",
+                (item.fileEntryId, PARTIAL, item.path, item.modifiedDate,
+                 time.time()))
+
+    def done(self, item, validator=None):
+        validator = validator or dict()
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO downloads (fileEntryId, state, "
+                "target, modifiedDate, path, etag, lastModified, length, "
+                "hash, updated) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (item.fileEntryId, DONE, item.path, item.modifiedDate,
+                 validator.get("path"), validator.get("etag"),
+                 validator.get("lastModified"), validator.get("length"),
+                 validator.get("hash"), time.time()))
+
+    def same_content(self, length, hash):
+        # paths of the downloaded files with this content
+        with self.lock:
+            rows = self.conn.execute(
+                "SELECT path FROM downloads WHERE state = ? AND length = ? "
+                "AND hash = ?", (DONE, length, hash))
+            return [row[0] for row in rows]
+
+    def forbidden(self, fileEntryId):
+        with self.lock, self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO downloads (fileEntryId, state, "
+                "updated) VALUES (?, ?, ?)",
+                (fileEntryId, FORBIDDEN, time.time()))
+
+    def save_structure(self, structure):
+        # the structure replaces the saved one, the courses and folders no
+        # longer listed are removed in the same transaction
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM sites")
+            self.conn.execute("DELETE FROM folders")
+            self.conn.execute("DELETE FROM files")
+            for groupId, site in structure.items():
+                groupId = int(groupId)
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO sites (groupId, name, crawledAt, "
+                    "filters) VALUES (?, ?, ?, ?)",
+                    (groupId, site["name"], site.get("crawledAt"),
+                     site.get("filters")))
+                self._save_folder(groupId, 0, site)
+
+    def _save_folder(self, groupId, folderId, folder):
+        self.conn.executemany(
+            "INSERT OR REPLACE INTO files (fileEntryId, groupId, folderId, "
+            "title, extension, size, modifiedDate) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((f.fileEntryId, groupId, folderId, f.title, f.extension, f.size,
+              f.modifiedDate) for f in folder["files"]))
+        for subfolderId, subfolder in folder["folders"].items():
+            subfolderId = int(subfolderId)
+            self.conn.execute(
+                "INSERT OR REPLACE INTO folders (folderId, groupId, "
+                "parentId, name, lastPostDate, modifiedDate) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (subfolderId, groupId, folderId, subfolder["name"],
+                 subfolder.get("lastPostDate"),
+                 subfolder.get("modifiedDate")))
+            self._save_folder(groupId, subfolderId, subfolder)
+
+    def load_structure(self):
+        # rebuild the structure saved by save_structure, in the same format
+        # returned by the remotes
+        with self.lock:
+            structure = dict()
+            for groupId, name, crawledAt, filters in self.conn.execute(
+                    "SELECT groupId, name, crawledAt, filters FROM sites"):
+                structure[groupId] = {
+                    "name": name,
+                    "groupId": groupId,
+                    "crawledAt": crawledAt or 0,
+                    "filters": filters,
+                    "files": [],
+                    "folders": dict()
+                }
+            folders = dict()
+            parents = []
+            for row in self.conn.execute(
+                    "SELECT folderId, groupId, parentId, name, lastPostDate, "
+                    "modifiedDate FROM folders"):
+                folderId, groupId, parentId, name, lastPostDate, \
+                    modifiedDate = row
+                folders[folderId] = {
+                    "folderId": folderId,
+                    "name": name,
+                    "lastPostDate": lastPostDate,
+                    "modifiedDate": modifiedDate,
+                    "files": [],
+                    "folders": dict()
+                }
+                parents.append((groupId, parentId, folderId))
+            for groupId, parentId, folderId in parents:
+                parent = structure.get(groupId) if parentId == 0 else \
+                    folders.get(parentId)
+                if parent is not None:
+                    parent["folders"][folderId] = folders[folderId]
+            extensions = dict()
+            for row in self.conn.execute(
+                    "SELECT fileEntryId, groupId, folderId, title, extension, "
+                    "size, modifiedDate FROM files"):
+                f = FileEntry._make(row)
+                parent = structure.get(f.groupId) if f.folderId == 0 else \
+                    folders.get(f.folderId)
+                if parent is not None:
+                    # sqlite returns a new string for every row
+                    extension = extensions.setdefault(f.extension, f.extension)
+                    parent["files"].append(f._replace(extension=extension))
+            return structure
+
+    def import_json(self, out_dir, cache_path, forbidden_files_path,
+                    validators_path):
+        # the JSON cache has no per-file state, all the files it lists are
+        # considered downloaded at the path the planner would choose
+        from beep_downloader.remote.json import DownloadPlanner
+
+        cache = compact_files(get_cache(cache_path))
+        forbidden_files = get_forbidden_files(forbidden_files_path)
+        validators = get_validators(validators_path)
+        planner = DownloadPlanner(dict(), out_dir, forbidden_files)
+        planner.add_sites(cache)
+        for item in planner.to_download:
+            self.done(item, validators.get(str(item.fileEntryId)))
+        for fileEntryId in forbidden_files:
+            self.forbidden(fileEntryId)
+        self.save_structure(cache)
+        print(Style.BRIGHT + Fore.LIGHTCYAN_EX +
+              "Imported %d files from %s" %
+              (len(planner.to_download), cache_path))
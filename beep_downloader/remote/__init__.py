@@ -1,4 +1,9 @@
+import threading
+import time
 from abc import ABC, abstractmethod
+from colorama import Fore, Style
+
+from beep_downloader.cache import index_folders
 
 
 class Remote(ABC):
@@ -7,5 +12,100 @@ class Remote(ABC):
         pass
 
     @abstractmethod
-    def get_download_list(self, sites, cache, out_dir, forbidden_files):
+    def get_download_list(self, sites, downloaded, out_dir, forbidden_files):
         pass
+
+    def stream_user_sites(self, include_beep, username, password, planner):
+        # remotes that cannot feed the planner while crawling plan everything
+        # at the end of the crawl
+        sites = self.get_user_sites(include_beep, username, password)
+        if sites is not None:
+            planner.add_sites(sites)
+        return sites
+
+
+class CrawlCache:
+    # structure saved by the previous run, the sites crawled less than
+    # max_age seconds ago are reused as they are. With incremental the files
+    # of the folders whose lastPostDate and modifiedDate did not change are
+    # reused, their subfolders are still listed. Only the sites crawled with
+    # the same include and exclude rules are reused
+    def __init__(self,
+                 structure,
+                 max_age=None,
+                 incremental=False,
+                 filters=None):
+        self.structure = {
+            groupId: site
+            for groupId, site in structure.items()
+            if site.get("filters") == filters
+        }
+        self.max_age = max_age
+        self.incremental = incremental
+        self.folders = index_folders(self.structure) if incremental else \
+            dict()
+
+    def site(self, groupId):
+        site = self.structure.get(groupId)
+        max_age = self.site_max_age(groupId)
+        if site is None or max_age is None:
+            return None
+        if time.time() - site.get("crawledAt", 0) >= max_age:
+            return None
+        return site
+
+    def site_max_age(self, groupId):
+        return self.max_age
+
+    def folder(self, folder):
+        cached = self.folders.get(folder["folderId"])
+        if cached is None:
+            return None
+        for key in ("lastPostDate", "modifiedDate"):
+            if folder.get(key) is None or folder.get(key) != cached.get(key):
+                return None
+        return cached
+
+
+class CrawlStats:
+    def __init__(self):
+        self.start = time.monotonic()
+        self.requests = 0
+        self.folders = 0
+        self.reused_sites = 0
+        self.reused_folders = 0
+        # requests that would have been needed to crawl the reused folders
+        self.saved_requests = 0
+        self.lock = threading.Lock()
+
+    def add_requests(self, count):
+        # the requests may be counted by many crawler threads
+        with self.lock:
+            self.requests += count
+
+    def reuse(self, folder, requests_per_folder):
+        stack = [folder]
+        while stack:
+            folder = stack.pop()
+            self.reused_folders += 1
+            self.saved_requests += requests_per_folder
+            stack.extend(folder["folders"].values())
+
+    def reuse_files(self):
+        # the files of a folder come from the cache, its subfolders are
+        # still requested
+        self.reused_folders += 1
+        self.saved_requests += 1
+
+    def print_summary(self):
+        elapsed = time.monotonic() - self.start
+        print(Style.BRIGHT + Fore.LIGHTCYAN_EX +
+              "Crawled %d folders with %d requests in %.1fs" %
+              (self.folders, self.requests, elapsed))
+        if self.reused_folders:
+            total = self.requests + self.saved_requests
+            print("  Reused %d cached folders (%d whole sites), skipped %d "
+                  "of %d requests (%.0f%%)" %
+                  (self.reused_folders, self.reused_sites,
+                   self.saved_requests, total,
+                   100 * self.saved_requests / total))
@@ -1,62 +1,255 @@
 #!/usr/bin/env python3
 
 import json
+import math
 import requests
 import os.path
+import time
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
 from colorama import init, Fore, Style
 
-from beep_downloader.cache import get_file_from_cache, get_folder_from_cache, get_site_from_cache
+from beep_downloader import timing
 from beep_downloader.utils import format_size
-from beep_downloader.remote import Remote
+from beep_downloader.remote import Remote, CrawlStats
+from beep_downloader.download import DownloadItem
+from beep_downloader.structure import file_entry
+from beep_downloader.filters import CrawlFilter
+from beep_downloader.login import BEEP_URL
 
-GET_FILES_URL = "https://beep.metid.polimi.it/api/secure/jsonws/dlapp/get-file-entries?repositoryId=%d&folderId=%d"
-GET_SUBFOLDERS_URL = "https://beep.metid.polimi.it/api/secure/jsonws/dlapp/get-folders?repositoryId=%d&parentFolderId=%d"
-USER_SITES_URL = "https://beep.metid.polimi.it/api/secure/jsonws/group/get-user-sites"
-DOWNLOAD_FILE_URL = "https://beep.metid.polimi.it/documents/%d/%d/%s"
+GET_FILES_URL = BEEP_URL + "/api/secure/jsonws/dlapp/get-file-entries?repositoryId=%d&folderId=%d"
+GET_SUBFOLDERS_URL = BEEP_URL + "/api/secure/jsonws/dlapp/get-folders?repositoryId=%d&parentFolderId=%d"
+USER_SITES_URL = BEEP_URL + "/api/secure/jsonws/group/get-user-sites"
+INVOKE_URL = BEEP_URL + "/api/secure/jsonws/invoke"
+DOWNLOAD_FILE_URL = BEEP_URL + "/documents/%d/%d/%s"
+GET_FILES_CMD = "/dlapp/get-file-entries"
+GET_SUBFOLDERS_CMD = "/dlapp/get-folders"
+CRAWL_THREADS = 8
+# number of commands sent in a single /invoke request
+BATCH_SIZE = 50
+
+
+class BatchRejected(Exception):
+    pass
 
 
 class JsonRemote(Remote):
+    def __init__(self,
+                 threads=CRAWL_THREADS,
+                 batch=False,
+                 cache=None,
+                 crawl_filter=None):
+        self.threads = threads
+        self.batch = batch
+        self.cache = cache
+        self.crawl_filter = crawl_filter
+        # kept between the crawls, with its connections
+        self.session = None
+
     def get_user_sites(self, include_beep, username, password):
-        return get_user_sites(include_beep, username, password)
+        return self.stream_user_sites(include_beep, username, password, None)
+
+    def stream_user_sites(self, include_beep, username, password, planner):
+        if self.session is None:
+            self.session = make_session(username, password, self.threads)
+        session = self.session
+        with ThreadPoolExecutor(self.threads) as pool:
+            return get_user_sites(include_beep, session, pool, self.batch,
+                                  planner, self.cache, self.crawl_filter)
 
-    def get_download_list(self, sites, cache, out_dir, forbidden_files):
-        return get_download_list(sites, cache, out_dir, forbidden_files)
+    def get_download_list(self, sites, downloaded, out_dir, forbidden_files):
+        return get_download_list(sites, downloaded, out_dir, forbidden_files)
 
 
-def get_json(url, username, password):
-    session = requests.Session()
+def make_session(username, password, pool_size=CRAWL_THREADS):
+    session = timing.instrument(requests.Session(), "crawl")
     session.auth = HTTPBasicAuth(username, password)
-    response = session.get(url, stream=True)
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_json(url, session):
+    response = session.get(url)
     return json.loads(response.content.decode("latin"))
 
 
-def get_structure(folder, repo_id, folder_id, indent, username, password):
-    files = get_json(GET_FILES_URL % (repo_id, folder_id), username, password)
-    folders = get_json(GET_SUBFOLDERS_URL % (repo_id, folder_id), username,
-                       password)
-    folder["files"] = files
-    folder["folders"] = dict()
+def get_json_batch(commands, session):
+    response = session.post(INVOKE_URL, data={"cmd": json.dumps(commands)})
+    if response.status_code != 200:
+        raise BatchRejected()
+    try:
+        results = json.loads(response.content.decode("latin"))
+    except ValueError:
+        raise BatchRejected()
+    if not isinstance(results, list) or len(results) != len(commands):
+        raise BatchRejected()
+    if not all(isinstance(res, list) for res in results):
+        raise BatchRejected()
+    return results
+
+
+def wants_files(entry):
+    # the files of the folders crawled only to reach the included ones are
+    # not requested, nor the ones already known from the cache
+    _, _, _, _, scope, files = entry
+    return scope.inside and files is None
+
+
+def fetch_level(pending, session, pool):
+    files_futures = [
+        pool.submit(get_json, GET_FILES_URL %
+                    (entry[1], entry[2]), session)
+        if wants_files(entry) else None for entry in pending
+    ]
+    folders_futures = [
+        pool.submit(get_json, GET_SUBFOLDERS_URL % (repo_id, folder_id),
+                    session) for _, repo_id, folder_id, _, _, _ in pending
+    ]
+    return [(files.result() if files is not None else [], folders.result())
+            for files, folders in zip(files_futures, folders_futures)]
+
+
+def fetch_level_batch(pending, session, pool):
+    commands = []
+    for entry in pending:
+        _, repo_id, folder_id, _, _, _ = entry
+        if wants_files(entry):
+            commands.append(
+                {GET_FILES_CMD: {
+                    "repositoryId": repo_id,
+                    "folderId": folder_id
+                }})
+        commands.append({
+            GET_SUBFOLDERS_CMD: {
+                "repositoryId": repo_id,
+                "parentFolderId": folder_id
+            }
+        })
+    futures = [
+        pool.submit(get_json_batch, commands[i:i + BATCH_SIZE], session)
+        for i in range(0, len(commands), BATCH_SIZE)
+    ]
+    results = []
+    for future in futures:
+        results.extend(future.result())
+    results = iter(results)
+    return [(next(results) if wants_files(entry) else [], next(results))
+            for entry in pending]
+
+
+def get_structure(pending,
+                  session,
+                  pool,
+                  batch=False,
+                  planner=None,
+                  cache=None,
+                  stats=None,
+                  crawl_filter=None):
+    # pending is a list of (folder, repo_id, folder_id, parent, scope,
+    # files), files are the ones of the cache or None to fetch them. The
+    # whole level is fetched concurrently before moving to the next one. When
+    # a planner is given it is fed with every folder as soon as it's fetched
+    stats = stats or CrawlStats()
+    crawl_filter = crawl_filter or CrawlFilter()
+    while pending:
+        stats.folders += len(pending)
+        commands = len(pending) + sum(1 for p in pending if wants_files(p))
+        if batch:
+            try:
+                results = fetch_level_batch(pending, session, pool)
+                stats.requests += math.ceil(commands / BATCH_SIZE)
+            except BatchRejected:
+                print(Style.BRIGHT + Fore.YELLOW +
+                      "Batch requests rejected, using single requests")
+                batch = False
+        if not batch:
+            results = fetch_level(pending, session, pool)
+            stats.requests += commands
+        next_level = []
+        for (folder, repo_id, folder_id, parent, scope, cached_files), \
+                (files, folders) in zip(pending, results):
+            if cached_files is not None:
+                folder["files"] = cached_files
+            else:
+                folder["files"] = crawl_filter.files(
+                    scope, [file_entry(f) for f in files])
+            folder["folders"] = dict()
+            if planner is not None and folder_id == 0:
+                parent = planner.add_site(repo_id, folder)
+            elif planner is not None:
+                parent = planner.add_folder(folder, parent)
+            for f in folders:
+                subscope = crawl_filter.folder(scope, f["name"])
+                if subscope is None:
+                    continue
+                # the dates of a folder do not change when something is
+                # added deeper in the tree, only its own files are reused
+                # and its subfolders are still listed
+                cached = cache.folder(f) if cache is not None else None
+                cached_files = None
+                if cached is not None:
+                    cached_files = cached["files"]
+                    stats.reuse_files()
+                folder["folders"][f["folderId"]] = f
+                next_level.append((f, repo_id, f["folderId"], parent,
+                                   subscope, cached_files))
+        pending = next_level
+    return stats
+
+
+def print_structure(folder, indent):
     print("    %s%s (%d files)" %
-          ("    " * indent, folder["name"], len(files)))
-    for f in folders:
-        folder["folders"][f["folderId"]] = get_structure(
-            f, repo_id, f["folderId"], indent + 1, username, password)
-    return folder
+          ("    " * indent, folder["name"], len(folder["files"])))
+    for f in folder["folders"].values():
+        print_structure(f, indent + 1)
 
 
-def get_user_sites(include_beep, username, password):
-    sites = get_json(USER_SITES_URL, username, password)
+def get_user_sites(include_beep,
+                   session,
+                   pool,
+                   batch=False,
+                   planner=None,
+                   cache=None,
+                   crawl_filter=None):
+    stats = CrawlStats()
+    crawl_filter = crawl_filter or CrawlFilter()
+    sites = get_json(USER_SITES_URL, session)
+    stats.requests += 1
     structure = dict()
+    pending = []
     for site in sites:
         if not site.get("site", True):
             continue
         if not include_beep and site["name"] == "BeeP channel":
             continue
         groupId = site["groupId"]
-        folder = {"name": site["name"], "groupId": groupId}
-        get_structure(folder, groupId, 0, 0, username, password)
+        scope = crawl_filter.site(groupId, site["name"])
+        if scope is None:
+            continue
+        cached = cache.site(groupId) if cache is not None else None
+        if cached is not None:
+            structure[groupId] = cached
+            stats.reused_sites += 1
+            stats.reuse(cached, 2)
+            if planner is not None:
+                planner.add_sites({groupId: cached})
+            continue
+        folder = {
+            "name": site["name"],
+            "groupId": groupId,
+            "crawledAt": time.time(),
+            "filters": crawl_filter.signature
+        }
+        pending.append((folder, groupId, 0, None, scope, None))
         structure[groupId] = folder
+    get_structure(pending, session, pool, batch, planner, cache, stats,
+                  crawl_filter)
+    for folder in structure.values():
+        print_structure(folder, 0)
+    stats.print_summary()
     return structure
 
 
@@ -64,58 +257,77 @@ def download_file_url(groupId, folderId, title):
     return DOWNLOAD_FILE_URL % (groupId, folderId, title)
 
 
-def get_download_list_site(site, cache, base_dir, forbidden_files):
-    size = 0
-    download_size = 0
-    to_download = list()
+class DownloadPlanner:
+    def __init__(self, downloaded, out_dir, forbidden_files, put=None):
+        # downloaded maps fileEntryId -> (modifiedDate, path) of the files
+        # already downloaded
+        self.downloaded = downloaded
+        self.out_dir = out_dir
+        self.forbidden_files = forbidden_files
+        self.to_download = list()
+        self.put = put or self.to_download.append
+        # groupId -> [name, size, download_size, files to download]
+        self.stats = dict()
 
-    for f in site["files"]:
-        fileEntryId = f["fileEntryId"]
-        if fileEntryId in forbidden_files:
-            continue
-        cached_file = get_file_from_cache(cache, fileEntryId)
-        size += f["size"]
-        if cached_file.get("modifiedDate") == f["modifiedDate"]:
-            continue
-        groupId = f["groupId"]
-        folderId = f["folderId"]
-        title = f["title"]
-
-        download_size += f["size"]
-        download_url = download_file_url(groupId, folderId, title)
-        download_path = os.path.join(base_dir, f["title"])
-        if not download_path.endswith(f["extension"]):
-            download_path += "." + f["extension"]
-        to_download.append((download_url, download_path, fileEntryId))
-
-    for folderId, f in site["folders"].items():
-        cached_dir = get_folder_from_cache(cache, folderId)
-        sz, down_sz, to_dl = get_download_list_site(
-            f, cached_dir, os.path.join(base_dir, f["name"]), forbidden_files)
-        size += sz
-        download_size += down_sz
-        to_download.extend(to_dl)
-    return size, download_size, to_download
-
-
-def get_download_list(sites, cache, out_dir, forbidden_files):
-    downloads = list()
-    total_size = 0
-    total_download_size = 0
-    for groupId, site in sites.items():
+    def add_site(self, groupId, site):
         groupId = str(groupId)
-        cache_site = get_site_from_cache(cache, groupId)
-        size, download_size, to_download = get_download_list_site(
-            site, cache_site, os.path.join(out_dir, site["name"]),
-            forbidden_files)
-        print(Style.BRIGHT + "  %s" % site["name"])
-        print(
-            "      Total size: %s | To download: %s | Files to download: %d" %
-            (format_size(size), format_size(download_size), len(to_download)))
-        downloads.extend(to_download)
-        total_size += size
-        total_download_size += download_size
-    print("  Total size: %s | To download: %s | Files to download: %d" %
-          (format_size(total_size), format_size(total_download_size),
-           len(downloads)))
-    return downloads
+        self.stats[groupId] = [site["name"], 0, 0, 0]
+        base_dir = os.path.join(self.out_dir, site["name"])
+        return self._add_files(groupId, site, base_dir)
+
+    def add_folder(self, folder, parent):
+        groupId, base_dir = parent
+        base_dir = os.path.join(base_dir, folder["name"])
+        return self._add_files(groupId, folder, base_dir)
+
+    def _add_files(self, site, folder, base_dir):
+        stats = self.stats[site]
+        for f in folder["files"]:
+            fileEntryId = f.fileEntryId
+            if fileEntryId in self.forbidden_files:
+                continue
+            stats[1] += f.size
+
+            download_url = download_file_url(f.groupId, f.folderId, f.title)
+            download_path = os.path.join(base_dir, f.title)
+            if not download_path.endswith(f.extension):
+                download_path += "." + f.extension
+            if self.downloaded.get(fileEntryId) == (f.modifiedDate,
+                                                    download_path):
+                continue
+            stats[2] += f.size
+            stats[3] += 1
+            self.put(
+                DownloadItem(download_url, download_path, fileEntryId, f.size,
+                             f.modifiedDate, f.groupId))
+        return site, base_dir
+
+    def _add_subfolders(self, folder, parent):
+        for f in folder["folders"].values():
+            self._add_subfolders(f, self.add_folder(f, parent))
+
+    def add_sites(self, sites):
+        for groupId, site in sites.items():
+            self._add_subfolders(site, self.add_site(groupId, site))
+
+    def plan(self, sites):
+        self.add_sites(sites)
+        self.print_summary()
+        return self.to_download
+
+    def print_summary(self):
+        for name, size, download_size, count in self.stats.values():
+            print(Style.BRIGHT + "  %s" % name)
+            print(
+                "      Total size: %s | To download: %s | Files to download: %d"
+                % (format_size(size), format_size(download_size), count))
+        total_size = sum(s[1] for s in self.stats.values())
+        total_download_size = sum(s[2] for s in self.stats.values())
+        count = sum(s[3] for s in self.stats.values())
+        print("  Total size: %s | To download: %s | Files to download: %d" %
+              (format_size(total_size), format_size(total_download_size),
+               count))
+
+
+def get_download_list(sites, downloaded, out_dir, forbidden_files):
+    return DownloadPlanner(downloaded, out_dir, forbidden_files).plan(sites)
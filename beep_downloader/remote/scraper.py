@@ -1,57 +1,186 @@
 import requests
-from bs4 import BeautifulSoup
+import lxml.html
+import multiprocessing
 import re
 import datetime
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from requests.adapters import HTTPAdapter
 from colorama import Fore, Style
 
-from beep_downloader.remote import Remote
+from beep_downloader import timing
+from beep_downloader.remote import Remote, CrawlStats
 from beep_downloader.remote.json import get_download_list
-from beep_downloader.login import perform_beep_login
+from beep_downloader.login import perform_beep_login, BEEP_HOME_URL
+from beep_downloader.structure import FileEntry
+from beep_downloader.filters import CrawlFilter
+
+FOLDER_SUFFIX = "?p_p_id=20&p_p_lifecycle=2&p_p_state=normal&p_p_mode=view&p_p_cacheability=cacheLevelPage&p_p_col_id=column-1&p_p_col_count=1&"
+FOLDER_DATA = {
+    "_20_folderId": 0,
+    "_20_displayStyle": "list",
+    "_20_viewEntries": 0,
+    "_20_viewFolders": 0,
+    "_20_entryEnd": 500,
+    "_20_entryStart": 0,
+    "_20_folderEnd": 20,
+    "_20_folderStart": 0,
+    "_20_viewEntriesPage": 1,
+    "_20_viewFoldersPage": 1,
+    "p_p_id": 20,
+    "p_p_lifecycle": 0,
+}
+# page sizes asked to the server, it may return less entries per page
+ENTRY_PAGE_SIZE = 2000
+FOLDER_PAGE_SIZE = 200
+# page sizes the server is known to honor, when there is no pagination
+# control a page this full may have been truncated
+MIN_ENTRY_PAGE_SIZE = 500
+MIN_FOLDER_PAGE_SIZE = 20
+SCRAPER_THREADS = 8
+# most pages fetched for a single folder, in case the server ignores the
+# start of the pages
+MAX_FOLDER_PAGES = 1000
+# pages shorter than this are parsed by the thread that fetched them, sending
+# them to a process costs more than parsing them
+MIN_PROCESS_PAGE_SIZE = 16 * 1024
+# "Showing 1 - 500 of 2,000 results" or "Visualizzazione di 1 - 500 di 2.000
+# risultati" in the pagination controls
+PAGE_RESULTS_RE = re.compile(
+    r"(\d[\d.,]*)\s*-\s*(\d[\d.,]*)\s+(?:of|di)\s+(\d[\d.,]*)")
 
 
 class ScraperRemote(Remote):
+    def __init__(self, cache=None, threads=SCRAPER_THREADS, crawl_filter=None):
+        self.cache = cache
+        self.threads = threads
+        self.crawl_filter = crawl_filter
+        # kept between the crawls, with its connections
+        self.session = None
+        self.parser = FolderParser()
+
     def get_user_sites(self, include_beep, username, password):
         cookies = perform_beep_login(username, password)
         if cookies is None:
             return None
-        session = requests.Session()
+        if self.session is None:
+            self.session = timing.instrument(requests.Session(), "crawl")
+            adapter = HTTPAdapter(pool_connections=self.threads,
+                                  pool_maxsize=self.threads)
+            self.session.mount("https://", adapter)
+            self.session.mount("http://", adapter)
+        session = self.session
         session.cookies = cookies
-        res = session.get("https://beep.metid.polimi.it/polimi/login")
-        content = BeautifulSoup(res.content.decode("latin"), 'html.parser')
-        data = get_user_sites(session, content)
+        stats = CrawlStats()
+        with ThreadPoolExecutor(self.threads) as pool:
+            data = get_user_sites(session, pool, self.parser, self.cache,
+                                  stats, self.crawl_filter)
+        stats.print_summary()
         return data
 
-    def get_download_list(self, sites, cache, out_dir, forbidden_files):
-        return get_download_list(sites, cache, out_dir, forbidden_files)
+    def get_download_list(self, sites, downloaded, out_dir, forbidden_files):
+        return get_download_list(sites, downloaded, out_dir, forbidden_files)
+
+
+class FolderParser:
+    # parses the folder pages fetched by the threads of a crawl. Parsing is
+    # CPU bound and would hold the GIL, the big pages go to a pool of
+    # processes started on the first of them and kept between the crawls.
+    # The workers are spawned since forking a process with running threads
+    # is unsafe
+    def __init__(self):
+        self.processes = None
+        self.lock = threading.Lock()
+
+    def parse(self, content, group_id, folder_id):
+        if len(content) < MIN_PROCESS_PAGE_SIZE:
+            return parse_folder(content, group_id, folder_id)
+        with self.lock:
+            if self.processes is None:
+                self.processes = ProcessPoolExecutor(
+                    mp_context=multiprocessing.get_context("spawn"))
+        return self.processes.submit(parse_folder, content, group_id,
+                                     folder_id).result()
+
+    def shutdown(self):
+        with self.lock:
+            if self.processes is not None:
+                self.processes.shutdown()
+                self.processes = None
 
 
-def get_user_sites(session, content):
-    sites = dict()
-    for td in content.find_all("td"):
-        links = td.find_all("a")
+def has_class(name):
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+
+def parse_html(content):
+    if not content.strip():
+        return None
+    return lxml.html.document_fromstring(content)
+
+
+def parse_site_list(content):
+    # returns the (name, href) of the courses in a page of the course list
+    # and the link to the next page, if any
+    root = parse_html(content)
+    if root is None:
+        return [], None
+    sites = []
+    for td in root.iter("td"):
+        links = td.findall(".//a")
         if len(links) != 1:
             continue
         link = links[0]
-        href = link["href"]
-        name = link.find("strong")
+        name = link.find(".//strong")
         if name is None:
             continue
-        name = name.get_text()
-        id = extract_site_id(href)
-        if id is None:
-            print("Cannot extract id of", name)
-            continue
-        print(name)
-        files, folders = extract_course_structure(session, href, id)
-        sites[id] = {"name": name, "files": files, "folders": folders}
+        sites.append((name.text_content(), link.get("href")))
+    next = root.xpath("//*[@id='column-1']//a[%s]/@href" % has_class("next"))
+    return sites, next[0] if next else None
 
-    next = content.find(id="column-1").find("a", class_="next")
-    if next is not None:
-        res = session.get(next["href"])
-        content = BeautifulSoup(res.content.decode("latin"), 'html.parser')
-        sites.update(get_user_sites(session, content))
 
-    return sites
+def get_user_sites(session,
+                   pool,
+                   parser,
+                   cache=None,
+                   stats=None,
+                   crawl_filter=None):
+    # the pages have no folder-level change signal, only whole sites crawled
+    # recently are reused
+    stats = stats or CrawlStats()
+    crawl_filter = crawl_filter or CrawlFilter()
+    structure = dict()
+    pending = []
+    url = BEEP_HOME_URL
+    while url is not None:
+        res = session.get(url)
+        stats.add_requests(1)
+        sites, url = parse_site_list(res.content.decode("latin"))
+        for name, href in sites:
+            id = extract_site_id(href)
+            if id is None:
+                print("Cannot extract id of", name)
+                continue
+            scope = crawl_filter.site(id, name)
+            if scope is None:
+                continue
+            print(name)
+            cached = cache.site(id) if cache is not None else None
+            if cached is not None:
+                structure[id] = cached
+                stats.reused_sites += 1
+                stats.reuse(cached, 1)
+                continue
+            site = {
+                "name": name,
+                "crawledAt": time.time(),
+                "filters": crawl_filter.signature
+            }
+            structure[id] = site
+            pending.append((site, id, 0, href, scope))
+    get_structure(pending, session, pool, parser, stats, crawl_filter)
+    return structure
 
 
 def extract_site_id(href):
@@ -59,112 +188,251 @@ def extract_site_id(href):
     return int(res.group(1))
 
 
-def extract_course_structure(session, link, group_id):
+def page_data(entry_start, entry_end, folder_start, folder_end):
+    data = dict(FOLDER_DATA)
+    data.update({
+        "_20_entryStart": entry_start,
+        "_20_entryEnd": entry_end,
+        "_20_folderStart": folder_start,
+        "_20_folderEnd": folder_end,
+    })
+    return data
+
+
+FIRST_PAGE = page_data(0, ENTRY_PAGE_SIZE, 0, FOLDER_PAGE_SIZE)
+# (start field, end field, page number field, page size surely honored,
+# index in the parsed page) of the file entries and of the subfolders
+PAGINATION = [
+    ("_20_entryStart", "_20_entryEnd", "_20_viewEntriesPage",
+     MIN_ENTRY_PAGE_SIZE, 0),
+    ("_20_folderStart", "_20_folderEnd", "_20_viewFoldersPage",
+     MIN_FOLDER_PAGE_SIZE, 1),
+]
+
+
+def fetch_course(session, link, stats):
     res = session.get(link)
     prefix = res.url.rsplit("/", 1)[0]
-    suffix = "?p_p_id=20&p_p_lifecycle=2&p_p_state=normal&p_p_mode=view&p_p_cacheability=cacheLevelPage&p_p_col_id=column-1&p_p_col_count=1&"
-    data = {
-        "_20_folderId": 0,
-        "_20_displayStyle": "list",
-        "_20_viewEntries": 0,
-        "_20_viewFolders": 0,
-        "_20_entryEnd": 500,
-        "_20_entryStart": 0,
-        "_20_folderEnd": 20,
-        "_20_folderStart": 0,
-        "_20_viewEntriesPage": 1,
-        "p_p_id": 20,
-        "p_p_lifecycle": 0,
-    }
-    url = prefix + "/documenti-e-media" + suffix
-    res = session.post(url, data)
+    url = prefix + "/documenti-e-media" + FOLDER_SUFFIX
+    res = session.post(url, FIRST_PAGE)
+    stats.add_requests(2)
     content = res.content.decode("latin")
     if res.status_code == 404 or "Not Found" in content:
-        url = prefix + "/materiali" + suffix
-        res = session.post(url, data)
+        url = prefix + "/materiali" + FOLDER_SUFFIX
+        res = session.post(url, FIRST_PAGE)
+        stats.add_requests(1)
         content = res.content.decode("latin")
     if res.status_code == 404:
-        return [], dict()
-    content = BeautifulSoup(content, 'html.parser')
-    return extract_folder(session, content, group_id, 0)
-
-
-def extract_folder(session, content, group_id, folder_id):
-    data = {
-        "_20_folderId": 0,
-        "_20_displayStyle": "list",
-        "_20_viewEntries": 0,
-        "_20_viewFolders": 0,
-        "_20_entryEnd": 500,
-        "_20_entryStart": 0,
-        "_20_folderEnd": 20,
-        "_20_folderStart": 0,
-        "_20_viewEntriesPage": 1,
-        "p_p_id": 20,
-        "p_p_lifecycle": 0,
-    }
+        return None, None
+    return url, content
+
+
+def fetch_page(session, parser, url, data, group_id, folder_id, stats):
+    res = session.post(url, data)
+    stats.add_requests(1)
+    content = res.content.decode("latin")
+    return parser.parse(content, group_id, folder_id)
+
+
+def fetch_folder(session, parser, link, group_id, folder_id, stats):
+    # returns the url of the folder pages and its first page
+    if folder_id != 0:
+        return link, fetch_page(session, parser, link, FIRST_PAGE, group_id,
+                                folder_id, stats)
+    url, content = fetch_course(session, link, stats)
+    if content is None:
+        return None, ([], [], [], (None, None))
+    return url, parser.parse(content, group_id, folder_id)
+
+
+def more_pages(data, page):
+    # the request data of the pages that follow the page fetched with data.
+    # With a pagination control all the remaining pages are known after the
+    # first one, otherwise a page as full as the page size surely honored by
+    # the server may be followed by another one
+    pages = []
+    for start_key, end_key, page_key, min_size, index in PAGINATION:
+        start, end = data[start_key], data[end_key]
+        if start == end:
+            continue
+        count = len(page[index])
+        total = page[3][index]
+        if total is not None and start == 0:
+            # the server may return less entries than asked
+            size = end - start
+            if 0 < count < min(total, size):
+                size = count
+            starts = range(count, total, size) if count > 0 else []
+        elif total is None and count >= min_size:
+            size = count
+            starts = [start + count]
+        else:
+            continue
+        for new_start in starts:
+            new_data = page_data(0, 0, 0, 0)
+            new_data[start_key] = new_start
+            new_data[end_key] = new_start + size
+            new_data[page_key] = new_start // size + 1
+            pages.append(new_data)
+    return pages
+
+
+def merge_page(result, page):
+    # returns the number of entries that were not in the previous pages
+    files, subfolders, warnings = result
+    file_ids = {f.fileEntryId for f in files}
+    folder_ids = {f[0] for f in subfolders}
+    count = len(files) + len(subfolders)
+    files.extend(f for f in page[0] if f.fileEntryId not in file_ids)
+    subfolders.extend(f for f in page[1] if f[0] not in folder_ids)
+    warnings.extend(page[2])
+    return len(files) + len(subfolders) - count
+
+
+def limit_pages(result, fetched, new_pages):
+    # the pages still allowed to a folder that already fetched some
+    allowed = max(0, MAX_FOLDER_PAGES - fetched)
+    if len(new_pages) > allowed:
+        result[2].append("Too many pages, stopped after %d" %
+                         MAX_FOLDER_PAGES)
+    return new_pages[:allowed]
+
+
+def get_structure(pending, session, pool, parser, stats, crawl_filter=None):
+    # pending is a list of (folder, group_id, folder_id, link, scope), like
+    # the JSON remote the whole level is fetched concurrently, together with
+    # the other pages of the big folders
+    crawl_filter = crawl_filter or CrawlFilter()
+    while pending:
+        stats.folders += len(pending)
+        futures = [
+            pool.submit(fetch_folder, session, parser, link, group_id,
+                        folder_id, stats)
+            for _, group_id, folder_id, link, _ in pending
+        ]
+        results = []
+        # pages fetched or requested for every folder
+        fetched = []
+        todo = []
+        for num, future in enumerate(futures):
+            url, page = future.result()
+            results.append(([], [], []))
+            merge_page(results[num], page)
+            new_pages = limit_pages(results[num], 1,
+                                    more_pages(FIRST_PAGE, page))
+            fetched.append(1 + len(new_pages))
+            todo.extend((num, url, data) for data in new_pages)
+        while todo:
+            futures = [
+                pool.submit(fetch_page, session, parser, url, data,
+                            pending[num][1], pending[num][2], stats)
+                for num, url, data in todo
+            ]
+            next_todo = []
+            for (num, url, data), future in zip(todo, futures):
+                page = future.result()
+                if merge_page(results[num], page) == 0:
+                    # nothing new, the server returned a page already seen
+                    continue
+                new_pages = limit_pages(results[num], fetched[num],
+                                        more_pages(data, page))
+                fetched[num] += len(new_pages)
+                next_todo.extend((num, url, new_data)
+                                 for new_data in new_pages)
+            todo = next_todo
+
+        next_level = []
+        for (folder, group_id, _, _, scope), (files, subfolders, warnings) \
+                in zip(pending, results):
+            for warning in warnings:
+                print(Style.BRIGHT + Fore.YELLOW + warning)
+            folder["files"] = crawl_filter.files(scope, files)
+            folder["folders"] = dict()
+            for new_folder_id, name, link in subfolders:
+                if link is None:
+                    print("??")
+                    continue
+                subscope = crawl_filter.folder(scope, name)
+                if subscope is None:
+                    continue
+                new_folder = {"folderId": new_folder_id, "name": name}
+                folder["folders"][new_folder_id] = new_folder
+                next_level.append(
+                    (new_folder, group_id, new_folder_id, link, subscope))
+        pending = next_level
+    return stats
+
+
+def parse_file_size(text):
+    try:
+        size = text.strip().replace(",", "")
+        num, unit = size[:-1], size[-1]
+        if unit == "k":
+            scale = 1024
+        else:
+            scale = 1
+        return float(num) * scale
+    except:
+        return 0
+
+
+def parse_date(text, warnings):
+    try:
+        modified_date = text.strip()
+        # dd/mm/yy hh.mm  -->  dd/mm/yy hh:mm
+        modified_date = modified_date.replace(".", ":")
+        return int(
+            datetime.datetime.strptime(modified_date,
+                                       "%d/%m/%y %H:%M").timestamp())
+    except:
+        warnings.append("Invalid date: %s" % modified_date)
+        return 0
+
+
+def parse_total(root, container):
+    # total number of results shown by the pagination control in container
+    for node in root.xpath("//*[%s]" % has_class(container)):
+        match = PAGE_RESULTS_RE.search(node.text_content())
+        if match:
+            return int(re.sub(r"[.,]", "", match.group(3)))
+    return None
+
+
+def parse_folder(content, group_id, folder_id):
+    # runs in a worker process for the big pages, returns the files of the folder, the
+    # (folderId, name, link) of its subfolders, the warnings to print and the
+    # total number of files and subfolders if the page has pagination controls
     files = []
-    folders = dict()
-    for tr in content.find_all("tr", class_="results-row"):
-        if "data-folder-id" in tr.attrs:
-            new_folder_id = int(tr["data-folder-id"])
-            name = tr["data-title"]
-            link = tr.find("a", attrs={"data-folder": "true"})
-            if link is not None:
-                res = session.post(link["href"], data)
-                content = res.content.decode("latin")
-                content = BeautifulSoup(content, 'html.parser')
-                new_files, new_folders = extract_folder(
-                    session, content, group_id, new_folder_id)
-                folders[new_folder_id] = {
-                    "folderId": new_folder_id,
-                    "name": name,
-                    "files": new_files,
-                    "folders": new_folders
-                }
-            else:
-                print("??")
-        elif "data-title" in tr.attrs:
-            file_name = tr["data-title"]
-            a = tr.find("a")
-            file_id = a["data-file-entry-id"]
-            size = tr.find("td", class_="col-3")
-            if size is not None:
-                try:
-                    size = size.get_text().strip().replace(",", "")
-                    num, unit = size[:-1], size[-1]
-                    if unit == "k":
-                        scale = 1024
-                    else:
-                        scale = 1
-                    size = float(num) * scale
-                except:
-                    size = 0
+    subfolders = []
+    warnings = []
+    root = parse_html(content)
+    if root is None:
+        return files, subfolders, warnings, (None, None)
+    totals = (parse_total(root, "document-entries-pagination"),
+              parse_total(root, "folder-pagination"))
+    for tr in root.xpath("//tr[%s]" % has_class("results-row")):
+        if tr.get("data-folder-id") is not None:
+            link = tr.xpath(".//a[@data-folder='true']/@href")
+            subfolders.append((int(tr.get("data-folder-id")),
+                               tr.get("data-title"),
+                               link[0] if link else None))
+        elif tr.get("data-title") is not None:
+            file_name = tr.get("data-title")
+            a = tr.find(".//a")
+            file_id = a.get("data-file-entry-id")
+            size = tr.xpath(".//td[%s]" % has_class("col-3"))
+            if size:
+                size = parse_file_size(size[0].text_content())
             else:
                 size = 0
-            modified_date = tr.find("td", class_="col-5")
-            if modified_date is not None:
-                try:
-                    modified_date = modified_date.get_text().strip()
-                    # dd/mm/yy hh.mm  -->  dd/mm/yy hh:mm
-                    modified_date = modified_date.replace(".", ":")
-                    modified_date = int(
-                        datetime.datetime.strptime(
-                            modified_date, "%d/%m/%y %H:%M").timestamp())
-                except:
-                    print(Style.BRIGHT + Fore.YELLOW +
-                          "Invalid date: %s" % modified_date)
-                    modified_date = 0
+            modified_date = tr.xpath(".//td[%s]" % has_class("col-5"))
+            if modified_date:
+                modified_date = parse_date(modified_date[0].text_content(),
+                                           warnings)
             else:
                 modified_date = 0
 
-            files.append({
-                "fileEntryId": int(file_id),
-                "title": file_name,
-                "modifiedDate": modified_date,
-                "size": size,
-                "groupId": group_id,
-                "folderId": folder_id,
-                "extension": ""
-            })
-    return files, folders
+            files.append(
+                FileEntry(int(file_id), group_id, folder_id, file_name, "",
+                          size, modified_date))
+    return files, subfolders, warnings, totals
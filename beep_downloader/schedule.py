@@ -0,0 +1,200 @@
+#!/usr/bin/env python3
+
+import asyncio
+import collections
+import heapq
+import itertools
+import queue
+import time
+
+# in the fair share a file costs its size plus this, so that the courses
+# with many small files are not served more often than the others
+FAIR_ITEM_COST = 256 * 1024
+
+
+class CrawlOrder:
+    # the files in the order they are planned, one course after the other
+    def __init__(self):
+        self.items = collections.deque()
+
+    def __len__(self):
+        return len(self.items)
+
+    def push(self, item):
+        self.items.append(item)
+
+    def pop(self):
+        return self.items.popleft()
+
+
+class SizeOrder:
+    # the biggest files first (longest processing time first) keep all the
+    # workers busy until the end of the run, the smallest files first make
+    # most of the files available early. Files of the same size keep the
+    # crawl order
+    def __init__(self, biggest_first):
+        self.sign = -1 if biggest_first else 1
+        self.heap = []
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def push(self, item):
+        heapq.heappush(self.heap,
+                       (self.sign * item.size, next(self.counter), item))
+
+    def pop(self):
+        return heapq.heappop(self.heap)[2]
+
+
+POLICIES = {
+    "crawl": CrawlOrder,
+    "lpt": lambda: SizeOrder(True),
+    "small": lambda: SizeOrder(False),
+}
+
+
+class FairShare:
+    # a queue for each course, the next file comes from the course that
+    # received the fewest bytes so far, so that a big course cannot take all
+    # the workers. A course that had nothing to download starts from the
+    # least served one instead of taking back the time it was idle
+    def __init__(self, new_policy):
+        self.new_policy = new_policy
+        self.sites = dict()
+        self.served = dict()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def push(self, item):
+        site = self.sites.get(item.groupId)
+        if site is None:
+            site = self.sites[item.groupId] = self.new_policy()
+            self.served[item.groupId] = 0
+        if not site:
+            served = [
+                self.served[groupId] for groupId, other in self.sites.items()
+                if other
+            ]
+            if served:
+                self.served[item.groupId] = max(self.served[item.groupId],
+                                                min(served))
+        site.push(item)
+        self.count += 1
+
+    def pop(self):
+        groupId = min((groupId for groupId, site in self.sites.items() if site),
+                      key=self.served.__getitem__)
+        item = self.sites[groupId].pop()
+        self.served[groupId] += item.size + FAIR_ITEM_COST
+        self.count -= 1
+        return item
+
+
+class Schedule:
+    # order in which the downloaders take the files. The segments of a file
+    # already started and the other items without a size skip the queue
+    def __init__(self, policy="crawl", fair=False):
+        new_policy = POLICIES[policy]
+        self.files = FairShare(new_policy) if fair else new_policy()
+        self.urgent = collections.deque()
+
+    def __len__(self):
+        return len(self.urgent) + len(self.files)
+
+    def push(self, item):
+        if getattr(item, "size", None) is None:
+            self.urgent.append(item)
+        else:
+            self.files.push(item)
+
+    def pop(self):
+        if self.urgent:
+            return self.urgent.popleft()
+        return self.files.pop()
+
+
+class ScheduledQueue(queue.Queue):
+    # queue.Queue that returns the items in the order of the schedule
+    def __init__(self, schedule):
+        self.schedule = schedule
+        # (ready at, counter, item) of the items put back after a delay
+        self.delayed = []
+        self.counter = itertools.count()
+        super().__init__()
+
+    def _init(self, maxsize):
+        self.queue = self.schedule
+
+    def _put(self, item):
+        self.queue.push(item)
+
+    def _get(self):
+        return self.queue.pop()
+
+    def requeue_later(self, item, delay):
+        # puts back an item taken from the queue after delay seconds, in
+        # place of its task_done(): it stays unfinished while it waits so
+        # join() waits for it, and no thread is blocked meanwhile
+        with self.mutex:
+            heapq.heappush(self.delayed,
+                           (time.monotonic() + delay, next(self.counter),
+                            item))
+            self.not_empty.notify()
+
+    def _release_ready(self):
+        now = time.monotonic()
+        while self.delayed and self.delayed[0][0] <= now:
+            self._put(heapq.heappop(self.delayed)[2])
+
+    def get(self, block=True, timeout=None):
+        # like queue.Queue.get, the waits also end when a delayed item is
+        # ready
+        with self.not_empty:
+            deadline = None if timeout is None else \
+                time.monotonic() + timeout
+            while True:
+                self._release_ready()
+                if self._qsize():
+                    break
+                waits = []
+                if self.delayed:
+                    waits.append(self.delayed[0][0])
+                if deadline is not None:
+                    waits.append(deadline)
+                if not block or (deadline is not None and
+                                 time.monotonic() >= deadline):
+                    raise queue.Empty
+                self.not_empty.wait(
+                    max(0, min(waits) - time.monotonic()) if waits else None)
+            item = self._get()
+            self.not_full.notify()
+            return item
+
+
+class AsyncScheduledQueue(asyncio.Queue):
+    def __init__(self, schedule):
+        self.schedule = schedule
+        super().__init__()
+
+    def _init(self, maxsize):
+        self._queue = self.schedule
+
+    def _put(self, item):
+        self._queue.push(item)
+
+    def _get(self):
+        return self._queue.pop()
+
+    def requeue_later(self, item, delay):
+        # puts back an item taken from the queue after delay seconds, in
+        # place of its task_done(): it stays unfinished while it waits so
+        # join() waits for it
+        asyncio.get_event_loop().call_later(delay, self._requeue, item)
+
+    def _requeue(self, item):
+        self.put_nowait(item)
+        self.task_done()
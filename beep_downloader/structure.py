@@ -1,10 +1,122 @@
 #!/usr/bin/env python3
 
+import json
+import sys
+from collections import namedtuple
+
+# the fields of a file used by the planner and by the manifest, the API
+# returns dozens more. A namedtuple has no per-instance dict, an entry takes
+# a fraction of the memory of the decoded JSON object
+FileEntry = namedtuple("FileEntry", [
+    "fileEntryId", "groupId", "folderId", "title", "extension", "size",
+    "modifiedDate"
+])
+
+
+def file_entry(f):
+    # f is a file of the API, of the pages or of an old JSON structure
+    if isinstance(f, FileEntry):
+        return f
+    return FileEntry(f["fileEntryId"], f["groupId"], f["folderId"],
+                     f["title"], sys.intern(f["extension"]), f["size"],
+                     f["modifiedDate"])
+
+
+def compact_files(structure):
+    # replaces in place the files of a structure decoded from JSON
+    stack = list(structure.values())
+    while stack:
+        folder = stack.pop()
+        folder["files"] = [file_entry(f) for f in folder.get("files", [])]
+        folder.setdefault("folders", dict())
+        stack.extend(folder["folders"].values())
+    return structure
+
 
 def get_size(folder):
     size = 0
     for f in folder["files"]:
-        size += f["size"]
+        size += f.size
     for d in folder["folders"].values():
         size += get_size(d)
     return size
+
+
+def _folder_lines(groupId, parentId, folderId, folder):
+    # the parents come before their subfolders, so they can be linked while
+    # reading
+    stack = [(parentId, folderId, folder)]
+    while stack:
+        parentId, folderId, folder = stack.pop()
+        line = {
+            "groupId": groupId,
+            "folderId": folderId,
+            "name": folder["name"],
+            "files": [[f.fileEntryId, f.title, f.extension, f.size,
+                       f.modifiedDate] for f in folder["files"]]
+        }
+        if folderId == 0:
+            line["crawledAt"] = folder.get("crawledAt")
+        else:
+            line.update(parentId=parentId,
+                        lastPostDate=folder.get("lastPostDate"),
+                        modifiedDate=folder.get("modifiedDate"))
+        yield json.dumps(line, separators=(",", ":")) + "\n"
+        stack.extend((folderId, int(subfolderId), subfolder)
+                     for subfolderId, subfolder in reversed(
+                         list(folder["folders"].items())))
+
+
+def dump_structure(structure, f):
+    # NDJSON, one line per folder: only the folder being written is encoded
+    # instead of the whole structure at once
+    for groupId, site in structure.items():
+        for line in _folder_lines(int(groupId), None, 0, site):
+            f.write(line)
+
+
+def load_structure(f):
+    # reads a structure written by dump_structure one line at a time, or a
+    # single JSON document in the format returned by the remotes
+    first = f.readline()
+    try:
+        line = json.loads(first) if first.strip() else None
+    except ValueError:
+        line = None
+    if not isinstance(line, dict) or "folderId" not in line:
+        return compact_files(json.loads(first + f.read()))
+    structure = dict()
+    folders = dict()
+    while line is not None:
+        groupId = line["groupId"]
+        folderId = line["folderId"]
+        folder = {
+            "name": line["name"],
+            "files": [
+                FileEntry(fileEntryId, groupId, folderId, title,
+                          sys.intern(extension), size, modifiedDate)
+                for fileEntryId, title, extension, size, modifiedDate in
+                line["files"]
+            ],
+            "folders": dict()
+        }
+        if folderId == 0:
+            folder.update(groupId=groupId,
+                          crawledAt=line.get("crawledAt") or 0)
+            structure[groupId] = folder
+        else:
+            folder.update(folderId=folderId,
+                          lastPostDate=line.get("lastPostDate"),
+                          modifiedDate=line.get("modifiedDate"))
+            parentId = line["parentId"]
+            parent = structure.get(groupId) if parentId == 0 else \
+                folders.get(parentId)
+            if parent is not None:
+                parent["folders"][folderId] = folder
+            folders[folderId] = folder
+        line = None
+        for text in f:
+            if text.strip():
+                line = json.loads(text)
+                break
+    return structure
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+
+import contextlib
+import csv
+import heapq
+import json
+import os
+import os.path
+import re
+import threading
+import time
+from urllib.parse import urlparse
+
+# slowest files kept for the report
+SLOWEST_FILES = 20
+PERCENTILES = [50, 90, 99]
+
+profiler = None
+
+
+def enable():
+    global profiler
+    profiler = Profiler()
+    return profiler
+
+
+def endpoint(url):
+    # the path of the url without the ids of the courses and of the files
+    path = urlparse(url).path
+    if path.startswith("/documents/"):
+        return "/documents/"
+    return re.sub(r"^/web/[^/]+/", "/web/*/", path)
+
+
+def percentile(values, perc):
+    # values must be sorted
+    if not values:
+        return 0
+    index = min(len(values) - 1, int(round(perc / 100 * (len(values) - 1))))
+    return values[index]
+
+
+class Endpoint:
+    def __init__(self):
+        self.latencies = []
+        self.bytes = 0
+        self.errors = 0
+        self.statuses = dict()
+
+
+class Profiler:
+    # timings of the requests, of the downloaded files and of the phases of
+    # the run, filled by many threads
+    def __init__(self):
+        self.start = time.time()
+        self.endpoints = dict()
+        self.phases = dict()
+        self.files = []
+        self.file_count = 0
+        self.file_bytes = 0
+        self.lock = threading.Lock()
+
+    def request(self, phase, method, url, status, seconds, size):
+        key = (phase, method, endpoint(url))
+        with self.lock:
+            stats = self.endpoints.get(key)
+            if stats is None:
+                stats = self.endpoints[key] = Endpoint()
+            stats.latencies.append(seconds)
+            stats.bytes += size
+            stats.statuses[status] = stats.statuses.get(status, 0) + 1
+            if status >= 400:
+                stats.errors += 1
+
+    def file(self, path, size, seconds):
+        with self.lock:
+            self.file_count += 1
+            self.file_bytes += size
+            entry = (seconds, size, path)
+            if len(self.files) < SLOWEST_FILES:
+                heapq.heappush(self.files, entry)
+            else:
+                heapq.heappushpop(self.files, entry)
+
+    def add_phase(self, name, seconds):
+        with self.lock:
+            count, total = self.phases.get(name, (0, 0))
+            self.phases[name] = (count + 1, total + seconds)
+
+    def summary(self):
+        with self.lock:
+            endpoints = []
+            for (phase, method, name), stats in sorted(self.endpoints.items()):
+                latencies = sorted(stats.latencies)
+                entry = {
+                    "phase": phase,
+                    "method": method,
+                    "endpoint": name,
+                    "count": len(latencies),
+                    "errors": stats.errors,
+                    "bytes": stats.bytes,
+                    "statuses": {
+                        str(status): count
+                        for status, count in sorted(stats.statuses.items())
+                    },
+                    "total_s": round(sum(latencies), 3),
+                    "max_ms": round(latencies[-1] * 1000, 1),
+                }
+                for perc in PERCENTILES:
+                    entry["p%d_ms" % perc] = round(
+                        percentile(latencies, perc) * 1000, 1)
+                endpoints.append(entry)
+            return {
+                "started": self.start,
+                "elapsed_s": round(time.time() - self.start, 3),
+                "phases": {
+                    name: {
+                        "count": count,
+                        "wall_s": round(total, 3)
+                    }
+                    for name, (count, total) in self.phases.items()
+                },
+                "files": {
+                    "count": self.file_count,
+                    "bytes": self.file_bytes
+                },
+                "endpoints": endpoints,
+                "slowest_files": [{
+                    "path": path,
+                    "bytes": size,
+                    "seconds": round(seconds, 3)
+                } for seconds, size, path in sorted(self.files, reverse=True)],
+            }
+
+    def write_report(self, path):
+        # CSV if the path ends with .csv, JSON otherwise
+        summary = self.summary()
+        if not path.lower().endswith(".csv"):
+            _write_atomic(path, json.dumps(summary, indent=2) + "\n")
+            return
+        columns = ["section", "name", "count", "errors", "bytes", "total_s"
+                   ] + ["p%d_ms" % perc for perc in PERCENTILES] + ["max_ms"]
+        rows = []
+        for entry in summary["endpoints"]:
+            rows.append(
+                dict(entry,
+                     section="endpoint",
+                     name="%s %s %s" %
+                     (entry["phase"], entry["method"], entry["endpoint"])))
+        for name, phase in summary["phases"].items():
+            rows.append({
+                "section": "phase",
+                "name": name,
+                "count": phase["count"],
+                "total_s": phase["wall_s"]
+            })
+        for f in summary["slowest_files"]:
+            rows.append({
+                "section": "file",
+                "name": f["path"],
+                "count": 1,
+                "bytes": f["bytes"],
+                "total_s": f["seconds"]
+            })
+        with _open_atomic(path) as f:
+            writer = csv.DictWriter(f, columns, extrasaction="ignore")
+            writer.writeheader()
+            writer.writerows(rows)
+
+    def write_prometheus(self, path):
+        # text exposition format, for the textfile collector of the node
+        # exporter
+        summary = self.summary()
+        lines = [
+            "# HELP beep_downloader_request_duration_seconds Time to the "
+            "response headers.",
+            "# TYPE beep_downloader_request_duration_seconds summary",
+        ]
+        for entry in summary["endpoints"]:
+            labels = 'phase="%s",method="%s",endpoint="%s"' % (
+                entry["phase"], entry["method"], entry["endpoint"])
+            for perc in PERCENTILES:
+                lines.append(
+                    'beep_downloader_request_duration_seconds{%s,quantile='
+                    '"%s"} %f' % (labels, perc / 100,
+                                  entry["p%d_ms" % perc] / 1000))
+            lines.append("beep_downloader_request_duration_seconds_sum{%s} %f"
+                         % (labels, entry["total_s"]))
+            lines.append(
+                "beep_downloader_request_duration_seconds_count{%s} %d" %
+                (labels, entry["count"]))
+        for name, help, key in [
+            ("request_errors_total", "Responses with status >= 400.",
+             "errors"),
+            ("response_bytes_total", "Content-Length of the responses.",
+             "bytes"),
+        ]:
+            lines.append("# HELP beep_downloader_%s %s" % (name, help))
+            lines.append("# TYPE beep_downloader_%s counter" % name)
+            for entry in summary["endpoints"]:
+                lines.append(
+                    'beep_downloader_%s{phase="%s",method="%s",endpoint="%s"}'
+                    ' %d' % (name, entry["phase"], entry["method"],
+                             entry["endpoint"], entry[key]))
+        lines.append("# HELP beep_downloader_phase_seconds Wall time of the "
+                     "phases of the last run.")
+        lines.append("# TYPE beep_downloader_phase_seconds gauge")
+        for name, phase in summary["phases"].items():
+            lines.append('beep_downloader_phase_seconds{phase="%s"} %f' %
+                         (name, phase["wall_s"]))
+        for name, help, value in [
+            ("files_downloaded", "Files downloaded by the last run.",
+             summary["files"]["count"]),
+            ("bytes_downloaded", "Bytes downloaded by the last run.",
+             summary["files"]["bytes"]),
+            ("last_run_timestamp_seconds", "When the last run started.",
+             summary["started"]),
+            ("last_run_duration_seconds", "Wall time of the last run.",
+             summary["elapsed_s"]),
+        ]:
+            lines.append("# HELP beep_downloader_%s %s" % (name, help))
+            lines.append("# TYPE beep_downloader_%s gauge" % name)
+            lines.append("beep_downloader_%s %s" % (name, value))
+        _write_atomic(path, "\n".join(lines) + "\n")
+
+
+@contextlib.contextmanager
+def _open_atomic(path):
+    # the readers never see a half written file
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", newline="") as f:
+        yield f
+    os.replace(tmp_path, path)
+
+
+def _write_atomic(path, content):
+    with _open_atomic(path) as f:
+        f.write(content)
+
+
+def _response_hook(phase):
+    def hook(res, *args, **kwargs):
+        if profiler is not None:
+            try:
+                size = int(res.headers.get("Content-Length", 0))
+            except ValueError:
+                size = 0
+            profiler.request(phase, res.request.method, res.url,
+                             res.status_code, res.elapsed.total_seconds(),
+                             size)
+
+    return hook
+
+
+def instrument(session, phase):
+    # records every response of a requests session
+    if profiler is not None:
+        session.hooks["response"].append(_response_hook(phase))
+    return session
+
+
+def request(phase, method, url, status, seconds, size):
+    if profiler is not None:
+        profiler.request(phase, method, url, status, seconds, size)
+
+
+def file(path, size, seconds):
+    if profiler is not None:
+        profiler.file(path, size, seconds)
+
+
+@contextlib.contextmanager
+def phase(name):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        if profiler is not None:
+            profiler.add_phase(name, time.monotonic() - start)
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import re
 import shutil
 
 
@@ -13,3 +14,26 @@ def format_size(num_bytes):
     if num_bytes < 1024**4:
         return "%.1fGB" % (num_bytes / 1024**3)
     return "%.1fTB" % (num_bytes / 1024**4)
+
+
+def format_duration(seconds):
+    for unit, length in (("d", 86400), ("h", 3600), ("m", 60)):
+        if seconds >= length and seconds % length == 0:
+            return "%d%s" % (seconds // length, unit)
+    return "%ds" % seconds
+
+
+def parse_size(size):
+    units = {"": 1, "k": 1024, "m": 1024**2, "g": 1024**3, "t": 1024**4}
+    match = re.match(r"^\s*([\d.]+)\s*([kmgt]?)b?\s*$", size.lower())
+    if not match:
+        raise ValueError("Invalid size: %s" % size)
+    return int(float(match.group(1)) * units[match.group(2)])
+
+
+def parse_duration(duration):
+    units = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800}
+    match = re.match(r"^\s*([\d.]+)\s*([smhdw]?)\s*$", duration.lower())
+    if not match:
+        raise ValueError("Invalid duration: %s" % duration)
+    return float(match.group(1)) * units[match.group(2)]
@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+
+import json
+import os
+import os.path
+import random
+import signal
+import threading
+import time
+import traceback
+from colorama import Fore, Style
+
+from beep_downloader.remote import CrawlCache
+
+# a course is crawled again after this fraction of the time passed since its
+# last change: a course changed today is crawled at every sync, one quiet
+# for a month every three days
+ACTIVITY_FACTOR = 0.1
+# the courses quiet for a long time are still crawled this often
+ARCHIVED_MAX_AGE = 7 * 24 * 3600
+
+
+def last_change(site):
+    # newest modifiedDate of the files of a crawled course, in seconds
+    newest = 0
+    stack = [site]
+    while stack:
+        folder = stack.pop()
+        for f in folder["files"]:
+            newest = max(newest, f.modifiedDate or 0)
+        stack.extend(folder["folders"].values())
+    # the API dates are in milliseconds, the dates of the pages in seconds
+    return newest / 1000 if newest > 1e11 else newest
+
+
+class ActivityCache(CrawlCache):
+    # the structure of the previous sync, kept in memory. The courses changed
+    # recently are crawled at every sync, the others less often the longer
+    # they have been quiet
+    def __init__(self,
+                 structure,
+                 max_age=ARCHIVED_MAX_AGE,
+                 incremental=False,
+                 filters=None):
+        super().__init__(structure, max_age, incremental, filters)
+        now = time.time()
+        self.ages = {
+            groupId:
+            min(max_age, ACTIVITY_FACTOR * max(0, now - last_change(site)))
+            for groupId, site in self.structure.items()
+        }
+
+    def site_max_age(self, groupId):
+        return self.ages.get(groupId, 0)
+
+    def due(self, now=None):
+        # number of cached courses that the next crawl will fetch again
+        now = now or time.time()
+        return sum(1 for groupId, site in self.structure.items()
+                   if now - site.get("crawledAt", 0) >= self.ages[groupId])
+
+
+class Status:
+    # state of the watcher for the monitoring, a JSON file rewritten
+    # atomically at every change
+    def __init__(self, path):
+        self.path = path
+        self.state = {
+            "pid": os.getpid(),
+            "state": "starting",
+            "syncs": 0,
+            "failures": 0,
+            "last_start": None,
+            "last_sync": None,
+            "last_error": None,
+            "next_sync": None,
+        }
+
+    def update(self, **changes):
+        self.state.update(changes)
+        if self.path is None:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(json.dumps(self.state, indent=2) + "\n")
+        os.replace(tmp_path, self.path)
+
+
+def watch(sync, interval, jitter, status):
+    # runs sync every interval seconds, give or take jitter so that many
+    # watchers do not hit BeeP at the same time. sync returns a dict of
+    # results for the status. SIGUSR1 starts a sync right away, SIGTERM stops
+    # after the current one
+    wakeup = threading.Event()
+    stopping = threading.Event()
+
+    def sync_now(*args):
+        wakeup.set()
+
+    def stop(*args):
+        stopping.set()
+        wakeup.set()
+
+    signal.signal(signal.SIGUSR1, sync_now)
+    signal.signal(signal.SIGTERM, stop)
+    while not stopping.is_set():
+        start = time.time()
+        status.update(state="syncing", last_start=start, next_sync=None)
+        try:
+            result = sync()
+        except Exception as e:
+            traceback.print_exc()
+            print(Style.BRIGHT + Fore.RED + "Sync failed: %s" % e)
+            status.update(failures=status.state["failures"] + 1,
+                          last_error="%s: %s" % (type(e).__name__, e))
+        else:
+            status.update(syncs=status.state["syncs"] + 1,
+                          last_sync=time.time(),
+                          last_duration=round(time.time() - start, 1),
+                          last_error=None,
+                          **result)
+        next_sync = start + interval + random.uniform(-jitter, jitter)
+        status.update(state="idle", next_sync=next_sync)
+        if not stopping.is_set():
+            print(Style.BRIGHT + Fore.LIGHTCYAN_EX + "Next sync at %s" %
+                  time.strftime("%Y-%m-%d %H:%M:%S",
+                                time.localtime(next_sync)))
+        wakeup.wait(max(0, next_sync - time.time()))
+        wakeup.clear()
+    status.update(state="stopped", next_sync=None)
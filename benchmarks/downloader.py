@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# Runs beep-downloader against a local server, like the fake BeeP, instead of
+# BeeP and aunicalogin. The downloader itself has no way to change its
+# servers, so that the credentials are never sent anywhere else: the URLs are
+# replaced in its modules before it starts.
+#
+#   python3 benchmarks/downloader.py http://127.0.0.1:8080 --person-code ...
+
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from beep_downloader import login
+from beep_downloader.__main__ import main
+from beep_downloader.remote import json as remote_json
+from beep_downloader.remote import scraper
+
+
+def use_server(base_url):
+    # every URL of the downloader is built at import from one of these two
+    servers = [login.BEEP_URL, login.AUNICALOGIN_URL]
+    for module in (login, remote_json, scraper):
+        for name, value in list(vars(module).items()):
+            if not name.endswith("_URL") or not isinstance(value, str):
+                continue
+            for server in servers:
+                if value.startswith(server):
+                    setattr(module, name, base_url + value[len(server):])
+
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.exit("usage: %s base_url [beep-downloader arguments]" %
+                 sys.argv[0])
+    use_server(sys.argv.pop(1).rstrip("/"))
+    sys.exit(main())
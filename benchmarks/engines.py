@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+# Runs the download engines head to head: every engine downloads the same
+# tree from a new fake BeeP, with the same arguments after --, and the reports
+# of benchmarks/run.py are printed side by side as JSON.
+#
+#   python3 benchmarks/engines.py --sites 10 --latency 0.05 -- --json-api
+#   python3 benchmarks/engines.py --engines threads asyncio --drop-rate 0.05
+
+import argparse
+import json
+import os.path
+import shutil
+import sys
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fakebeep import add_arguments
+from run import run
+
+ENGINES = ["threads", "asyncio", "aria2"]
+# the fields of the reports compared
+FIELDS = [
+    "exit_code", "elapsed", "files", "files_per_sec", "mb_per_sec",
+    "requests", "peak_rss_mb"
+]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Compare the download engines against a fake BeeP")
+    add_arguments(parser)
+    parser.add_argument("--engines",
+                        nargs="+",
+                        choices=ENGINES,
+                        default=ENGINES,
+                        help="Engines to run, aria2 is skipped without "
+                        "aria2c")
+    parser.add_argument("--output", help="Also write the report to this file")
+    parser.add_argument("downloader_args",
+                        nargs=argparse.REMAINDER,
+                        help="Arguments of beep-downloader, after --")
+    args = parser.parse_args()
+    if args.downloader_args[:1] == ["--"]:
+        args.downloader_args = args.downloader_args[1:]
+    return args
+
+
+def main():
+    args = parse_args()
+    report = {"downloader_args": args.downloader_args}
+    for engine in args.engines:
+        if engine == "aria2" and shutil.which("aria2c") is None:
+            report[engine] = "aria2c not found"
+            continue
+        result = run(args, args.downloader_args + ["--engine", engine])
+        report.setdefault("tree", result["tree"])
+        report[engine] = {field: result[field] for field in FIELDS}
+        if "log_tail" in result:
+            report[engine]["log_tail"] = result["log_tail"]
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    failed = any(
+        isinstance(report[engine], dict) and report[engine]["exit_code"] != 0
+        for engine in args.engines)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
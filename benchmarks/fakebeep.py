@@ -0,0 +1,590 @@
+#!/usr/bin/env python3
+# A local fake of BeeP for the benchmarks: the JSONWS api, the document
+# library pages read by the scraper, the SSO login with its redirects and the
+# /documents/ downloads, on a synthetic tree of courses. Run the downloader
+# against it with benchmarks/downloader.py.
+#
+#   python3 benchmarks/fakebeep.py --port 8080 --sites 10 --latency 0.05
+
+import argparse
+import base64
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from email.utils import formatdate, parsedate_to_datetime
+from html import escape
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlparse, parse_qs, unquote
+
+LOGIN_PATH = "/aunicalogin/aunicalogin/controller/IdentificazioneUnica.do"
+SSO_PATH = "/Shibboleth.sso/SAML2/POST"
+HOME_PATH = "/polimi/login"
+JSONWS_PATH = "/api/secure/jsonws/"
+# courses in a page of the course list
+COURSES_PAGE_SIZE = 20
+# bytes of the pattern that the content of a file repeats
+BLOCK_SIZE = 64 * 1024
+EXTENSIONS = ["pdf", "pdf", "pdf", "zip", "pptx", "mp4"]
+
+
+def add_arguments(parser):
+    parser.add_argument("--sites", type=int, default=8, help="Courses")
+    parser.add_argument("--depth",
+                        type=int,
+                        default=2,
+                        help="Levels of folders under a course")
+    parser.add_argument("--fanout",
+                        type=int,
+                        default=3,
+                        help="Subfolders of a folder")
+    parser.add_argument("--files",
+                        type=int,
+                        default=10,
+                        help="Files in a folder")
+    parser.add_argument("--file-size",
+                        type=int,
+                        default=256 * 1024,
+                        help="Median size of a file, in bytes")
+    parser.add_argument("--size-spread",
+                        type=float,
+                        default=1.0,
+                        help="Spread of the lognormal file sizes, 0 for "
+                        "files all of the same size")
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.02,
+                        help="Seconds before every response")
+    parser.add_argument("--rate",
+                        type=int,
+                        default=0,
+                        help="Bytes per second of a single download, 0 for "
+                        "no limit")
+    parser.add_argument("--page-size",
+                        type=int,
+                        default=500,
+                        help="Most entries in a page of the scraped folders")
+    parser.add_argument("--folder-page-size",
+                        type=int,
+                        default=20,
+                        help="Most subfolders in a page of the scraped "
+                        "folders")
+    parser.add_argument("--session-ttl",
+                        type=float,
+                        default=0,
+                        help="Seconds a session lasts, 0 for no expiry")
+    parser.add_argument("--error-rate",
+                        type=float,
+                        default=0,
+                        help="Fraction of the downloads answered with a 500")
+    parser.add_argument("--busy-rate",
+                        type=float,
+                        default=0,
+                        help="Fraction of the downloads answered with a 429")
+    parser.add_argument("--drop-rate",
+                        type=float,
+                        default=0,
+                        help="Fraction of the downloads closed halfway")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--username", default="bench")
+    parser.add_argument("--password", default="bench")
+
+
+class Tree:
+    # the synthetic courses, folders and files
+    def __init__(self, config):
+        rnd = random.Random(config.seed)
+        self.sites = []
+        # (groupId, folderId) -> files, subfolders
+        self.files = dict()
+        self.folders = dict()
+        # (groupId, folderId, title) -> file, the scraper does not know the
+        # extensions and asks for the titles without them
+        self.documents = dict()
+        self.stems = dict()
+        self.next_id = 1000
+        for num in range(config.sites):
+            groupId = 10000 + num
+            self.sites.append({
+                "groupId": groupId,
+                "name": "Corso %d" % num,
+                "friendlyURL": "/corso-%d" % groupId,
+                "site": True
+            })
+            self._add_folder(rnd, config, groupId, 0, 0)
+
+    def _new_id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def _add_folder(self, rnd, config, groupId, folderId, depth):
+        files = []
+        for num in range(config.files):
+            extension = rnd.choice(EXTENSIONS)
+            size = config.file_size
+            if config.size_spread:
+                size = int(rnd.lognormvariate(0, config.size_spread) * size)
+            f = {
+                "fileEntryId": self._new_id(),
+                "groupId": groupId,
+                "folderId": folderId,
+                "title": "Lezione %d-%d.%s" % (folderId, num, extension),
+                "extension": extension,
+                "size": max(1, size),
+                "modifiedDate": 1600000000000 + rnd.randint(0, 10**10)
+            }
+            files.append(f)
+            self.documents[(groupId, folderId, f["title"])] = f
+            self.stems[(groupId, folderId, f["title"].rsplit(".", 1)[0])] = f
+        subfolders = []
+        if depth < config.depth:
+            for num in range(config.fanout):
+                subfolder = {
+                    "folderId": self._new_id(),
+                    "groupId": groupId,
+                    "parentFolderId": folderId,
+                    "name": "Cartella %d" % num,
+                    "lastPostDate": 1600000000000,
+                    "modifiedDate": 1600000000000
+                }
+                subfolders.append(subfolder)
+                self._add_folder(rnd, config, groupId,
+                                 subfolder["folderId"], depth + 1)
+        self.files[(groupId, folderId)] = files
+        self.folders[(groupId, folderId)] = subfolders
+
+    def count(self):
+        return len(self.documents), sum(f["size"]
+                                        for f in self.documents.values())
+
+
+class Stats:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.first_download = None
+        self.counts = dict()
+
+    def add(self, name, value=1):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def download_started(self):
+        with self.lock:
+            if self.first_download is None:
+                self.first_download = time.time()
+
+    def get(self, name):
+        with self.lock:
+            return self.counts.get(name, 0)
+
+    def to_json(self):
+        with self.lock:
+            return dict(self.counts, first_download=self.first_download)
+
+
+def file_block(fileEntryId):
+    seed = hashlib.sha256(str(fileEntryId).encode()).digest()
+    return (seed * (BLOCK_SIZE // len(seed)))[:BLOCK_SIZE]
+
+
+def html_page(body, logged_in=True):
+    logout = '<a href="/c/portal/logout">Esci</a>' if logged_in else ""
+    return ('<html><head><title>BeeP</title></head><body>%s'
+            '<div id="column-1">%s</div></body></html>' % (logout, body))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    wbufsize = 64 * 1024
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def fake(self):
+        return self.server.fake
+
+    def reply(self, body, status=200, headers=None, content_type=None):
+        if isinstance(body, str):
+            body = body.encode("latin", "replace")
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(body)))
+        if content_type:
+            self.send_header("Content-Type", content_type)
+        for name, value in (headers or dict()).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def reply_json(self, obj, status=200):
+        self.reply(json.dumps(obj), status, content_type="application/json")
+
+    def redirect(self, location, headers=None):
+        headers = dict(headers or dict(), Location=location)
+        self.reply(b"", 302, headers)
+
+    def form(self):
+        length = int(self.headers.get("Content-Length", 0))
+        body = self.rfile.read(length).decode("latin")
+        return {key: values[0] for key, values in parse_qs(body).items()}
+
+    def query(self):
+        return {
+            key: values[0]
+            for key, values in parse_qs(urlparse(self.path).query).items()
+        }
+
+    def session(self):
+        # True if the request carries a valid session cookie
+        match = re.search(r"JSESSIONID=([\w-]+)", self.headers.get("Cookie",
+                                                                   ""))
+        if match is None:
+            return False
+        return self.fake.session_valid(match.group(1))
+
+    def basic_auth(self):
+        auth = self.headers.get("Authorization", "")
+        if not auth.startswith("Basic "):
+            return False
+        credentials = base64.b64decode(auth[6:]).decode()
+        return credentials == "%s:%s" % (self.fake.config.username,
+                                         self.fake.config.password)
+
+    def do_GET(self):
+        self.handle_request("GET")
+
+    def do_POST(self):
+        self.handle_request("POST")
+
+    def handle_request(self, method):
+        stats = self.fake.stats
+        stats.add("requests")
+        if self.fake.config.latency:
+            time.sleep(self.fake.config.latency)
+        path = urlparse(self.path).path
+        if path.startswith(JSONWS_PATH):
+            stats.add("jsonws")
+            return self.jsonws(method, path[len(JSONWS_PATH) - 1:])
+        if path == LOGIN_PATH:
+            stats.add("login")
+            return self.aunicalogin()
+        if path == SSO_PATH:
+            stats.add("login")
+            return self.sso()
+        if path == HOME_PATH:
+            stats.add("pages")
+            return self.home()
+        if path.startswith("/documents/"):
+            stats.add("documents")
+            return self.document(path)
+        if path.startswith("/web/"):
+            stats.add("pages")
+            return self.course_page(method, path)
+        self.reply("Not Found", 404)
+
+    def jsonws(self, method, command):
+        if not self.basic_auth():
+            return self.reply_json(
+                {
+                    "exception": "Authenticated access required",
+                    "throwable": "java.lang.SecurityException"
+                }, 403)
+        if method == "POST" and command == "/invoke":
+            commands = json.loads(self.form()["cmd"])
+            results = []
+            for entry in commands:
+                (name, params), = entry.items()
+                params = {key: str(value) for key, value in params.items()}
+                results.append(self.run_command(name, params))
+            return self.reply_json(results)
+        return self.reply_json(self.run_command(command, self.query()))
+
+    def run_command(self, name, params):
+        tree = self.fake.tree
+        if name == "/group/get-user-sites":
+            return tree.sites
+        if name == "/dlapp/get-file-entries":
+            key = (int(params["repositoryId"]), int(params["folderId"]))
+            return tree.files.get(key, [])
+        if name == "/dlapp/get-folders":
+            key = (int(params["repositoryId"]), int(params["parentFolderId"]))
+            return tree.folders.get(key, [])
+        return {"exception": "No JSON web service action for %s" % name}
+
+    def aunicalogin(self):
+        data = self.form()
+        config = self.fake.config
+        if data.get("login") != config.username or \
+                data.get("password") != config.password:
+            return self.reply(
+                html_page(
+                    '<div class="jaf-message-fragment">Credenziali non '
+                    'valide</div>', False))
+        token = self.fake.new_token()
+        inputs = "".join(
+            '<input type="hidden" name="%s" value="%s"/>' % (name, value)
+            for name, value in [("RelayState", "ss:mem:" + token[:8]),
+                                ("SAMLResponse", token)])
+        self.reply(
+            html_page(
+                '<form method="post" action="%s">%s</form>' %
+                (SSO_PATH, inputs), False))
+
+    def sso(self):
+        data = self.form()
+        session = self.fake.redeem_token(data.get("SAMLResponse"))
+        if session is None:
+            return self.reply("Invalid SAML response", 403)
+        self.redirect(HOME_PATH,
+                      {"Set-Cookie": "JSESSIONID=%s; Path=/" % session})
+
+    def home(self):
+        if not self.session():
+            return self.reply(html_page("<p>Accedi</p>", False))
+        page = int(self.query().get("page", 0))
+        sites = self.fake.tree.sites
+        shown = sites[page * COURSES_PAGE_SIZE:(page + 1) * COURSES_PAGE_SIZE]
+        cells = "".join(
+            '<td><a href="%s/web%s/home?groupId=%d"><strong>%s</strong></a>'
+            '</td>' % (self.fake.base_url, site["friendlyURL"],
+                       site["groupId"], escape(site["name"]))
+            for site in shown)
+        body = "<table><tr>%s</tr></table>" % cells
+        if (page + 1) * COURSES_PAGE_SIZE < len(sites):
+            body += '<a class="next" href="%s%s?page=%d">Avanti</a>' % (
+                self.fake.base_url, HOME_PATH, page + 1)
+        self.reply(html_page(body))
+
+    def course_page(self, method, path):
+        if not self.session():
+            return self.redirect(self.fake.base_url + HOME_PATH)
+        match = re.match(r"/web/corso-(\d+)/(home|documenti-e-media)$", path)
+        if match is None:
+            return self.reply("Not Found", 404)
+        groupId = int(match.group(1))
+        if match.group(2) == "home" or method != "POST":
+            return self.reply(html_page("<p>Home del corso</p>"))
+        data = self.form()
+        folderId = int(self.query().get("_20_folderId", 0))
+        self.reply(self.folder_page(groupId, folderId, data))
+
+    def folder_page(self, groupId, folderId, data):
+        tree = self.fake.tree
+        rows = []
+        controls = []
+        subfolders = tree.folders.get((groupId, folderId), [])
+        files = tree.files.get((groupId, folderId), [])
+        config = self.fake.config
+        for items, prefix, css, page_size in [
+            (subfolders, "_20_folder", "folder-pagination",
+             config.folder_page_size),
+            (files, "_20_entry", "document-entries-pagination",
+             config.page_size)
+        ]:
+            start = int(data.get(prefix + "Start", 0))
+            end = min(int(data.get(prefix + "End", 0)), start + page_size)
+            shown = items[start:end]
+            if items and end > start:
+                controls.append(
+                    '<div class="taglib-page-iterator %s">Showing %d - %d of '
+                    '%s results</div>' %
+                    (css, start + 1, start + len(shown), "{:,}".format(
+                        len(items))))
+            if prefix == "_20_folder":
+                rows.extend(self.folder_row(groupId, f) for f in shown)
+            else:
+                rows.extend(self.file_row(f) for f in shown)
+        return html_page('<table class="taglib-search-iterator"><tbody>%s'
+                         '</tbody></table>%s' %
+                         ("".join(rows), "".join(controls)))
+
+    def folder_row(self, groupId, folder):
+        href = "%s/web/corso-%d/documenti-e-media?p_p_id=20&_20_folderId=%d" \
+            % (self.fake.base_url, groupId, folder["folderId"])
+        return ('<tr class="results-row" data-folder-id="%d" data-title="%s">'
+                '<td class="col-1"><a data-folder="true" href="%s">%s</a>'
+                '</td></tr>' % (folder["folderId"], escape(folder["name"]),
+                                escape(href), escape(folder["name"])))
+
+    def file_row(self, f):
+        title = escape(f["title"].rsplit(".", 1)[0])
+        date = time.strftime("%d/%m/%y %H.%M",
+                             time.localtime(f["modifiedDate"] // 1000))
+        return ('<tr class="results-row" data-title="%s"><td class="col-2">'
+                '<a data-file-entry-id="%d" href="#">%s</a></td>'
+                '<td class="col-3">%.1fk</td><td class="col-5">%s</td></tr>' %
+                (title, f["fileEntryId"], title, f["size"] / 1024, date))
+
+    def document(self, path):
+        if not self.session():
+            self.fake.stats.add("unauthenticated")
+            return self.redirect(self.fake.base_url + HOME_PATH)
+        parts = path.split("/", 4)
+        try:
+            key = (int(parts[2]), int(parts[3]), unquote(parts[4]))
+        except (IndexError, ValueError):
+            return self.reply("Not Found", 404)
+        f = self.fake.tree.documents.get(key) or self.fake.tree.stems.get(key)
+        if f is None:
+            return self.reply("Not Found", 404)
+        config = self.fake.config
+        rnd = random.random()
+        if rnd < config.busy_rate:
+            self.fake.stats.add("injected_busy")
+            return self.reply("Too Many Requests", 429, {"Retry-After": "1"})
+        if rnd < config.busy_rate + config.error_rate:
+            self.fake.stats.add("injected_errors")
+            return self.reply("Internal Server Error", 500)
+        self.send_file(f, rnd < config.busy_rate + config.error_rate +
+                       config.drop_rate)
+
+    def send_file(self, f, drop):
+        size = f["size"]
+        last_modified = formatdate(f["modifiedDate"] / 1000, usegmt=True)
+        etag = '"%d-%d"' % (f["fileEntryId"], f["modifiedDate"])
+        if self.headers.get("If-None-Match") == etag:
+            self.fake.stats.add("not_modified")
+            return self.reply(b"", 304, {"ETag": etag})
+        start, end, status = 0, size - 1, 200
+        match = re.match(r"bytes=(\d*)-(\d*)$", self.headers.get("Range", ""))
+        if match and self.range_valid(last_modified, etag):
+            if match.group(1):
+                start = int(match.group(1))
+                if match.group(2):
+                    end = min(end, int(match.group(2)))
+            else:
+                start = max(0, size - int(match.group(2)))
+            if start > end:
+                return self.reply(b"", 416,
+                                  {"Content-Range": "bytes */%d" % size})
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Disposition",
+                         'attachment; filename="%s"' % f["title"])
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", last_modified)
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range",
+                             "bytes %d-%d/%d" % (start, end, size))
+        self.end_headers()
+        self.fake.stats.download_started()
+        stop = end + 1
+        if drop:
+            self.fake.stats.add("injected_drops")
+            stop = start + (stop - start) // 2
+            self.close_connection = True
+        self.write_body(f, start, stop)
+        if not drop and start == 0 and stop == size:
+            self.fake.stats.add("files")
+
+    def range_valid(self, last_modified, etag):
+        if_range = self.headers.get("If-Range")
+        if if_range is None or if_range == etag:
+            return True
+        try:
+            return parsedate_to_datetime(if_range) >= \
+                parsedate_to_datetime(last_modified)
+        except (TypeError, ValueError):
+            return False
+
+    def write_body(self, f, start, stop):
+        block = file_block(f["fileEntryId"])
+        rate = self.fake.config.rate
+        began = time.monotonic()
+        position = start
+        while position < stop:
+            offset = position % BLOCK_SIZE
+            chunk = block[offset:offset + min(BLOCK_SIZE - offset,
+                                              stop - position)]
+            self.wfile.write(chunk)
+            position += len(chunk)
+            self.fake.stats.add("bytes", len(chunk))
+            if rate:
+                delay = (position - start) / rate - (time.monotonic() -
+                                                      began)
+                if delay > 0:
+                    time.sleep(delay)
+
+
+class FakeBeep:
+    def __init__(self, config, host="127.0.0.1", port=0):
+        self.config = config
+        self.tree = Tree(config)
+        self.stats = Stats()
+        self.tokens = set()
+        # session -> creation time
+        self.sessions = dict()
+        self.lock = threading.Lock()
+        self.server = ThreadingHTTPServer((host, port), Handler)
+        self.server.daemon_threads = True
+        self.server.fake = self
+        self.base_url = "http://%s:%d" % (host, self.server.server_port)
+        self.thread = None
+
+    def new_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens.add(token)
+        return token
+
+    def redeem_token(self, token):
+        with self.lock:
+            if token not in self.tokens:
+                return None
+            self.tokens.remove(token)
+            session = uuid.uuid4().hex
+            self.sessions[session] = time.monotonic()
+        self.stats.add("sessions")
+        return session
+
+    def session_valid(self, session):
+        with self.lock:
+            created = self.sessions.get(session)
+        if created is None:
+            return False
+        ttl = self.config.session_ttl
+        if ttl and time.monotonic() - created > ttl:
+            self.stats.add("expired")
+            return False
+        return True
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever,
+                                       daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake BeeP server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    add_arguments(parser)
+    config = parser.parse_args()
+    fake = FakeBeep(config, config.host, config.port)
+    files, size = fake.tree.count()
+    print("Serving %d courses, %d files (%d bytes) on %s" %
+          (len(fake.tree.sites), files, size, fake.base_url))
+    print("Run the downloader with: python3 benchmarks/downloader.py %s "
+          "--person-code %s --password %s" %
+          (fake.base_url, config.username, config.password))
+    try:
+        fake.server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    print(json.dumps(fake.stats.to_json()))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+# Times the planning of a synthetic account with many files: the planner
+# looks up every file in the files already downloaded by its id, against the
+# scan of the files of the cached folder that it used to do for every file.
+#
+#   python3 benchmarks/plan.py --files 100000
+
+import argparse
+import json
+import os.path
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from beep_downloader.remote.json import DownloadPlanner
+from beep_downloader.structure import FileEntry
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Planning time of a big account")
+    parser.add_argument("--files", type=int, default=100000)
+    parser.add_argument("--sites", type=int, default=20)
+    parser.add_argument("--files-per-folder", type=int, default=1000)
+    parser.add_argument("--changed",
+                        type=float,
+                        default=0.1,
+                        help="Fraction of the files changed since the last "
+                        "run")
+    parser.add_argument("--no-scan",
+                        action="store_true",
+                        help="Skip the quadratic scan, slow on big folders")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def build(args):
+    # the structure of the crawl and the files of the previous run, the
+    # files of a folder are all in a single level under the course
+    rnd = random.Random(args.seed)
+    structure = dict()
+    fileEntryId = 0
+    folderId = 1
+    files_per_site = args.files // args.sites
+    for groupId in range(1, args.sites + 1):
+        site = {"name": "Corso %d" % groupId, "files": [], "folders": dict()}
+        structure[groupId] = site
+        count = 0
+        while count < files_per_site:
+            files = []
+            for _ in range(min(args.files_per_folder,
+                               files_per_site - count)):
+                files.append(
+                    FileEntry(fileEntryId, groupId, folderId,
+                              "Lezione %d" % fileEntryId, "pdf",
+                              rnd.randint(10**4, 10**7),
+                              1600000000000 + fileEntryId))
+                fileEntryId += 1
+            site["folders"][folderId] = {
+                "folderId": folderId,
+                "name": "Cartella %d" % folderId,
+                "files": files,
+                "folders": dict()
+            }
+            count += len(files)
+            folderId += 1
+    return structure
+
+
+def previous_run(structure, changed, out_dir, seed):
+    # fileEntryId -> (modifiedDate, path) of the files of the previous run
+    rnd = random.Random(seed)
+    downloaded = dict()
+    for site in structure.values():
+        site_dir = os.path.join(out_dir, site["name"])
+        for folder in site["folders"].values():
+            folder_dir = os.path.join(site_dir, folder["name"])
+            for f in folder["files"]:
+                if rnd.random() < changed:
+                    continue
+                downloaded[f.fileEntryId] = (f.modifiedDate,
+                                             os.path.join(
+                                                 folder_dir,
+                                                 f.title + "." + f.extension))
+    return downloaded
+
+
+def plan_indexed(structure, downloaded, out_dir):
+    planner = DownloadPlanner(downloaded, out_dir, set())
+    planner.add_sites(structure)
+    return len(planner.to_download)
+
+
+def plan_scan(structure, downloaded, out_dir):
+    # the files of the previous run kept with their folders, every file is
+    # searched among the ones of its cached folder
+    cache = dict()
+    for groupId, site in structure.items():
+        cache[groupId] = {
+            "folders": {
+                folderId: {
+                    "files": [{
+                        "fileEntryId": f.fileEntryId,
+                        "modifiedDate": downloaded[f.fileEntryId][0]
+                    } for f in folder["files"] if f.fileEntryId in downloaded]
+                }
+                for folderId, folder in site["folders"].items()
+            }
+        }
+    count = 0
+    for groupId, site in structure.items():
+        for folderId, folder in site["folders"].items():
+            cached_files = cache[groupId]["folders"][folderId]["files"]
+            for f in folder["files"]:
+                cached = {}
+                for c in cached_files:
+                    if c.get("fileEntryId") == f.fileEntryId:
+                        cached = c
+                        break
+                if cached.get("modifiedDate") != f.modifiedDate:
+                    count += 1
+    return count
+
+
+def timed(function, *args):
+    start = time.perf_counter()
+    result = function(*args)
+    return result, round(time.perf_counter() - start, 3)
+
+
+def main():
+    args = parse_args()
+    out_dir = os.path.join(os.sep, "tmp", "beep")
+    structure = build(args)
+    downloaded = previous_run(structure, args.changed, out_dir, args.seed)
+    report = {"files": args.files, "files_per_folder": args.files_per_folder}
+    planned, seconds = timed(plan_indexed, structure, downloaded, out_dir)
+    report["indexed"] = {"planned": planned, "seconds": seconds}
+    if not args.no_scan:
+        planned, seconds = timed(plan_scan, structure, downloaded, out_dir)
+        report["scan"] = {"planned": planned, "seconds": seconds}
+        report["speedup"] = round(
+            seconds / max(report["indexed"]["seconds"], 0.001), 1)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,128 @@
+#!/usr/bin/env python3
+# Runs beep-downloader end to end (crawl, plan and download) against the fake
+# BeeP server and reports the throughput and the peak memory as JSON. The
+# arguments after -- are passed to beep-downloader.
+#
+#   python3 benchmarks/run.py --sites 20 --latency 0.05 -- --json-api
+#   python3 benchmarks/run.py --session-ttl 5 --drop-rate 0.05 -- --stream
+
+import argparse
+import json
+import os
+import os.path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(__file__))
+
+from fakebeep import FakeBeep, add_arguments
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Benchmark beep-downloader against a fake BeeP")
+    add_arguments(parser)
+    parser.add_argument("--output", help="Also write the report to this file")
+    parser.add_argument("--keep",
+                        action="store_true",
+                        help="Keep the downloaded files")
+    parser.add_argument("downloader_args",
+                        nargs=argparse.REMAINDER,
+                        help="Arguments of beep-downloader, after --")
+    args = parser.parse_args()
+    if args.downloader_args[:1] == ["--"]:
+        args.downloader_args = args.downloader_args[1:]
+    return args
+
+
+def count_files(out_dir):
+    files = 0
+    size = 0
+    for root, _, names in os.walk(out_dir):
+        for name in names:
+            if name.startswith("manifest.db") or name.endswith(".part"):
+                continue
+            files += 1
+            size += os.path.getsize(os.path.join(root, name))
+    return files, size
+
+
+def run(args, downloader_args, keep=False):
+    # runs the downloader against a new fake BeeP configured by args and
+    # returns the report
+    fake = FakeBeep(args).start()
+    total_files, total_size = fake.tree.count()
+    work_dir = tempfile.mkdtemp(prefix="beep-bench-")
+    out_dir = os.path.join(work_dir, "results")
+    env = dict(os.environ, XDG_CACHE_HOME=os.path.join(work_dir, "cache"))
+    command = [
+        sys.executable,
+        os.path.join(ROOT, "benchmarks", "downloader.py"), fake.base_url,
+        "--person-code", args.username, "--password", args.password,
+        "--out-dir", out_dir, "--progress", "quiet"
+    ] + downloader_args
+    log_path = os.path.join(work_dir, "output.log")
+    start = time.time()
+    with open(log_path, "w") as log:
+        child = subprocess.Popen(command, env=env, stdout=log, stderr=log)
+        # the usage of this downloader alone, many may run one after another
+        _, status, usage = os.wait4(child.pid, 0)
+    elapsed = time.time() - start
+    code = os.WEXITSTATUS(status) if os.WIFEXITED(status) else \
+        -os.WTERMSIG(status)
+    child.returncode = code
+    # ru_maxrss is in KB on Linux
+    peak_rss = usage.ru_maxrss * 1024
+    fake.stop()
+
+    stats = fake.stats.to_json()
+    files, size = count_files(out_dir)
+    first_download = stats.pop("first_download")
+    report = {
+        "command": command[3:],
+        "exit_code": code,
+        "tree": {
+            "sites": args.sites,
+            "files": total_files,
+            "bytes": total_size
+        },
+        "elapsed": round(elapsed, 3),
+        "crawl_elapsed":
+        round(first_download - start, 3) if first_download else None,
+        "requests": stats.get("requests", 0),
+        "requests_per_sec": round(stats.get("requests", 0) / elapsed, 1),
+        "files": files,
+        "files_per_sec": round(files / elapsed, 1),
+        "bytes": size,
+        "mb_per_sec": round(stats.get("bytes", 0) / 1024**2 / elapsed, 2),
+        "peak_rss_mb": round(peak_rss / 1024**2, 1),
+        "server": stats,
+    }
+    if code != 0 or files != total_files:
+        with open(log_path) as log:
+            report["log_tail"] = log.read()[-2000:]
+    if not keep:
+        shutil.rmtree(work_dir, ignore_errors=True)
+    else:
+        report["out_dir"] = out_dir
+    return report
+
+
+def main():
+    args = parse_args()
+    report = run(args, args.downloader_args, args.keep)
+    output = json.dumps(report, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    return 0 if report["exit_code"] == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+# Simulates the downloaders on a synthetic set of courses and compares the
+# total run time of the download schedules. Each file is a single transfer
+# that waits the request latency and then shares the bandwidth with the
+# other transfers, each of them limited to the speed of one connection.
+#
+#   python3 benchmarks/schedule.py --workers 10 --bandwidth 20M
+
+import argparse
+import os.path
+import random
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from beep_downloader.download import DownloadItem
+from beep_downloader.schedule import Schedule, POLICIES
+from beep_downloader.utils import parse_size, format_size
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Download schedule simulator")
+    parser.add_argument("--workers", type=int, default=10)
+    parser.add_argument("--bandwidth",
+                        type=parse_size,
+                        default="20M",
+                        help="Total bandwidth, in bytes per second")
+    parser.add_argument("--connection-rate",
+                        type=parse_size,
+                        default="4M",
+                        help="Speed of a single connection")
+    parser.add_argument("--latency",
+                        type=float,
+                        default=0.2,
+                        help="Seconds before the first byte of a file")
+    parser.add_argument("--sites", type=int, default=12)
+    parser.add_argument("--files",
+                        type=int,
+                        default=150,
+                        help="Average number of files of a course")
+    parser.add_argument("--videos",
+                        type=float,
+                        default=0.02,
+                        help="Fraction of the files that are videos")
+    parser.add_argument("--seed", type=int, default=1)
+    return parser.parse_args()
+
+
+def make_items(args):
+    # documents of about 1MB and a few videos of hundreds of MB, in crawl
+    # order: one course after the other
+    rnd = random.Random(args.seed)
+    items = []
+    for groupId in range(args.sites):
+        for _ in range(int(rnd.expovariate(1 / args.files)) + 1):
+            if rnd.random() < args.videos:
+                size = rnd.randint(100, 800) * 1024**2
+            else:
+                size = int(rnd.lognormvariate(13.8, 1.2))
+            fileEntryId = len(items)
+            items.append(
+                DownloadItem("", "f%d" % fileEntryId, fileEntryId, size, 0,
+                             groupId))
+    return items
+
+
+def simulate(items, schedule, args):
+    # returns the time each file was completed at
+    for item in items:
+        schedule.push(item)
+    now = 0
+    done = dict()
+    # [item, latency left, bytes left]
+    active = []
+    while schedule or active:
+        while schedule and len(active) < args.workers:
+            item = schedule.pop()
+            active.append([item, args.latency, item.size])
+        transferring = sum(1 for t in active if t[1] <= 0)
+        rate = min(args.connection_rate,
+                   args.bandwidth / max(1, transferring))
+        step = min(t[1] if t[1] > 0 else t[2] / rate for t in active)
+        now += step
+        for transfer in active:
+            if transfer[1] > 0:
+                # rounding errors must not leave a tiny latency behind
+                transfer[1] = max(0, transfer[1] - step - 1e-9)
+            else:
+                transfer[2] -= step * rate
+        for transfer in [t for t in active if t[1] <= 0 and t[2] <= 1]:
+            active.remove(transfer)
+            done[transfer[0].fileEntryId] = now
+    return done
+
+
+def main():
+    args = parse_args()
+    items = make_items(args)
+    total = sum(item.size for item in items)
+    print("%d files in %d courses, %s, %d workers, %s/s" %
+          (len(items), args.sites, format_size(total), args.workers,
+           format_size(args.bandwidth)))
+    print("%-12s %10s %12s %12s %12s" %
+          ("schedule", "total (s)", "mean file", "90% files", "mean course"))
+    for policy in POLICIES:
+        for fair in (False, True):
+            done = simulate(items, Schedule(policy, fair), args)
+            times = sorted(done.values())
+            # when each course is complete
+            courses = dict()
+            for item in items:
+                courses[item.groupId] = max(courses.get(item.groupId, 0),
+                                            done[item.fileEntryId])
+            print("%-12s %10.1f %12.1f %12.1f %12.1f" %
+                  (policy + (" fair" if fair else ""), times[-1],
+                   sum(times) / len(times), times[int(len(times) * 0.9)],
+                   sum(courses.values()) / len(courses)))
+
+
+if __name__ == "__main__":
+    main()
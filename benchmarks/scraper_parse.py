@@ -0,0 +1,139 @@
+#!/usr/bin/env python3
+# Times the parsing of the folder pages saved in tests/fixtures/scraper, a
+# folder with 2,000 files and 45 subfolders, with:
+# - bs4: BeautifulSoup with html.parser, what the scraper used to do;
+# - lxml: parse_folder in the calling thread;
+# - pool per crawl: parse_folder in a pool of processes spawned for the
+#   crawl, like every crawl used to do;
+# - scraper: the FolderParser of the scraper, small pages in the calling
+#   thread and big ones in a pool of processes already started.
+#
+#   python3 benchmarks/scraper_parse.py --repeat 10
+
+import argparse
+import datetime
+import glob
+import gzip
+import json
+import multiprocessing
+import os.path
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from beep_downloader.remote.scraper import FolderParser, parse_folder
+
+FIXTURES = os.path.join(os.path.dirname(__file__), "..", "tests", "fixtures",
+                        "scraper")
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Parsing time of the scraped folder pages")
+    parser.add_argument("--repeat",
+                        type=int,
+                        default=10,
+                        help="Times every page is parsed")
+    return parser.parse_args()
+
+
+def load_pages():
+    pages = []
+    for path in sorted(glob.glob(os.path.join(FIXTURES, "*.html.gz"))):
+        with gzip.open(path) as f:
+            pages.append(f.read().decode("latin"))
+    return pages
+
+
+def parse_bs4(content, group_id, folder_id):
+    # the rows read like the scraper did before lxml, returns the ids of the
+    # files and of the subfolders
+    content = BeautifulSoup(content, "html.parser")
+    files = []
+    subfolders = []
+    for tr in content.find_all("tr", class_="results-row"):
+        if "data-folder-id" in tr.attrs:
+            subfolders.append(int(tr["data-folder-id"]))
+        elif "data-title" in tr.attrs:
+            tr.find("td", class_="col-3").get_text()
+            modified_date = tr.find("td", class_="col-5").get_text().strip()
+            datetime.datetime.strptime(modified_date.replace(".", ":"),
+                                       "%d/%m/%y %H:%M")
+            files.append(int(tr.find("a")["data-file-entry-id"]))
+    return files, subfolders
+
+
+def parse_lxml(content, group_id, folder_id):
+    files, subfolders, _, _ = parse_folder(content, group_id, folder_id)
+    return [f.fileEntryId for f in files], [f[0] for f in subfolders]
+
+
+def run_bs4(pages, repeat):
+    return [parse_bs4(page, 1, 1) for _ in range(repeat) for page in pages]
+
+
+def run_lxml(pages, repeat):
+    return [parse_lxml(page, 1, 1) for _ in range(repeat) for page in pages]
+
+
+def run_pool_per_crawl(pages, repeat):
+    # every repetition is a crawl with its own pool
+    results = []
+    for _ in range(repeat):
+        with ProcessPoolExecutor(mp_context=multiprocessing.get_context(
+                "spawn")) as parsers:
+            results.extend(
+                parsers.submit(parse_lxml, page, 1, 1).result()
+                for page in pages)
+    return results
+
+
+def run_scraper(pages, repeat):
+    parser = FolderParser()
+    # the processes are already running from the previous crawls
+    parser.parse(max(pages, key=len), 1, 1)
+    results = []
+    try:
+        for _ in range(repeat):
+            for page in pages:
+                files, subfolders, _, _ = parser.parse(page, 1, 1)
+                results.append(([f.fileEntryId for f in files],
+                                [f[0] for f in subfolders]))
+    finally:
+        parser.shutdown()
+    return results
+
+
+MODES = [("bs4", run_bs4), ("lxml", run_lxml),
+         ("pool per crawl", run_pool_per_crawl), ("scraper", run_scraper)]
+
+
+def main():
+    args = parse_args()
+    pages = load_pages()
+    report = {
+        "pages": len(pages) * args.repeat,
+        "bytes": sum(map(len, pages)) * args.repeat
+    }
+    expected = None
+    for name, run in MODES:
+        start = time.perf_counter()
+        results = run(pages, args.repeat)
+        elapsed = time.perf_counter() - start
+        if expected is None:
+            expected = results
+        elif results != expected:
+            sys.exit("%s parsed different entries" % name)
+        report[name] = {
+            "seconds": round(elapsed, 3),
+            "pages_per_sec": round(len(results) / elapsed, 1)
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
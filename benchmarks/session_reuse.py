@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+# Measures the files per second of many small downloads from a local HTTP/1.1
+# server with one session kept alive by every downloader thread, against a
+# new session, and so a new connection, for every file like the downloaders
+# used to do. Over TLS the handshake of every new connection costs even more.
+#
+#   python3 benchmarks/session_reuse.py --files 2000 --threads 8
+
+import argparse
+import json
+import os.path
+import shutil
+import socket
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from beep_downloader.download import _do_download
+from beep_downloader.download_ui import DownloadUI
+
+MODES = ["per-file", "reused"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Files per second with and without the session reuse")
+    parser.add_argument("--files", type=int, default=2000)
+    parser.add_argument("--file-size", type=int, default=20000)
+    parser.add_argument("--threads", type=int, default=8)
+    return parser.parse_args()
+
+
+class Server(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, file_size):
+        super().__init__(("127.0.0.1", 0), Handler)
+        self.body = b"x" * file_size
+        self.connections = 0
+        self.lock = threading.Lock()
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def setup(self):
+        super().setup()
+        # the headers and the body go out in separate writes
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        with self.server.lock:
+            self.server.connections += 1
+
+    def do_GET(self):
+        body = self.server.body
+        self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def download_all(items, threads, reuse, out_dir):
+    ui = DownloadUI(0)
+    ui.silent = True
+    lock = threading.Lock()
+    pending = list(items)
+
+    def worker():
+        session = requests.Session()
+        while True:
+            with lock:
+                if not pending:
+                    break
+                url, path = pending.pop()
+            if not reuse:
+                session.close()
+                session = requests.Session()
+            _do_download(url, os.path.join(out_dir, path), session, ui)
+        session.close()
+
+    workers = [threading.Thread(target=worker) for _ in range(threads)]
+    start = time.monotonic()
+    for worker_thread in workers:
+        worker_thread.start()
+    for worker_thread in workers:
+        worker_thread.join()
+    return time.monotonic() - start
+
+
+def main():
+    args = parse_args()
+    server = Server(args.file_size)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    base_url = "http://127.0.0.1:%d" % server.server_address[1]
+    items = [("%s/files/%d" % (base_url, n), "file-%d.bin" % n)
+             for n in range(args.files)]
+    report = {"files": len(items), "threads": args.threads}
+    for mode in MODES:
+        out_dir = tempfile.mkdtemp(prefix="beep-session-")
+        connections = server.connections
+        elapsed = download_all(items, args.threads, mode == "reused",
+                               out_dir)
+        report[mode] = {
+            "seconds": round(elapsed, 3),
+            "files_per_sec": round(len(items) / elapsed, 1),
+            "connections": server.connections - connections,
+        }
+        shutil.rmtree(out_dir, ignore_errors=True)
+    server.shutdown()
+    server.server_close()
+    report["speedup"] = round(
+        report["reused"]["files_per_sec"] /
+        report["per-file"]["files_per_sec"], 2)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
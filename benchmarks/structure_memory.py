@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+# Measures the peak memory of building, saving and loading the structure of
+# a huge account: the raw API objects written and read as a single JSON
+# document against the compact file entries written and read as NDJSON. Every
+# step runs in its own process, the peak is its maximum resident set size.
+#
+#   python3 benchmarks/structure_memory.py --files 500000
+
+import argparse
+import json
+import os
+import os.path
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from beep_downloader.structure import file_entry, dump_structure, \
+    load_structure
+
+STEPS = ["raw-save", "raw-load", "compact-save", "compact-load"]
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Peak memory of the structure of a huge account")
+    parser.add_argument("--files", type=int, default=500000)
+    parser.add_argument("--sites", type=int, default=50)
+    parser.add_argument("--files-per-folder", type=int, default=100)
+    parser.add_argument("--step", choices=STEPS, help=argparse.SUPPRESS)
+    parser.add_argument("--path", help=argparse.SUPPRESS)
+    return parser.parse_args()
+
+
+def api_file(fileEntryId, groupId, folderId):
+    # the fields returned by dlapp/get-file-entries
+    title = "Lezione %d del corso %d.pdf" % (fileEntryId, groupId)
+    return {
+        "uuid": "%08x-1c2d-4e5f-8a9b-%012x" % (groupId, fileEntryId),
+        "fileEntryId": fileEntryId,
+        "groupId": groupId,
+        "companyId": 10154,
+        "userId": 1000000 + fileEntryId % 977,
+        "userName": "Docente %d" % (fileEntryId % 977),
+        "createDate": 1600000000000 + fileEntryId,
+        "modifiedDate": 1600000000000 + fileEntryId * 7,
+        "repositoryId": groupId,
+        "folderId": folderId,
+        "treePath": "/%d/%d/" % (groupId, folderId),
+        "name": str(fileEntryId),
+        "fileName": title,
+        "extension": "pdf",
+        "mimeType": "application/pdf",
+        "title": title,
+        "description": "",
+        "extraSettings": "",
+        "fileEntryTypeId": 0,
+        "version": "1.0",
+        "size": 100000 + fileEntryId % 5000000,
+        "readCount": fileEntryId % 300,
+        "smallImageId": 0,
+        "largeImageId": 0,
+        "custom1ImageId": 0,
+        "custom2ImageId": 0,
+        "manualCheckInRequired": False,
+        "lastPublishDate": None,
+        "status": 0,
+        "statusByUserId": 0,
+    }
+
+
+def build(args, compact):
+    # the structure as the remotes return it, the compact one converts the
+    # files of every folder as soon as they are fetched
+    structure = dict()
+    fileEntryId = 0
+    folderId = 1
+    files_per_site = args.files // args.sites
+    for groupId in range(1, args.sites + 1):
+        site = {"name": "Corso %d" % groupId, "groupId": groupId,
+                "crawledAt": time.time(), "files": [], "folders": dict()}
+        structure[groupId] = site
+        count = 0
+        while count < files_per_site:
+            folder = {"folderId": folderId, "name": "Cartella %d" % folderId,
+                      "lastPostDate": None, "modifiedDate": None,
+                      "folders": dict()}
+            files = [
+                api_file(fileEntryId + i, groupId, folderId)
+                for i in range(min(args.files_per_folder,
+                                   files_per_site - count))
+            ]
+            folder["files"] = [file_entry(f) for f in files] if compact \
+                else files
+            site["folders"][folderId] = folder
+            fileEntryId += len(files)
+            count += len(files)
+            folderId += 1
+    return structure
+
+
+def run_step(args):
+    start = time.monotonic()
+    if args.step == "raw-save":
+        structure = build(args, False)
+        with open(args.path, "w") as f:
+            f.write(json.dumps(structure))
+    elif args.step == "raw-load":
+        with open(args.path) as f:
+            structure = json.loads(f.read())
+    elif args.step == "compact-save":
+        structure = build(args, True)
+        with open(args.path, "w") as f:
+            dump_structure(structure, f)
+    else:
+        with open(args.path) as f:
+            structure = load_structure(f)
+    # ru_maxrss is in KB on Linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    print(json.dumps({
+        "seconds": round(time.monotonic() - start, 2),
+        "peak_rss_mb": round(peak / 1024**2, 1),
+        "file_mb": round(os.path.getsize(args.path) / 1024**2, 1),
+    }))
+
+
+def main():
+    args = parse_args()
+    if args.step:
+        run_step(args)
+        return
+    work_dir = tempfile.mkdtemp(prefix="beep-structure-")
+    report = {"files": args.files}
+    for step in STEPS:
+        path = os.path.join(work_dir,
+                            "raw.json" if step.startswith("raw") else
+                            "compact.ndjson")
+        output = subprocess.check_output([
+            sys.executable, __file__, "--files", str(args.files), "--sites",
+            str(args.sites), "--files-per-folder",
+            str(args.files_per_folder), "--step", step, "--path", path
+        ])
+        report[step] = json.loads(output)
+    for name in os.listdir(work_dir):
+        os.remove(os.path.join(work_dir, name))
+    os.rmdir(work_dir)
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -13,6 +13,7 @@ setup(name="beep-downloader",
       url="https://github.com/edomora97/beep-downloader",
       packages=find_packages(exclude="test"),
       long_description="Beep downloader",
+      extras_require={"asyncio": ["aiohttp"]},
       entry_points={
           "console_scripts":
           ["beep-downloader = beep_downloader.__main__:main"]
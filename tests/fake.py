@@ -0,0 +1,25 @@
+# Starts the fake BeeP of the benchmarks and points the downloader to it
+
+import argparse
+import os.path
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..",
+                                "benchmarks"))
+
+from downloader import use_server
+from fakebeep import FakeBeep, add_arguments
+from beep_downloader.login import forget_login, set_session_cache
+
+
+def start_fake(**options):
+    # options are the ones of benchmarks/fakebeep.py, with underscores
+    parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    parser.set_defaults(**options)
+    fake = FakeBeep(parser.parse_args([])).start()
+    use_server(fake.base_url)
+    # the cookies of the previous fake are not valid on this one
+    set_session_cache(None)
+    forget_login(fake.config.username)
+    return fake
@@ -0,0 +1,49 @@
+import contextlib
+import io
+import unittest
+
+from beep_downloader.remote.json import JsonRemote
+from tests.fake import start_fake
+
+
+def crawl(fake, **options):
+    remote = JsonRemote(**options)
+    with contextlib.redirect_stdout(io.StringIO()):
+        sites = remote.get_user_sites(True, fake.config.username,
+                                      fake.config.password)
+    for site in sites.values():
+        del site["crawledAt"]
+    return sites
+
+
+def count_files(folder):
+    return len(folder["files"]) + sum(
+        count_files(f) for f in folder["folders"].values())
+
+
+class TestJsonCrawl(unittest.TestCase):
+    def setUp(self):
+        self.fake = start_fake(sites=4, depth=3, fanout=3, files=5,
+                               latency=0.01)
+        self.addCleanup(self.fake.stop)
+
+    def test_parallel_same_structure(self):
+        sequential = crawl(self.fake, threads=1)
+        parallel = crawl(self.fake, threads=8)
+        self.assertEqual(sum(map(count_files, sequential.values())),
+                         self.fake.tree.count()[0])
+        self.assertEqual(parallel, sequential)
+
+    def test_batch_same_structure(self):
+        requests = self.fake.stats.get("requests")
+        single = crawl(self.fake, threads=4)
+        single_requests = self.fake.stats.get("requests") - requests
+        requests = self.fake.stats.get("requests")
+        batched = crawl(self.fake, threads=4, batch=True)
+        batched_requests = self.fake.stats.get("requests") - requests
+        self.assertEqual(batched, single)
+        self.assertLess(batched_requests, single_requests)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from beep_downloader.dedup import HARDLINK, hash_file, share_content
+from beep_downloader.download import DownloadItem
+from beep_downloader.manifest import Manifest
+
+
+class TestShareContent(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp(prefix="beep-test-")
+        self.addCleanup(shutil.rmtree, self.out_dir, True)
+        self.manifest = Manifest(os.path.join(self.out_dir, "manifest.db"))
+        self.addCleanup(self.manifest.close)
+        self.next_id = 1
+
+    def download(self, folder, title, content):
+        # writes the file like a finished download and returns its validator
+        path = os.path.join(self.out_dir, folder, title)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            f.write(content)
+        validator = {
+            "path": path,
+            "length": len(content),
+            "hash": hash_file(path).hexdigest()
+        }
+        linked = share_content(self.manifest, validator, HARDLINK)
+        item = DownloadItem(None, path, self.next_id, len(content), 0)
+        self.next_id += 1
+        self.manifest.done(item, validator)
+        return path, linked
+
+    def test_same_content_linked(self):
+        first, linked = self.download("Corso A", "slides.pdf", b"a" * 1000)
+        self.assertFalse(linked)
+        copy, linked = self.download("Corso B", "lezione.pdf", b"a" * 1000)
+        self.assertTrue(linked)
+        self.assertTrue(os.path.samefile(first, copy))
+
+    def test_same_title_and_size_not_linked(self):
+        # the same title and size with a different content, like the
+        # solutions of two years differing in a few bytes
+        first, _ = self.download("Corso A", "esame.pdf", b"a" * 999 + b"1")
+        other, linked = self.download("Corso B", "esame.pdf",
+                                      b"a" * 999 + b"2")
+        self.assertFalse(linked)
+        self.assertFalse(os.path.samefile(first, other))
+        with open(other, "rb") as f:
+            self.assertEqual(f.read()[-1:], b"2")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,63 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+from urllib.parse import quote
+
+import requests
+
+from beep_downloader.dedup import new_hash
+from beep_downloader.download import PART_SUFFIX, _do_download
+from beep_downloader.download_ui import DownloadUI
+from tests.fake import start_fake
+from fakebeep import BLOCK_SIZE, file_block
+
+
+def content(f):
+    block = file_block(f["fileEntryId"])
+    return (block * (f["size"] // BLOCK_SIZE + 1))[:f["size"]]
+
+
+class TestResume(unittest.TestCase):
+    def setUp(self):
+        self.fake = start_fake(sites=1, depth=0, files=1, file_size=300000,
+                               size_spread=0, latency=0)
+        self.addCleanup(self.fake.stop)
+        self.out_dir = tempfile.mkdtemp(prefix="beep-test-")
+        self.addCleanup(shutil.rmtree, self.out_dir, True)
+        self.session = requests.Session()
+        self.session.cookies.set(
+            "JSESSIONID", self.fake.redeem_token(self.fake.new_token()))
+        self.addCleanup(self.session.close)
+        self.ui = DownloadUI(0)
+        self.ui.silent = True
+
+    def test_resume_after_drop(self):
+        (groupId, folderId, title), f = next(
+            iter(self.fake.tree.documents.items()))
+        url = "%s/documents/%d/%d/%s" % (self.fake.base_url, groupId,
+                                         folderId, quote(title))
+        path = os.path.join(self.out_dir, title)
+        # the server closes the connection halfway through the first response
+        self.fake.config.drop_rate = 1
+        with self.assertRaises(requests.RequestException):
+            _do_download(url, path, self.session, self.ui)
+        kept = os.path.getsize(path + PART_SUFFIX)
+        self.assertTrue(0 < kept <= f["size"] // 2)
+        self.fake.config.drop_rate = 0
+        validator = _do_download(url, path, self.session, self.ui)
+
+        expected = content(f)
+        with open(validator["path"], "rb") as saved:
+            self.assertEqual(saved.read(), expected)
+        hasher = new_hash()
+        hasher.update(expected)
+        self.assertEqual(validator["hash"], hasher.hexdigest())
+        # the second response carried only the bytes missing from the part
+        self.assertEqual(self.fake.stats.get("bytes"),
+                         f["size"] // 2 + f["size"] - kept)
+        self.assertFalse(os.path.exists(path + PART_SUFFIX))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,87 @@
+import contextlib
+import io
+import threading
+import time
+import unittest
+from unittest import mock
+from urllib.parse import quote
+
+import requests
+
+from beep_downloader import login
+from beep_downloader.login import LoginManager
+from tests.fake import start_fake
+
+WORKERS = 8
+
+
+class TestLoginManager(unittest.TestCase):
+    def setUp(self):
+        self.fake = start_fake(sites=1, depth=0, files=40, file_size=1000,
+                               size_spread=0, latency=0.005, session_ttl=1)
+        self.addCleanup(self.fake.stop)
+        self.urls = [
+            "%s/documents/%d/%d/%s" %
+            (self.fake.base_url, groupId, folderId, quote(title))
+            for groupId, folderId, title in self.fake.tree.documents
+        ]
+
+    def download_all(self, manager, seconds):
+        # every worker downloads the files over and over, logging in again
+        # through the manager when its session expires
+        expiries = []
+        deadline = time.monotonic() + seconds
+
+        def worker():
+            session = requests.Session()
+            expired = 0
+            while time.monotonic() < deadline:
+                for url in self.urls:
+                    generation, cookies = manager.get()
+                    self.assertIsNotNone(cookies)
+                    session.cookies = cookies
+                    res = session.get(url, allow_redirects=False)
+                    if res.is_redirect:
+                        expired += 1
+                        manager.expired(generation)
+                    else:
+                        self.assertEqual(res.status_code, 200)
+            session.close()
+            expiries.append(expired)
+
+        workers = [threading.Thread(target=worker) for _ in range(WORKERS)]
+        with contextlib.redirect_stdout(io.StringIO()):
+            for thread in workers:
+                thread.start()
+            for thread in workers:
+                thread.join(seconds + 30)
+        self.assertFalse(any(thread.is_alive() for thread in workers))
+        # a worker that failed an assertion does not report its expiries
+        self.assertEqual(len(expiries), WORKERS)
+        return sum(expiries)
+
+    def test_one_login_per_expiry(self):
+        manager = LoginManager(self.fake.config.username,
+                               self.fake.config.password)
+        self.download_all(manager, 4)
+        self.assertGreater(manager.generation, 2)
+        self.assertEqual(self.fake.stats.get("sessions"), manager.generation)
+
+    def test_refresh_before_expiry(self):
+        self.fake.config.session_ttl = 2
+        manager = LoginManager(self.fake.config.username,
+                               self.fake.config.password,
+                               lifetime=2)
+        with mock.patch.object(login, "MIN_REFRESH_INTERVAL", 0.5):
+            manager.start()
+            try:
+                expiries = self.download_all(manager, 5)
+            finally:
+                manager.stop()
+        self.assertGreater(manager.refreshes, 1)
+        self.assertEqual(self.fake.stats.get("sessions"), manager.generation)
+        self.assertEqual(expiries, 0)
+
+
+if __name__ == "__main__":
+    unittest.main()
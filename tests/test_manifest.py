@@ -0,0 +1,74 @@
+import os.path
+import shutil
+import tempfile
+import unittest
+
+from beep_downloader.download import DownloadItem
+from beep_downloader.manifest import Manifest
+from beep_downloader.structure import FileEntry
+
+
+def site(name, folders):
+    # a course with a file in its root and in each of the folders
+    groupId = len(name)
+    files = [FileEntry(groupId * 100, groupId, 0, name, "pdf", 10, 1)]
+    subfolders = dict()
+    for folderId, folder_name in folders.items():
+        subfolders[folderId] = {
+            "name": folder_name,
+            "files": [
+                FileEntry(folderId * 100, groupId, folderId, folder_name,
+                          "pdf", 10, 1)
+            ],
+            "folders": dict()
+        }
+    return groupId, {"name": name, "files": files, "folders": subfolders}
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self.out_dir = tempfile.mkdtemp(prefix="beep-test-")
+        self.addCleanup(shutil.rmtree, self.out_dir, True)
+        self.path = os.path.join(self.out_dir, "manifest.db")
+        self.manifest = Manifest(self.path)
+        self.addCleanup(lambda: self.manifest.close())
+
+    def test_stale_structure_removed(self):
+        structure = dict([
+            site("Analisi", {11: "Lezioni", 12: "Esami"}),
+            site("Fisica", {21: "Lezioni"})
+        ])
+        self.manifest.save_structure(structure)
+        groupId, analisi = site("Analisi", {11: "Lezioni"})
+        self.manifest.save_structure({groupId: analisi})
+
+        saved = self.manifest.load_structure()
+        self.assertEqual(list(saved), [groupId])
+        self.assertEqual(list(saved[groupId]["folders"]), [11])
+        files = self.manifest.conn.execute(
+            "SELECT fileEntryId FROM files ORDER BY fileEntryId").fetchall()
+        self.assertEqual(files, [(700, ), (1100, )])
+        folders = self.manifest.conn.execute(
+            "SELECT folderId FROM folders").fetchall()
+        self.assertEqual(folders, [(11, )])
+
+    def test_partial_until_done(self):
+        item = DownloadItem(None, "Analisi/slides.pdf", 1, 10, 2)
+        validator = {"path": item.path, "etag": '"1"', "length": 10}
+        self.manifest.done(item._replace(modifiedDate=1), validator)
+        self.manifest.started(item)
+        # reopened like a run interrupted during the download
+        self.manifest.close()
+        self.manifest = Manifest(self.path)
+
+        self.assertEqual(self.manifest.partial_files(), {1: item.path})
+        self.assertEqual(self.manifest.downloaded(), dict())
+        # the new version is requested with the validator of the old one
+        self.assertEqual(self.manifest.validator(1)["etag"], '"1"')
+        self.manifest.done(item, dict(validator, etag='"2"'))
+        self.assertEqual(self.manifest.partial_files(), dict())
+        self.assertEqual(self.manifest.downloaded(), {1: (2, item.path)})
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,100 @@
+import gzip
+import os.path
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from beep_downloader.filters import CrawlFilter
+from beep_downloader.remote import CrawlStats
+from beep_downloader.remote.scraper import FolderParser, get_structure
+
+# pages of a folder with 2,000 files and 45 subfolders, saved from the fake
+# BeeP that shows at most 500 files and 20 subfolders per page
+FIXTURES = os.path.join(os.path.dirname(__file__), "fixtures", "scraper")
+FOLDER_URL = "https://beep.metid.polimi.it/web/corso-10000/documenti-e-media"
+GROUP_ID = 10000
+FILES = 2000
+SUBFOLDERS = 45
+
+
+def load_page(name):
+    with gzip.open(os.path.join(FIXTURES, name + ".html.gz")) as f:
+        return f.read()
+
+
+class Response:
+    status_code = 200
+
+    def __init__(self, content):
+        self.content = content
+
+
+class SavedFolder:
+    # answers the requests of the scraper with the saved pages, the
+    # subfolders are empty. With ignore_start every request gets the first
+    # page, like a server that ignores the start of the pages
+    def __init__(self, ignore_start=False):
+        self.ignore_start = ignore_start
+        # request data of the pages of the folder
+        self.requests = []
+        self.lock = threading.Lock()
+
+    def post(self, url, data):
+        if url != FOLDER_URL:
+            return Response(b"<html><body></body></html>")
+        with self.lock:
+            self.requests.append(data)
+        entries = data["_20_entryStart"] < data["_20_entryEnd"]
+        folders = data["_20_folderStart"] < data["_20_folderEnd"]
+        if self.ignore_start or (entries and folders):
+            return Response(load_page("first"))
+        if entries:
+            return Response(load_page("entries-%d" % data["_20_entryStart"]))
+        return Response(load_page("folders-%d" % data["_20_folderStart"]))
+
+
+class TestPagination(unittest.TestCase):
+    def setUp(self):
+        self.parser = FolderParser()
+        self.addCleanup(self.parser.shutdown)
+
+    def crawl(self, session):
+        folder = {"name": "Corso"}
+        crawl_filter = CrawlFilter()
+        scope = crawl_filter.site(GROUP_ID, folder["name"])
+        pending = [(folder, GROUP_ID, 1, FOLDER_URL, scope)]
+        with ThreadPoolExecutor(4) as pool:
+            get_structure(pending, session, pool, self.parser, CrawlStats(),
+                          crawl_filter)
+        return folder
+
+    def test_all_pages_merged(self):
+        session = SavedFolder()
+        folder = self.crawl(session)
+        self.assertEqual(len({f.fileEntryId for f in folder["files"]}), FILES)
+        self.assertEqual(len(folder["files"]), FILES)
+        self.assertEqual(len(folder["folders"]), SUBFOLDERS)
+        # the first page, 3 more pages of files and 2 of subfolders
+        self.assertEqual(len(session.requests), 6)
+        for data in session.requests[1:]:
+            if data["_20_entryEnd"] > data["_20_entryStart"]:
+                self.assertEqual(data["_20_viewEntriesPage"],
+                                 data["_20_entryStart"] // 500 + 1)
+                self.assertEqual(data["_20_viewFoldersPage"], 1)
+            else:
+                self.assertEqual(data["_20_viewFoldersPage"],
+                                 data["_20_folderStart"] // 20 + 1)
+                self.assertEqual(data["_20_viewEntriesPage"], 1)
+
+    def test_server_ignores_start(self):
+        session = SavedFolder(ignore_start=True)
+        folder = self.crawl(session)
+        self.assertEqual(len(folder["files"]), 500)
+        self.assertEqual(len(folder["folders"]), 20)
+        # the pages known from the first one are fetched once, they bring
+        # nothing new and no more pages are asked
+        self.assertEqual(len(session.requests), 6)
+
+
+if __name__ == "__main__":
+    unittest.main()